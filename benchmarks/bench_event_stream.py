@@ -0,0 +1,222 @@
+"""
+Event-to-decision latency of the openHAB event stream (in-process) compared to the HABApp path.
+
+A fake openHAB publishes updates of the smart meter item and of the power item of a plug via its event stream (/rest/events).
+    - event_stream: OpenHabEventStream feeds the PlugManager directly
+    - habapp: a relay subscribes to the same event stream and forwards each event via http PUT to the API of the service
+      (same requests as the HABApp rules)
+The latency is measured from publishing the event until the PlugManager has evaluated the smart meter values resp. until
+the values of the plug have been updated. Events are published one after another (no queueing).
+NOTE: The relay and the API (uvicorn) run within this process. The overhead of HABApp itself (event bus, item registry,
+thread pool) and of the additional process is not included. The latency of the habapp mode is a lower bound.
+
+Usage:
+    python -m benchmarks.bench_event_stream --events 500 --output bench_event_stream.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import aiohttp
+
+from benchmarks.fake_openhab import FakeOpenhab
+
+PLUG_UUID = 'bench_plug'
+THING = 'bench:thing:1'
+SWITCH_ITEM = 'bench_switch'
+POWER_ITEM = 'bench_power'
+WATT_OBTAINED_ITEM = 'bench_watt_obtained'
+WATT_PRODUCED_ITEM = 'bench_watt_produced'
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _write_service_config(path : Path, log_file : Path) -> None:
+    # NOTE: no openhab_connection. Otherwise the config of the HABApp rules (within this repository) is rewritten at import.
+    path.write_text('\n'.join([f"log_file : '{log_file}'", "log_level : 40", "eval_time_in_min : 5", "default_base_load_in_watt : 250",
+                               "smartplugs: {}"]) + '\n')
+
+def _write_site_config(path : Path, log_file : Path, oh_url : str) -> None:
+    # the plug consumes more than ever produced. It stays off (no actuations during the benchmark).
+    path.write_text('\n'.join([f"log_file : '{log_file}'", "log_level : 40", "eval_time_in_min : 5", "default_base_load_in_watt : 250",
+                               "smartplugs:", f"  {PLUG_UUID}:", "    type : 'openhab'", "    enabled : True",
+                               "    expected_consumption_in_watt: 100000", "    consumer_efficiency: 0.3", f"    oh_thing_name : '{THING}'",
+                               f"    oh_switch_item_name : '{SWITCH_ITEM}'", f"    oh_power_consumption_item_name : '{POWER_ITEM}'",
+                               "    oh_automation_enabled_switch_item_name : ''",
+                               "openhab_connection:", f"  oh_url : '{oh_url}'", "  oh_user : ''", "  oh_password: ''",
+                               f"  oh_watt_obtained_from_provider_item : '{WATT_OBTAINED_ITEM}'",
+                               f"  oh_watt_produced_item : '{WATT_PRODUCED_ITEM}'", "  oh_event_stream : True"]) + '\n')
+
+class HabappRelay():
+    """Forwards the events via http like the HABApp rules (SmartMeterValueForwarder, SmartPlugSynchronizer)"""
+    def __init__(self, oh_url : str, api_url : str) -> None:
+        self._oh_url = oh_url
+        self._api_url = api_url
+        self._states : Dict[str, Any] = {WATT_OBTAINED_ITEM: None, WATT_PRODUCED_ITEM: None, SWITCH_ITEM: 'OFF', POWER_ITEM: '0', THING: 'ONLINE'}
+        self._task : Any = None
+
+    async def _run(self, session : aiohttp.ClientSession) -> None:
+        from smartplug_energy_controller.openhab_events import parse_event
+        topics = ','.join([f"openhab/items/{item}/*" for item in [WATT_OBTAINED_ITEM, WATT_PRODUCED_ITEM, SWITCH_ITEM, POWER_ITEM]] +
+                          [f"openhab/things/{THING}/statuschanged"])
+        async with session.get(f"{self._oh_url}/rest/events", params={'topics': topics}, timeout=aiohttp.ClientTimeout(total=None)) as response:
+            async for line in response.content:
+                text = line.decode().strip()
+                if not text.startswith('data:'):
+                    continue
+                event = parse_event(text[5:].strip())
+                if event is None or event.type not in ['ItemStateUpdatedEvent', 'ItemStateChangedEvent', 'ThingStatusInfoChangedEvent']:
+                    continue
+                self._states[event.name] = event.value
+                # NOTE: HABApp runs the rules concurrently to reading the events
+                if event.name == WATT_OBTAINED_ITEM and event.type == 'ItemStateUpdatedEvent':
+                    asyncio.create_task(self._put(session, f"{self._api_url}/smart-meter",
+                                                  {'watt_obtained_from_provider': self._states[WATT_OBTAINED_ITEM],
+                                                   'watt_produced': self._states[WATT_PRODUCED_ITEM]}))
+                elif event.name in [SWITCH_ITEM, POWER_ITEM, THING] and event.type != 'ItemStateUpdatedEvent':
+                    asyncio.create_task(self._put(session, f"{self._api_url}/plug-state/{PLUG_UUID}",
+                                                  {'watt_consumed_at_plug': float(self._states[POWER_ITEM].split(' ')[0]), 'online': self._states[THING] == 'ONLINE',
+                                                   'is_on': self._states[SWITCH_ITEM] == 'ON'}))
+
+    async def _put(self, session : aiohttp.ClientSession, url : str, payload : Dict[str, Any]) -> None:
+        async with session.put(url, json=payload) as response:
+            await response.read()
+
+    def start(self, session : aiohttp.ClientSession) -> None:
+        self._task = asyncio.create_task(self._run(session))
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+def _report(latencies_in_ms : List[float]) -> Dict[str, float]:
+    percentiles = statistics.quantiles(latencies_in_ms, n=100, method='inclusive')
+    return {'count': len(latencies_in_ms), 'mean_ms': statistics.fmean(latencies_in_ms), 'p50_ms': percentiles[49],
+            'p90_ms': percentiles[89], 'p99_ms': percentiles[98], 'max_ms': max(latencies_in_ms)}
+
+class LatencyProbe():
+    """Wraps an async method of an object. Resolves the waiter of the first argument once the method has returned."""
+    def __init__(self, obj : Any, method : str) -> None:
+        self._waiters : Dict[float, asyncio.Future] = {}
+        func = getattr(obj, method)
+        async def wrapper(value : float, *args, **kwargs):
+            result = await func(value, *args, **kwargs)
+            waiter = self._waiters.pop(float(value), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+            return result
+        setattr(obj, method, wrapper)
+
+    def expect(self, value : float) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[value] = waiter
+        return waiter
+
+async def _measure(openhab : FakeOpenhab, probes : Dict[str, LatencyProbe], events : int, interval_in_sec : float,
+                   offset : float) -> Dict[str, Dict[str, float]]:
+    publish : Dict[str, Callable[[float], None]] = {
+        'smart_meter': lambda value: openhab.update_item(WATT_OBTAINED_ITEM, str(value)),
+        'plug': lambda value: openhab.update_item(POWER_ITEM, f"{value} W")}
+    latencies : Dict[str, List[float]] = {kind: [] for kind in publish}
+    for i in range(events):
+        for kind, publish_event in publish.items():
+            # unique values: each update is a change as well
+            value = offset + i
+            waiter = probes[kind].expect(value)
+            start = time.perf_counter()
+            publish_event(value)
+            latencies[kind].append((await asyncio.wait_for(waiter, timeout=10) - start)*1000)
+            await asyncio.sleep(interval_in_sec)
+    return {kind: _report(values) for kind, values in latencies.items()}
+
+async def _wait_until(condition : Callable[[], bool], timeout_in_sec : float = 10) -> None:
+    deadline = time.monotonic() + timeout_in_sec
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met in time")
+        await asyncio.sleep(0.01)
+
+async def run(args : argparse.Namespace) -> Dict[str, Any]:
+    openhab = FakeOpenhab()
+    await openhab.start()
+    openhab.thing_states[THING] = 'ONLINE'
+    openhab.item_states.update({SWITCH_ITEM: 'OFF', POWER_ITEM: '0 W', WATT_OBTAINED_ITEM: '1000', WATT_PRODUCED_ITEM: '0'})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        service_config = Path(tmp_dir)/'config.yml'
+        _write_service_config(service_config, Path(tmp_dir)/'service.log')
+        site_config = Path(tmp_dir)/'site.yml'
+        _write_site_config(site_config, Path(tmp_dir)/'service.log', openhab.url)
+        port = _free_port()
+        os.environ.update({'CONFIG_PATH': str(service_config), 'SMARTPLUG_ENERGY_CONTROLLER_PORT': str(port)})
+        import uvicorn
+        from smartplug_energy_controller.app import create_app, Settings
+        from smartplug_energy_controller.config import ConfigParser
+        from smartplug_energy_controller.openhab_events import OpenHabEventStream
+        service = create_app(Settings()) # type: ignore
+        cfg_parser = ConfigParser(site_config, None)
+        site = service.state.sites.add('bench', cfg_parser)
+        probes = {'smart_meter': LatencyProbe(site.manager, 'ingest_smart_meter_values'),
+                  'plug': LatencyProbe(site.manager.plug(PLUG_UUID), 'update_values')}
+        server = uvicorn.Server(uvicorn.Config(service, host='127.0.0.1', port=port, log_level='error', lifespan='off'))
+        server_task = asyncio.create_task(server.serve())
+        await _wait_until(lambda: server.started)
+        report : Dict[str, Any] = {'config': vars(args)}
+        try:
+            async with aiohttp.ClientSession() as session:
+                for round_index in range(args.rounds):
+                    relay = HabappRelay(openhab.url, f"http://127.0.0.1:{port}/sites/bench")
+                    relay.start(session)
+                    await _wait_until(lambda: openhab.subscriber_count == 1)
+                    habapp = await _measure(openhab, probes, args.events, args.interval_ms/1000, offset=1000 + 2*round_index*args.events)
+                    await relay.stop()
+                    await _wait_until(lambda: openhab.subscriber_count == 0)
+
+                    assert cfg_parser.oh_connection is not None
+                    event_stream = OpenHabEventStream(site.manager._logger, cfg_parser.oh_connection, site.manager, service.state.session_pool)
+                    event_stream.start()
+                    await _wait_until(lambda: openhab.subscriber_count == 1 and event_stream.metrics['plug_updates'] > 0)
+                    native = await _measure(openhab, probes, args.events, args.interval_ms/1000, offset=1000 + (2*round_index + 1)*args.events)
+                    await event_stream.stop()
+                    await _wait_until(lambda: openhab.subscriber_count == 0)
+                    report.setdefault('rounds', []).append({'habapp': habapp, 'event_stream': native})
+        finally:
+            server.should_exit = True
+            await server_task
+            await service.state.session_pool.close()
+            await openhab.stop()
+    for mode in ['habapp', 'event_stream']:
+        for kind in ['smart_meter', 'plug']:
+            p50 = statistics.median(r[mode][kind]['p50_ms'] for r in report['rounds'])
+            report.setdefault('summary', {}).setdefault(mode, {})[f"{kind}_p50_ms"] = p50
+    return report
+
+def create_args_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Event-to-decision latency: openHAB event stream vs. HABApp path")
+    parser.add_argument('--events', type=int, default=200, help="Events per kind (smart meter, plug) and mode")
+    parser.add_argument('--rounds', type=int, default=3, help="Both modes are measured alternately in each round")
+    parser.add_argument('--interval-ms', type=float, default=5, help="Pause between two events")
+    parser.add_argument('--output', type=Path, default=None, help="Optional JSON file the report is written to")
+    return parser
+
+def main() -> None:
+    args = create_args_parser().parse_args()
+    report = asyncio.run(run(args))
+    print(json.dumps(report['summary'], indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Microbenchmarks for the rolling-window and decision hot paths.
+
+Usage:
+    python -m benchmarks.bench_hot_paths --output bench_results.json
+    python -m benchmarks.bench_hot_paths --output new.json --compare old.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from functools import cached_property
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Union
+
+from smartplug_energy_controller import __version__
+from smartplug_energy_controller.utils import RollingValues, ValueEntry, SavingsFromPlugsTurnedOff, VirtualClock
+from smartplug_energy_controller.plug_controller import PlugController
+from smartplug_energy_controller.plug_manager import PlugManager
+from smartplug_energy_controller.config import SmartPlugConfig
+
+logger = logging.getLogger('benchmark')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+WINDOWS_IN_MIN = [1, 5, 15]
+SAMPLE_RATES_IN_HZ = [0.1, 1, 10]
+CONTROLLER_COUNTS = [1, 10, 100, 500]
+
+class FakePlugController(PlugController):
+    def __init__(self, logger : logging.Logger, cfg : SmartPlugConfig, clock : VirtualClock) -> None:
+        super().__init__(logger, cfg, clock)
+        self._is_on = False
+
+    @cached_property
+    def info(self) -> Dict[str, str]:
+        return {'type': 'fake'}
+
+    def reset(self) -> None:
+        pass
+
+    async def is_online(self) -> bool:
+        return True
+
+    async def is_on(self) -> bool:
+        return self._is_on
+
+    async def turn_on(self) -> bool:
+        await super().turn_on()
+        self._is_on = True
+        return True
+
+    async def turn_off(self) -> bool:
+        await super().turn_off()
+        self._is_on = False
+        return True
+
+def _result(name : str, params : Dict[str, Any], durations_in_s : List[float]) -> Dict[str, Any]:
+    durations_in_us = [d*1e6 for d in durations_in_s]
+    return {'name': name, 'params': params, 'ops': len(durations_in_us),
+            'mean_us': statistics.fmean(durations_in_us), 'median_us': statistics.median(durations_in_us),
+            'min_us': min(durations_in_us), 'max_us': max(durations_in_us)}
+
+def _measure(func : Callable[[], Any], repeat : int) -> List[float]:
+    durations : List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def _filled_rolling_values(window_in_min : int, rate_in_hz : float, start : datetime) -> RollingValues:
+    rolling_values = RollingValues(timedelta(minutes=window_in_min))
+    step = timedelta(seconds=1/rate_in_hz)
+    for i in range(int(window_in_min*60*rate_in_hz) + 1):
+        rolling_values.add(ValueEntry(float(i % 500), start + i*step))
+    return rolling_values
+
+def bench_rolling_values(repeat : int) -> List[Dict[str, Any]]:
+    results : List[Dict[str, Any]] = []
+    for window_in_min in WINDOWS_IN_MIN:
+        for rate_in_hz in SAMPLE_RATES_IN_HZ:
+            params = {'window_in_min': window_in_min, 'rate_in_hz': rate_in_hz}
+            start = datetime(2024, 6, 1, 12)
+            step = timedelta(seconds=1/rate_in_hz)
+            rolling_values = _filled_rolling_values(window_in_min, rate_in_hz, start)
+            params['value_count'] = rolling_values.value_count()
+            # steady state: every added value trims the oldest one
+            next_timestamp = rolling_values[-1].timestamp
+            def add() -> None:
+                nonlocal next_timestamp
+                next_timestamp += step
+                rolling_values.add(ValueEntry(123.0, next_timestamp))
+            results.append(_result('RollingValues.add', params, _measure(add, repeat)))
+            results.append(_result('RollingValues.mean', params, _measure(rolling_values.mean, repeat)))
+            results.append(_result('RollingValues.median', params, _measure(rolling_values.median, repeat)))
+            results.append(_result('RollingValues.ratio', params, _measure(lambda: rolling_values.ratio(100), repeat)))
+    return results
+
+def bench_savings(repeat : int) -> List[Dict[str, Any]]:
+    results : List[Dict[str, Any]] = []
+    for window_in_min in WINDOWS_IN_MIN:
+        for rate_in_hz in SAMPLE_RATES_IN_HZ:
+            params = {'window_in_min': window_in_min, 'rate_in_hz': rate_in_hz}
+            savings = SavingsFromPlugsTurnedOff()
+            step = timedelta(seconds=1/rate_in_hz)
+            timestamp = datetime(2024, 6, 1, 12)
+            counter = 0
+            def value() -> None:
+                # a plug is turned off with every sample. The saving is valid for the evaluated window.
+                nonlocal timestamp, counter
+                timestamp += step
+                counter += 1
+                savings.add(f"plug_{counter % 100}", 100, timestamp, timedelta(minutes=window_in_min))
+                savings.value(timestamp)
+            results.append(_result('SavingsFromPlugsTurnedOff.value', params, _measure(value, repeat)))
+    return results
+
+def _create_manager(controller_count : int, clock : VirtualClock, allocate_surplus : bool = False) -> PlugManager:
+    manager = PlugManager(logger, eval_time_in_min=5, default_base_load_in_watt=200, clock=clock, allocate_surplus=allocate_surplus)
+    for i in range(controller_count):
+        cfg = SmartPlugConfig(type='fake', enabled=True, expected_consumption_in_watt=100, consumer_efficiency=0.5)
+        manager._add_plug_controller(f"plug_{i}", FakePlugController(logger, cfg, clock))
+    return manager
+
+async def _bench_manager(controller_count : int, watt_obtained : float, watt_produced : float, allocate_surplus : bool, repeat : int) -> List[float]:
+    # virtual time: the manager takes its timestamps from the clock
+    clock = VirtualClock()
+    manager = _create_manager(controller_count, clock, allocate_surplus)
+    # fill the evaluation window at 1 Hz
+    for _ in range(5*60):
+        clock.advance(timedelta(seconds=1))
+        await manager.add_smart_meter_values(watt_obtained, watt_produced)
+    durations : List[float] = []
+    for _ in range(repeat):
+        clock.advance(timedelta(seconds=1))
+        start = time.perf_counter()
+        await manager.add_smart_meter_values(watt_obtained, watt_produced)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def bench_plug_manager(repeat : int) -> List[Dict[str, Any]]:
+    results : List[Dict[str, Any]] = []
+    # 'consumption': all plugs are off and energy is obtained -> every plug is checked for turning off (worst case)
+    # 'overproduction': energy is produced -> plugs are turned on one by one until all plugs are on
+    # 'allocation': like 'overproduction', but the surplus is allocated to all plugs within each evaluation
+    scenarios = {'consumption': (300.0, 0.0, False), 'overproduction': (0.0, 5000.0, False), 'allocation': (0.0, 5000.0, True)}
+    for controller_count in CONTROLLER_COUNTS:
+        for scenario, (watt_obtained, watt_produced, allocate_surplus) in scenarios.items():
+            params = {'controller_count': controller_count, 'scenario': scenario, 'rate_in_hz': 1, 'window_in_min': 5}
+            durations = asyncio.run(_bench_manager(controller_count, watt_obtained, watt_produced, allocate_surplus, repeat))
+            results.append(_result('PlugManager.add_smart_meter_values', params, durations))
+    return results
+
+def _key(result : Dict[str, Any]) -> str:
+    return f"{result['name']}{json.dumps(result['params'], sort_keys=True)}"
+
+def compare(results : List[Dict[str, Any]], baseline_file : Path) -> None:
+    with open(baseline_file) as f:
+        baseline = {_key(result): result for result in json.load(f)['results']}
+    print(f"{'benchmark':<110} {'baseline [us]':>14} {'current [us]':>14} {'change':>8}")
+    for result in results:
+        old : Union[None, Dict[str, Any]] = baseline.get(_key(result))
+        if old is None:
+            continue
+        change = (result['median_us'] - old['median_us'])/old['median_us']*100 if old['median_us'] else 0
+        print(f"{_key(result):<110} {old['median_us']:>14.2f} {result['median_us']:>14.2f} {change:>+7.1f}%")
+
+def create_args_parser() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(description="Microbenchmarks for the rolling-window and decision hot paths")
+    parser.add_argument('--output', type=Path, default=Path('bench_results.json'), help="JSON file the results are written to")
+    parser.add_argument('--compare', type=Path, default=None, help="JSON file of a previous run to compare the results with")
+    parser.add_argument('--repeat', type=int, default=200, help="Number of measured calls per benchmark")
+    return parser
+
+def main() -> None:
+    args = create_args_parser().parse_args()
+    results = bench_rolling_values(args.repeat) + bench_savings(args.repeat) + bench_plug_manager(args.repeat)
+    data = {'meta': {'version': __version__, 'python': sys.version, 'platform': platform.platform(),
+                     'created': datetime.now().isoformat(), 'repeat': args.repeat},
+            'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(data, f, indent=2)
+    for result in results:
+        print(f"{_key(result):<110} median={result['median_us']:>10.2f}us max={result['max_us']:>10.2f}us")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
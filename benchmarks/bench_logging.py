@@ -0,0 +1,107 @@
+"""
+Ingest latency (PlugManager.add_smart_meter_values) with a slow log disk (e.g. an SD card of a Raspberry Pi).
+
+The disk is simulated by a file handler that sleeps for --write-delay-ms after each record (like a slow write/fsync).
+Modes:
+    'direct': the handler is attached to the logger. Records are written on the event loop (behaviour before the QueueListener).
+    'queued': records are handed over to a DroppingQueueHandler and written by a QueueListener thread (see init_logger).
+
+Usage:
+    python -m benchmarks.bench_logging --output logging.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+from logging.handlers import QueueListener
+from pathlib import Path
+from typing import Any, Dict, List, Union
+
+from smartplug_energy_controller.utils import DroppingQueueHandler, VirtualClock
+from benchmarks.bench_hot_paths import FakePlugController
+from smartplug_energy_controller.plug_manager import PlugManager
+from smartplug_energy_controller.config import SmartPlugConfig
+
+class SlowFileHandler(logging.FileHandler):
+    def __init__(self, file : Path, write_delay_in_s : float) -> None:
+        super().__init__(file)
+        self._write_delay_in_s=write_delay_in_s
+
+    def emit(self, record : logging.LogRecord) -> None:
+        super().emit(record)
+        time.sleep(self._write_delay_in_s)
+
+def _percentile(values : List[float], percent : float) -> float:
+    values=sorted(values)
+    return values[min(len(values) - 1, int(len(values)*percent/100))]
+
+async def _measure(logger : logging.Logger, values : int, interval_in_s : float) -> List[float]:
+    clock=VirtualClock()
+    manager=PlugManager(logger, eval_time_in_min=5, default_base_load_in_watt=200, clock=clock)
+    for i in range(4):
+        cfg=SmartPlugConfig(type='fake', enabled=True, expected_consumption_in_watt=100, consumer_efficiency=0.5)
+        manager._add_plug_controller(f"plug_{i}", FakePlugController(logger, cfg, clock))
+    latencies : List[float] = []
+    for i in range(values):
+        clock.advance(timedelta(seconds=1))
+        start=time.perf_counter()
+        # alternating consumption and overproduction: plugs are switched and the break-even value changes (info records)
+        await manager.add_smart_meter_values(300.0 if (i//20) % 2 == 0 else 0.0, 1000.0)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval_in_s)
+    return latencies
+
+def run(mode : str, level : int, args : argparse.Namespace, log_dir : Path) -> Dict[str, Any]:
+    logger=logging.getLogger(f"bench_logging.{mode}.{level}")
+    logger.propagate=False
+    logger.setLevel(level)
+    file_handler=SlowFileHandler(log_dir/f"{mode}_{level}.log", args.write_delay_ms/1000)
+    file_handler.setFormatter(logging.Formatter("%(levelname)s: %(asctime)s: %(message)s"))
+    listener : Union[None, QueueListener] = None
+    queue_handler : Union[None, DroppingQueueHandler] = None
+    if mode == 'queued':
+        queue_handler=DroppingQueueHandler(args.queue_size)
+        listener=QueueListener(queue_handler.queue, file_handler)
+        listener.start()
+        logger.addHandler(queue_handler)
+    else:
+        logger.addHandler(file_handler)
+    try:
+        latencies_in_ms=[latency*1000 for latency in asyncio.run(_measure(logger, args.values, args.interval_ms/1000))]
+    finally:
+        if listener is not None:
+            listener.stop()
+        file_handler.close()
+    return {'mode': mode, 'level': logging.getLevelName(level), 'values': len(latencies_in_ms),
+            'p50_ms': statistics.median(latencies_in_ms), 'p99_ms': _percentile(latencies_in_ms, 99), 'max_ms': max(latencies_in_ms),
+            'dropped': queue_handler.dropped if queue_handler is not None else 0}
+
+def create_args_parser() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(description="Ingest latency with a slow log disk: logging on the event loop vs. QueueListener")
+    parser.add_argument('--values', type=int, default=300, help="Smart meter values per mode")
+    parser.add_argument('--interval-ms', type=float, default=5, help="Pause between two values")
+    parser.add_argument('--write-delay-ms', type=float, default=20, help="Simulated duration of writing one record to the disk")
+    parser.add_argument('--queue-size', type=int, default=10000, help="Size of the queue of the DroppingQueueHandler")
+    parser.add_argument('--output', type=Path, default=None, help="Optional JSON file the report is written to")
+    return parser
+
+def main() -> None:
+    args=create_args_parser().parse_args()
+    results : List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as log_dir:
+        for level in [logging.INFO, logging.DEBUG]:
+            for mode in ['direct', 'queued']:
+                results.append(run(mode, level, args, Path(log_dir)))
+    for result in results:
+        print(f"{result['mode']:<8} {result['level']:<6} p50={result['p50_ms']:>8.3f}ms p99={result['p99_ms']:>8.3f}ms "
+              f"max={result['max_ms']:>8.3f}ms dropped={result['dropped']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'write_delay_ms': args.write_delay_ms, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
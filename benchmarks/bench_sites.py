@@ -0,0 +1,99 @@
+"""
+Benchmark of the multi-site mode: many sites (each with its own PlugManager) within one process and event loop.
+
+All plugs are openHAB plugs. Actuations are posted to a fake openHAB REST server via the shared connection pool.
+Reports the throughput of smart meter values, the memory per site and the peak RSS of the process.
+
+Usage:
+    python -m benchmarks.bench_sites --sites 300 --plugs 10 --readings 60
+"""
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Dict, List
+
+from benchmarks.fake_openhab import FakeOpenhab
+from smartplug_energy_controller.sites import Sites
+from smartplug_energy_controller.utils import ClientSessionPool, VirtualClock
+
+logger = logging.getLogger('benchmark')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+def _write_site_config(path : Path, site : int, plug_count : int, oh_url : str) -> None:
+    lines = ["log_file : 'unused.log'", "log_level : 30", "eval_time_in_min : 5", "default_base_load_in_watt : 250", "smartplugs:"]
+    for plug in range(plug_count):
+        lines += [f"  site{site}_plug{plug}:", "    type : 'openhab'", "    enabled : True", "    expected_consumption_in_watt: 100",
+                  "    consumer_efficiency: 0.3", f"    oh_thing_name : 'thing_{site}_{plug}'", f"    oh_switch_item_name : 'switch_{site}_{plug}'",
+                  f"    oh_power_consumption_item_name : 'power_{site}_{plug}'", "    oh_automation_enabled_switch_item_name : ''"]
+    lines += ["openhab_connection:", f"  oh_url : '{oh_url}'", "  oh_user : ''", "  oh_password: ''"]
+    path.write_text('\n'.join(lines) + '\n')
+
+async def run(args : argparse.Namespace) -> Dict[str, Any]:
+    openhab = FakeOpenhab(latency_in_sec=args.oh_latency_ms/1000)
+    await openhab.start()
+    clock = VirtualClock()
+    session_pool = ClientSessionPool(limit=args.max_connections)
+    sites = Sites(logger, clock, session_pool)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for site in range(args.sites):
+                _write_site_config(Path(tmp_dir)/f"site{site}.yml", site, args.plugs, openhab.url)
+            start = time.perf_counter()
+            sites.load(Path(tmp_dir))
+            load_time = time.perf_counter() - start
+
+        # every site gets one reading per (virtual) 10 seconds: half of the time overproduction, half of the time consumption
+        latencies : List[float] = []
+        async def add_values(name : str, watt_obtained : float, watt_produced : float) -> None:
+            start = time.perf_counter()
+            await sites[name].manager.add_smart_meter_values(watt_obtained, watt_produced)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for reading in range(args.readings):
+            clock.advance(timedelta(seconds=10))
+            overproduction = (reading//30) % 2 == 0
+            await asyncio.gather(*[add_values(name, 0 if overproduction else 500, 2000 if overproduction else 0) for name in sites.names])
+        elapsed = time.perf_counter() - start
+        # incl. rolling values and decision traces
+        memory = [sites.memory_in_bytes(name) for name in sites.names]
+    finally:
+        await session_pool.close()
+        await openhab.stop()
+
+    latencies_in_ms = sorted(latency*1000 for latency in latencies)
+    return {'config': vars(args), 'load_time_in_sec': load_time, 'elapsed_in_sec': elapsed,
+            'readings_per_sec': len(latencies)/elapsed,
+            'latency_p50_ms': latencies_in_ms[len(latencies_in_ms)//2], 'latency_p99_ms': latencies_in_ms[int(len(latencies_in_ms)*0.99)],
+            'memory_per_site_in_bytes': {'mean': statistics.fmean(memory), 'max': max(memory)},
+            'max_rss_in_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+            'openhab_posts': sum(openhab.post_count.values())}
+
+def create_args_parser() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(description="Benchmark of the multi-site mode of smartplug-energy-controller")
+    parser.add_argument('--sites', type=int, default=300)
+    parser.add_argument('--plugs', type=int, default=10, help="Plugs per site")
+    parser.add_argument('--readings', type=int, default=60, help="Smart meter values per site")
+    parser.add_argument('--oh-latency-ms', type=float, default=0)
+    parser.add_argument('--max-connections', type=int, default=100)
+    parser.add_argument('--output', type=Path, default=None, help="Optional JSON file the report is written to")
+    return parser
+
+def main() -> None:
+    args = create_args_parser().parse_args()
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, default=str))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Read and ingest throughput of the service against the number of worker processes.
+
+For every worker count the service is started (see SMARTPLUG_ENERGY_CONTROLLER_WORKERS) and driven by closed-loop clients:
+first with GET /smart-meter (reads served from the snapshot), then with PUT /smart-meter (ingest forwarded to the owner).
+
+Usage:
+    python -m benchmarks.bench_workers --workers 1 2 4 --concurrency 32 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import aiohttp
+
+from benchmarks.fake_openhab import FakeOpenhab
+from benchmarks.load_harness import OpenhabPlug, _free_port, _wait_until_ready, _write_config
+
+async def _closed_loop(concurrency : int, duration_in_sec : float, send : Callable[[int], Any]) -> Dict[str, Any]:
+    latencies : List[float] = []
+    errors = 0
+    deadline = time.monotonic() + duration_in_sec
+    counter = 0
+
+    async def client() -> None:
+        nonlocal errors, counter
+        while time.monotonic() < deadline:
+            counter += 1
+            start = time.perf_counter()
+            try:
+                status = await send(counter)
+            except aiohttp.ClientError:
+                status = 0
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+    latencies_in_ms = sorted(latency*1000 for latency in latencies)
+    return {'requests_per_sec': len(latencies)/elapsed, 'errors': errors,
+            'p50_ms': statistics.median(latencies_in_ms) if latencies_in_ms else None,
+            'p99_ms': latencies_in_ms[int(len(latencies_in_ms)*0.99)] if latencies_in_ms else None}
+
+async def _bench(workers : int, args : argparse.Namespace, oh_url : str, oh_plugs : List[OpenhabPlug]) -> Dict[str, Any]:
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_file = Path(tmp_dir)/'config.yml'
+        _write_config(config_file, Path(tmp_dir)/'service.log', oh_url, oh_plugs, {})
+        env = dict(os.environ, CONFIG_PATH=str(config_file), SMARTPLUG_ENERGY_CONTROLLER_PORT=str(port),
+                   SMARTPLUG_ENERGY_CONTROLLER_WORKERS=str(workers))
+        process = subprocess.Popen([sys.executable, '-c', 'from smartplug_energy_controller.app import serve; serve()'], env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+                await _wait_until_ready(session, base_url, process)
+
+                async def read(_ : int) -> int:
+                    async with session.get(f"{base_url}/smart-meter") as response:
+                        await response.read()
+                        return response.status
+
+                async def ingest(counter : int) -> int:
+                    # NOTE: no timestamp. Concurrent requests are not received in order.
+                    payload = {'watt_obtained_from_provider': 300 if (counter//100) % 2 == 0 else 0, 'watt_produced': 500}
+                    async with session.put(f"{base_url}/smart-meter", json=payload) as response:
+                        await response.read()
+                        return response.status
+
+                return {'workers': workers,
+                        'read': await _closed_loop(args.concurrency, args.duration, read),
+                        'ingest': await _closed_loop(args.concurrency, args.duration, ingest)}
+        finally:
+            process.terminate()
+            process.wait()
+
+async def run(args : argparse.Namespace) -> Dict[str, Any]:
+    openhab = FakeOpenhab()
+    await openhab.start()
+    oh_plugs = [OpenhabPlug(str(uuid.uuid4()), f"switch_{i}", f"power_{i}", 100 + 50*i) for i in range(args.openhab_plugs)]
+    try:
+        results = [await _bench(workers, args, openhab.url, oh_plugs) for workers in args.workers]
+    finally:
+        await openhab.stop()
+    return {'config': vars(args), 'cpu_count': os.cpu_count(), 'results': results}
+
+def create_args_parser() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(description="Throughput of smartplug-energy-controller against the number of workers")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--concurrency', type=int, default=32, help="Number of concurrent clients")
+    parser.add_argument('--duration', type=float, default=10, help="Duration of each phase in seconds")
+    parser.add_argument('--openhab-plugs', type=int, default=4)
+    parser.add_argument('--output', type=Path, default=None, help="Optional JSON file the report is written to")
+    return parser
+
+def main() -> None:
+    args = create_args_parser().parse_args()
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, default=str))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+if __name__ == '__main__':
+    main()
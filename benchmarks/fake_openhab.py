@@ -0,0 +1,125 @@
+"""
+Local stand-in for the openHAB REST API.
+
+Accepts posts to /rest/items/{item} with a configurable latency and failure rate and keeps the latest state of each item.
+Changes of the items and things are published via the event stream (/rest/events) like openHAB 4 does.
+"""
+import asyncio
+import fnmatch
+import json
+import random
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+from aiohttp import web
+
+@dataclass()
+class FakeOpenhab:
+    port : int = 0
+    latency_in_sec : float = 0
+    failure_rate : float = 0
+    item_states : Dict[str, str] = field(default_factory=dict)
+    thing_states : Dict[str, str] = field(default_factory=dict)
+    post_count : Counter = field(default_factory=Counter)
+    failure_count : int = 0
+    _runner : Any = None
+    # topic patterns and queue of each subscriber of the event stream
+    _subscribers : List[Tuple[List[str], asyncio.Queue]] = field(default_factory=list)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _post_item(self, request : web.Request) -> web.Response:
+        item = request.match_info['item']
+        value = await request.text()
+        if self.latency_in_sec > 0:
+            await asyncio.sleep(self.latency_in_sec)
+        if random.random() < self.failure_rate:
+            self.failure_count += 1
+            raise web.HTTPInternalServerError(text="Simulated failure")
+        self.post_count[item] += 1
+        # NOTE: a command is applied at once (like the autoupdate of openHAB)
+        self.update_item(item, value)
+        return web.Response()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def _publish(self, topic : str, event_type : str, payload : Any) -> None:
+        data = json.dumps({'topic': topic, 'payload': json.dumps(payload), 'type': event_type})
+        for patterns, queue in self._subscribers:
+            if any(fnmatch.fnmatchcase(topic, pattern) for pattern in patterns):
+                queue.put_nowait(data)
+
+    def update_item(self, item : str, value : str, value_type : str = 'Decimal') -> None:
+        old_value = self.item_states.get(item)
+        self.item_states[item] = value
+        self._publish(f"openhab/items/{item}/state", 'ItemStateEvent', {'type': value_type, 'value': value})
+        self._publish(f"openhab/items/{item}/stateupdated", 'ItemStateUpdatedEvent', {'type': value_type, 'value': value})
+        if old_value != value:
+            self._publish(f"openhab/items/{item}/statechanged", 'ItemStateChangedEvent',
+                          {'type': value_type, 'value': value, 'oldType': value_type, 'oldValue': old_value})
+
+    def set_thing_status(self, thing : str, status : str) -> None:
+        old_status = self.thing_states.get(thing)
+        self.thing_states[thing] = status
+        if old_status != status:
+            self._publish(f"openhab/things/{thing}/statuschanged", 'ThingStatusInfoChangedEvent',
+                          [{'status': status, 'statusDetail': 'NONE'}, {'status': old_status, 'statusDetail': 'NONE'}])
+
+    async def _events(self, request : web.Request) -> web.StreamResponse:
+        patterns = request.query.get('topics', '*').split(',')
+        queue : asyncio.Queue = asyncio.Queue()
+        subscriber = (patterns, queue)
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        self._subscribers.append(subscriber)
+        try:
+            while True:
+                data = await queue.get()
+                await response.write(f"event: message\ndata: {data}\n\n".encode())
+        finally:
+            self._subscribers.remove(subscriber)
+
+    async def _get_root(self, request : web.Request) -> web.Response:
+        return web.json_response({'version': '5', 'runtimeInfo': {'version': '4.1.0'}})
+
+    async def _get_items(self, request : web.Request) -> web.Response:
+        return web.json_response([{'name': item, 'state': state} for item, state in self.item_states.items()])
+
+    async def _get_things(self, request : web.Request) -> web.Response:
+        return web.json_response([{'UID': thing, 'statusInfo': {'status': status, 'statusDetail': 'NONE'}} for thing, status in self.thing_states.items()])
+
+    async def _get_thing(self, request : web.Request) -> web.Response:
+        thing = request.match_info['thing']
+        if thing not in self.thing_states:
+            raise web.HTTPNotFound()
+        return web.json_response({'UID': thing, 'statusInfo': {'status': self.thing_states[thing], 'statusDetail': 'NONE'}})
+
+    async def _get_item(self, request : web.Request) -> web.Response:
+        item = request.match_info['item']
+        if item not in self.item_states:
+            raise web.HTTPNotFound()
+        return web.json_response({'name': item, 'state': self.item_states[item]})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post('/rest/items/{item}', self._post_item)
+        app.router.add_get('/rest/items', self._get_items)
+        app.router.add_get('/rest/items/{item}', self._get_item)
+        app.router.add_get('/rest/things', self._get_things)
+        app.router.add_get('/rest/', self._get_root)
+        app.router.add_get('/rest/things/{thing}', self._get_thing)
+        app.router.add_get('/rest/events', self._events)
+        self._runner = web.AppRunner(app, access_log=None, handler_cancellation=True)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,131 @@
+"""
+Local stand-in for Tapo smart plugs.
+
+Speaks the KLAP protocol of plugp100 (handshake1, handshake2 and encrypted requests) and answers the requests
+which are needed by the TapoPlugController (component_nego, get_device_info and set_device_info).
+"""
+import asyncio
+import base64
+import json
+import random
+import secrets
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+from aiohttp import web
+from plugp100.common.credentials import AuthCredential
+from plugp100.protocol.klap.klap_handshake_revision import klap_handshake_v1, klap_handshake_v2
+from plugp100.protocol.klap.klap_protocol import KlapChiper
+
+@dataclass()
+class FakeTapoDevice:
+    user : str
+    passwd : str
+    port : int = 0
+    klap_version : int = 2
+    latency_in_sec : float = 0
+    failure_rate : float = 0
+    device_on : bool = False
+    watt_consumption : float = 100
+    actuation_count : int = 0
+    request_count : int = 0
+    _sessions : Dict[str, Tuple[bytes, bytes]] = field(default_factory=dict)
+    _runner : Any = None
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    @property
+    def _strategy(self):
+        return klap_handshake_v2() if self.klap_version == 2 else klap_handshake_v1()
+
+    @property
+    def _auth_hash(self) -> bytes:
+        return self._strategy.generate_auth_hash(AuthCredential(self.user, self.passwd))
+
+    async def _delay_or_fail(self) -> None:
+        self.request_count += 1
+        if self.latency_in_sec > 0:
+            await asyncio.sleep(self.latency_in_sec)
+        if random.random() < self.failure_rate:
+            raise web.HTTPServiceUnavailable()
+
+    async def _passthrough(self, request : web.Request) -> web.Response:
+        # KLAP devices do not support the securePassthrough protocol
+        return web.json_response({'error_code': 1003})
+
+    async def _handshake1(self, request : web.Request) -> web.Response:
+        await self._delay_or_fail()
+        local_seed = await request.read()
+        remote_seed = secrets.token_bytes(16)
+        session_id = uuid.uuid4().hex
+        self._sessions[session_id] = (local_seed, remote_seed)
+        server_hash = self._strategy.handshake1_seed_auth_hash(local_seed, remote_seed, self._auth_hash)
+        response = web.Response(body=remote_seed + server_hash)
+        response.set_cookie('TP_SESSIONID', session_id)
+        response.set_cookie('TIMEOUT', '86400')
+        return response
+
+    async def _handshake2(self, request : web.Request) -> web.Response:
+        session_id = request.cookies.get('TP_SESSIONID', '')
+        if session_id not in self._sessions:
+            raise web.HTTPForbidden()
+        local_seed, remote_seed = self._sessions[session_id]
+        if await request.read() != self._strategy.handshake2_seed_auth_hash(local_seed, remote_seed, self._auth_hash):
+            raise web.HTTPForbidden()
+        return web.Response()
+
+    def _handle(self, method : str, params : Any) -> Dict[str, Any]:
+        if method == 'component_nego':
+            return {'error_code': 0, 'result': {'component_list': [{'id': 'device', 'ver_code': 2}, {'id': 'on_off', 'ver_code': 1}]}}
+        if method == 'get_device_info':
+            return {'error_code': 0, 'result': {
+                'device_id': f"fake-{self.port}", 'hw_id': 'fake', 'oem_id': 'fake', 'fw_ver': '1.0.0 Build 240101', 'hw_ver': '1.0',
+                'mac': '00-00-00-00-00-00', 'nickname': base64.b64encode(f"fake-{self.port}".encode()).decode(),
+                'model': 'P110', 'type': 'SMART.TAPOPLUG', 'device_on': self.device_on}}
+        if method == 'set_device_info':
+            if 'device_on' in params and params['device_on'] != self.device_on:
+                self.device_on = params['device_on']
+                self.actuation_count += 1
+            return {'error_code': 0}
+        return {'error_code': -1002}
+
+    async def _request(self, request : web.Request) -> web.Response:
+        await self._delay_or_fail()
+        session_id = request.cookies.get('TP_SESSIONID', '')
+        if session_id not in self._sessions:
+            raise web.HTTPForbidden()
+        local_seed, remote_seed = self._sessions[session_id]
+        seq = int(request.query['seq'])
+        chiper = KlapChiper(local_seed, remote_seed, self._auth_hash)
+        chiper._seq = seq
+        payload = json.loads(chiper.decrypt(await request.read()))
+        response = self._handle(payload['method'], payload.get('params'))
+        # encrypt() increments the sequence number before using it
+        chiper._seq = seq - 1
+        body, _ = chiper.encrypt(json.dumps(response))
+        return web.Response(body=body)
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post('/app', self._passthrough)
+        app.router.add_post('/app/handshake1', self._handshake1)
+        app.router.add_post('/app/handshake2', self._handshake2)
+        app.router.add_post('/app/request', self._request)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+async def start_devices(count : int, **kwargs) -> List[FakeTapoDevice]:
+    devices = [FakeTapoDevice(user=f"user_{i}", passwd=f"passwd_{i}", **kwargs) for i in range(count)]
+    for device in devices:
+        await device.start()
+    return devices
@@ -0,0 +1,208 @@
+"""
+End-to-end load harness.
+
+Starts the smartplug-energy-controller service (as a separate process), a fake openHAB REST server and fake Tapo plugs.
+A simulated smart meter drives PUT /smart-meter at the given rate while the states of the openHAB plugs are streamed
+via PUT /plug-state/{uuid}. Reports throughput, latency percentiles and actuation counts.
+
+Usage:
+    python -m benchmarks.load_harness --rate 10 --duration 60 --openhab-plugs 4 --tapo-plugs 2 --oh-latency-ms 50
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List
+
+import aiohttp
+
+from benchmarks.fake_openhab import FakeOpenhab
+from benchmarks.fake_tapo import FakeTapoDevice, start_devices
+
+@dataclass()
+class RouteStats:
+    latencies_in_ms : List[float] = field(default_factory=list)
+    sent : int = 0
+    errors : int = 0
+
+    def report(self, elapsed_in_sec : float) -> Dict[str, Any]:
+        report : Dict[str, Any] = {'sent': self.sent, 'completed': len(self.latencies_in_ms), 'errors': self.errors,
+                                   'throughput_per_sec': len(self.latencies_in_ms)/elapsed_in_sec}
+        if len(self.latencies_in_ms) > 1:
+            percentiles = statistics.quantiles(self.latencies_in_ms, n=100, method='inclusive')
+            report.update({'p50_ms': percentiles[49], 'p90_ms': percentiles[89], 'p99_ms': percentiles[98],
+                           'max_ms': max(self.latencies_in_ms)})
+        return report
+
+@dataclass()
+class OpenhabPlug:
+    uuid : str
+    switch_item : str
+    power_item : str
+    watt_consumption : float
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _write_config(path : Path, log_file : Path, oh_url : str, oh_plugs : List[OpenhabPlug], tapo_devices : Dict[str, FakeTapoDevice]) -> None:
+    lines = [f"log_file : '{log_file}'", "log_level : 30", "eval_time_in_min : 5", "default_base_load_in_watt : 250", "smartplugs:"]
+    # alternate between plug types to get a mixed priority order
+    for plug in oh_plugs:
+        lines += [f"  {plug.uuid}:", "    type : 'openhab'", "    enabled : True", f"    expected_consumption_in_watt: {int(plug.watt_consumption)}",
+                  "    consumer_efficiency: 0.3", f"    oh_thing_name : 'thing_{plug.uuid}'", f"    oh_switch_item_name : '{plug.switch_item}'",
+                  f"    oh_power_consumption_item_name : '{plug.power_item}'", "    oh_automation_enabled_switch_item_name : ''"]
+    for plug_uuid, device in tapo_devices.items():
+        lines += [f"  {plug_uuid}:", "    type : 'tapo'", "    enabled : True", f"    expected_consumption_in_watt: {int(device.watt_consumption)}",
+                  "    consumer_efficiency: 0.3", f"    id : '{device.host}'", f"    auth_user: '{device.user}'", f"    auth_passwd: '{device.passwd}'"]
+    lines += ["openhab_connection:", f"  oh_url : '{oh_url}'", "  oh_user : ''", "  oh_password: ''"]
+    path.write_text('\n'.join(lines) + '\n')
+
+async def _wait_until_ready(session : aiohttp.ClientSession, base_url : str, process : subprocess.Popen, timeout_in_sec : float = 30) -> None:
+    deadline = time.monotonic() + timeout_in_sec
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Service exited with return code {process.returncode}")
+        try:
+            async with session.get(f"{base_url}/") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise TimeoutError("Service did not start in time")
+
+class LoadHarness():
+    def __init__(self, args : argparse.Namespace) -> None:
+        self._args = args
+        self._stats : Dict[str, RouteStats] = {'PUT /smart-meter': RouteStats(), 'PUT /plug-state': RouteStats()}
+        self._tasks : List[asyncio.Task] = []
+        self._oh_plugs = [OpenhabPlug(str(uuid.uuid4()), f"switch_{i}", f"power_{i}", 100 + 50*i) for i in range(args.openhab_plugs)]
+        self._openhab = FakeOpenhab(latency_in_sec=args.oh_latency_ms/1000, failure_rate=args.oh_failure_rate)
+        self._tapo_devices : Dict[str, FakeTapoDevice] = {}
+
+    def _consumption_of_plugs(self) -> float:
+        watt = sum(plug.watt_consumption for plug in self._oh_plugs if self._openhab.item_states.get(plug.switch_item) == 'ON')
+        return watt + sum(device.watt_consumption for device in self._tapo_devices.values() if device.device_on)
+
+    def _meter_values(self, elapsed_in_sec : float) -> Dict[str, float]:
+        # one simulated "day" per harness run with random clouds
+        day_phase = min(1.0, elapsed_in_sec/self._args.duration)
+        produced = self._args.peak_production*math.sin(math.pi*day_phase)*random.uniform(0.6, 1.0)
+        consumption = self._args.base_consumption + self._consumption_of_plugs()
+        return {'watt_obtained_from_provider': max(0.0, consumption - produced), 'watt_produced': produced}
+
+    async def _request(self, session : aiohttp.ClientSession, route : str, url : str, payload : Dict[str, Any]) -> None:
+        stats = self._stats[route]
+        stats.sent += 1
+        start = time.perf_counter()
+        try:
+            async with session.put(url, json=payload) as response:
+                await response.read()
+                if response.status != 200:
+                    stats.errors += 1
+                    return
+        except aiohttp.ClientError:
+            stats.errors += 1
+            return
+        stats.latencies_in_ms.append((time.perf_counter() - start)*1000)
+
+    async def _run_periodically(self, rate_in_hz : float, duration_in_sec : float, create_request) -> None:
+        # open-loop load: requests are sent at the given rate, independent of the response time of the service
+        start = time.monotonic()
+        count = 0
+        while (elapsed := time.monotonic() - start) < duration_in_sec:
+            self._tasks.append(asyncio.create_task(create_request(elapsed)))
+            count += 1
+            await asyncio.sleep(max(0.0, start + count/rate_in_hz - time.monotonic()))
+
+    async def run(self) -> Dict[str, Any]:
+        args = self._args
+        await self._openhab.start()
+        for device in await start_devices(args.tapo_plugs, latency_in_sec=args.tapo_latency_ms/1000, failure_rate=args.tapo_failure_rate):
+            self._tapo_devices[str(uuid.uuid4())] = device
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_file = Path(tmp_dir)/'config.yml'
+            _write_config(config_file, Path(tmp_dir)/'service.log', self._openhab.url, self._oh_plugs, self._tapo_devices)
+            env = dict(os.environ, CONFIG_PATH=str(config_file), SMARTPLUG_ENERGY_CONTROLLER_PORT=str(port))
+            process = subprocess.Popen([sys.executable, '-m', 'uvicorn', '--factory', 'smartplug_energy_controller.app:create_app', '--port', str(port), '--log-level', 'warning'], env=env)
+            try:
+                connector = aiohttp.TCPConnector(limit=args.max_connections)
+                async with aiohttp.ClientSession(connector=connector) as session:
+                    await _wait_until_ready(session, base_url, process)
+
+                    async def meter_request(elapsed : float) -> None:
+                        await self._request(session, 'PUT /smart-meter', f"{base_url}/smart-meter", self._meter_values(elapsed))
+
+                    def plug_request(plug : OpenhabPlug):
+                        async def request(elapsed : float) -> None:
+                            is_on = self._openhab.item_states.get(plug.switch_item) == 'ON'
+                            payload = {'watt_consumed_at_plug': plug.watt_consumption if is_on else 0.0, 'online': True, 'is_on': is_on}
+                            await self._request(session, 'PUT /plug-state', f"{base_url}/plug-state/{plug.uuid}", payload)
+                        return request
+
+                    start = time.monotonic()
+                    load = [self._run_periodically(args.rate, args.duration, meter_request)]
+                    load += [self._run_periodically(args.plug_update_rate, args.duration, plug_request(plug)) for plug in self._oh_plugs]
+                    await asyncio.gather(*load)
+                    # wait for outstanding requests
+                    await asyncio.wait(self._tasks, timeout=args.drain_timeout)
+                    elapsed = time.monotonic() - start
+                    pending = sum(1 for task in self._tasks if not task.done())
+                    for task in self._tasks:
+                        task.cancel()
+            finally:
+                process.terminate()
+                process.wait()
+                await self._openhab.stop()
+                for device in self._tapo_devices.values():
+                    await device.stop()
+
+        return {'config': vars(args), 'elapsed_in_sec': elapsed, 'pending_after_drain': pending,
+                'routes': {route: stats.report(elapsed) for route, stats in self._stats.items()},
+                'actuations': {'openhab_posts': dict(self._openhab.post_count), 'openhab_failures': self._openhab.failure_count,
+                               'tapo': {device.host: device.actuation_count for device in self._tapo_devices.values()},
+                               'tapo_requests': sum(device.request_count for device in self._tapo_devices.values())}}
+
+def create_args_parser() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(description="End-to-end load harness for smartplug-energy-controller")
+    parser.add_argument('--rate', type=float, default=1, help="Smart meter readings per second (PUT /smart-meter)")
+    parser.add_argument('--duration', type=float, default=30, help="Duration of the load test in seconds")
+    parser.add_argument('--openhab-plugs', type=int, default=4)
+    parser.add_argument('--tapo-plugs', type=int, default=2)
+    parser.add_argument('--plug-update-rate', type=float, default=0.5, help="Updates per second and openHAB plug (PUT /plug-state)")
+    parser.add_argument('--oh-latency-ms', type=float, default=0)
+    parser.add_argument('--oh-failure-rate', type=float, default=0)
+    parser.add_argument('--tapo-latency-ms', type=float, default=0)
+    parser.add_argument('--tapo-failure-rate', type=float, default=0)
+    parser.add_argument('--peak-production', type=float, default=1500, help="Peak of the simulated production in Watt")
+    parser.add_argument('--base-consumption', type=float, default=250, help="Consumption without the plugs in Watt")
+    parser.add_argument('--max-connections', type=int, default=100)
+    parser.add_argument('--drain-timeout', type=float, default=30, help="Time in seconds to wait for outstanding requests")
+    parser.add_argument('--output', type=Path, default=None, help="Optional JSON file the report is written to")
+    return parser
+
+def main() -> None:
+    args = create_args_parser().parse_args()
+    report = asyncio.run(LoadHarness(args).run())
+    print(json.dumps(report, indent=2, default=str))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+if __name__ == '__main__':
+    main()
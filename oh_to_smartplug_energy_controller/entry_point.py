@@ -1,24 +1,131 @@
-import selectors
-import subprocess
+import asyncio
+import signal
 import sys
+import time
 from pathlib import Path
+from typing import BinaryIO, Dict, List, Sequence, Union
 
 config_file=f"{Path(__file__).parent.absolute()}/config.yml"
 
-# https://stackoverflow.com/questions/31833897/python-read-from-subprocess-stdout-and-stderr-separately-while-preserving-order
+class Supervisor():
+    """
+    Runs a child process (HABApp) and restarts it with an exponential backoff once it exits.
+    The output of the child is forwarded as it arrives (without blocking and without polling).
+    SIGINT and SIGTERM are forwarded to the child. The supervisor exits once the child has exited then.
+    The backoff is reset in case the child has been running for at least stable_time_in_sec.
+    """
+    def __init__(self, args : Sequence[str], initial_backoff_in_sec : float = 1, max_backoff_in_sec : float = 60,
+                 stable_time_in_sec : float = 60, max_restarts : Union[None, int] = None, stop_timeout_in_sec : float = 10,
+                 stdout : Union[None, BinaryIO] = None, stderr : Union[None, BinaryIO] = None) -> None:
+        self._args=list(args)
+        self._initial_backoff_in_sec=initial_backoff_in_sec
+        self._max_backoff_in_sec=max_backoff_in_sec
+        self._stable_time_in_sec=stable_time_in_sec
+        self._max_restarts=max_restarts
+        self._stop_timeout_in_sec=stop_timeout_in_sec
+        self._stdout=stdout if stdout is not None else sys.stdout.buffer
+        self._stderr=stderr if stderr is not None else sys.stderr.buffer
+        self._process : Union[None, asyncio.subprocess.Process] = None
+        self._stop_signal : Union[None, signal.Signals] = None
+        self._stop_event : Union[None, asyncio.Event] = None
+        self._kill_timer : Union[None, asyncio.TimerHandle] = None
+        self._started_at : Union[None, float] = None
+        self._starts=0
+        self._exit_codes : List[int] = []
+        self._backoffs_in_sec : List[float] = []
+
+    @property
+    def health(self) -> Dict[str, Union[None, bool, int, float, str]]:
+        running=self._process is not None and self._process.returncode is None
+        return {'running': running, 'pid': self._process.pid if running else None, # type: ignore
+                'uptime_in_sec': time.monotonic() - self._started_at if running and self._started_at is not None else None,
+                'starts': self._starts, 'restarts': max(0, self._starts - 1),
+                'last_exit_code': self._exit_codes[-1] if self._exit_codes else None,
+                'stopping': self._stop_signal.name if self._stop_signal is not None else None}
+
+    @property
+    def exit_codes(self) -> List[int]:
+        return list(self._exit_codes)
+
+    @property
+    def backoffs_in_sec(self) -> List[float]:
+        return list(self._backoffs_in_sec)
+
+    def _report(self, message : str) -> None:
+        self._stderr.write(f"[supervisor] {message} Health: {self.health}\n".encode())
+        self._stderr.flush()
+
+    def stop(self, sig : signal.Signals = signal.SIGTERM) -> None:
+        """Forwards the signal to the child. It is not restarted anymore."""
+        self._stop_signal=sig
+        if self._stop_event is not None:
+            self._stop_event.set()
+        if self._process is not None and self._process.returncode is None:
+            self._process.send_signal(sig)
+            if self._kill_timer is None:
+                self._kill_timer=asyncio.get_running_loop().call_later(self._stop_timeout_in_sec, self._kill)
+
+    def _kill(self) -> None:
+        # the child did not exit in time after forwarding the signal
+        if self._process is not None and self._process.returncode is None:
+            self._report(f"{self._args[0]} did not stop within {self._stop_timeout_in_sec} seconds. Killing it.")
+            self._process.kill()
+
+    async def _forward(self, stream : asyncio.StreamReader, target : BinaryIO) -> None:
+        # returns on EOF (the child has exited or closed the stream)
+        while data := await stream.read(64*1024):
+            target.write(data)
+            target.flush()
+
+    async def _run_child(self) -> int:
+        self._process=await asyncio.create_subprocess_exec(*self._args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        self._started_at=time.monotonic()
+        self._starts+=1
+        self._report(f"Started {self._args[0]}.")
+        if self._stop_signal is not None:
+            # stopped while starting
+            self.stop(self._stop_signal)
+        # NOTE: no polling. The supervisor sleeps until the child writes output or closes its pipes (EOF).
+        await asyncio.gather(self._forward(self._process.stdout, self._stdout), self._forward(self._process.stderr, self._stderr)) # type: ignore
+        exit_code=await self._process.wait()
+        if self._kill_timer is not None:
+            self._kill_timer.cancel()
+            self._kill_timer=None
+        return exit_code
+
+    async def run(self) -> int:
+        """Returns the exit code of the last run of the child"""
+        loop=asyncio.get_running_loop()
+        self._stop_event=asyncio.Event()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, self.stop, sig)
+        try:
+            backoff_in_sec=self._initial_backoff_in_sec
+            while True:
+                exit_code=await self._run_child()
+                self._exit_codes.append(exit_code)
+                if self._stop_signal is not None:
+                    self._report(f"{self._args[0]} stopped with exit code {exit_code}.")
+                    return exit_code
+                if self._max_restarts is not None and self._starts > self._max_restarts:
+                    self._report(f"{self._args[0]} exited with exit code {exit_code}. Giving up after {self._max_restarts} restarts.")
+                    return exit_code
+                if self._started_at is not None and time.monotonic() - self._started_at >= self._stable_time_in_sec:
+                    backoff_in_sec=self._initial_backoff_in_sec
+                self._report(f"{self._args[0]} exited with exit code {exit_code}. Restarting in {backoff_in_sec} seconds.")
+                self._backoffs_in_sec.append(backoff_in_sec)
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=backoff_in_sec)
+                    return exit_code
+                except asyncio.TimeoutError:
+                    pass
+                backoff_in_sec=min(2*backoff_in_sec, self._max_backoff_in_sec)
+        finally:
+            for sig in [signal.SIGINT, signal.SIGTERM]:
+                loop.remove_signal_handler(sig)
+
 def main() -> None:
-    p = subprocess.Popen(["habapp", "--config", config_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    sel = selectors.DefaultSelector()
-    sel.register(p.stdout, selectors.EVENT_READ) # type: ignore
-    sel.register(p.stderr, selectors.EVENT_READ) # type: ignore
-
-    while True:
-        for key, _ in sel.select():
-            data = key.fileobj.read1().decode() # type: ignore
-            if key.fileobj is p.stdout:
-                print(data, end="")
-            else:
-                print(data, end="", file=sys.stderr)
+    sys.exit(asyncio.run(Supervisor(["habapp", "--config", config_file]).run()))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
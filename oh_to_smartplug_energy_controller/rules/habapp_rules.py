@@ -5,7 +5,8 @@ from HABApp.openhab.events import ItemStateChangedEvent, ItemStateChangedEventFi
 from HABApp.openhab.items import NumberItem, SwitchItem, Thing
 from HABApp.openhab.definitions.values import OnOffValue
 
-from datetime import timedelta
+from datetime import datetime, timedelta
+from typing import Union
 
 import asyncio
 import logging
@@ -18,6 +19,7 @@ log = logging.getLogger('HABApp')
 
 from pathlib import Path
 from dotenv import load_dotenv
+from oh_to_smartplug_energy_controller.thing_health import ThingHealth
 load_dotenv(f"{Path(__file__).parent}/../.env")
 import os
 
@@ -85,6 +87,8 @@ class SmartPlugSynchronizer(HABApp.Rule):
         self._info_url=base_url+'/plug-info'
         self._state_url=base_url+'/plug-state'
         self._lock : asyncio.Lock = asyncio.Lock()
+        self._health : Union[None, ThingHealth] = None
+        self._thing_status_changed=asyncio.Event()
         self.run.soon(callback=self._init_oh_connection) # type: ignore
     
     async def _init_oh_connection(self):
@@ -94,11 +98,17 @@ class SmartPlugSynchronizer(HABApp.Rule):
             else:
                 data = await response.json()
                 self._thing=Thing.get_item(data['oh_thing_name'])
-                self._thing.listen_event(self._sync_values, EventFilter(ThingStatusInfoChangedEvent))
+                # NOTE: idle plugs might not update their items for hours. Thus the silence is only taken into account in case it is configured.
+                max_silence_in_min=float(data.get('oh_thing_max_silence_in_min', 0))
+                self._health=ThingHealth(datetime.now(), self._thing.status == 'ONLINE', 
+                                         max_silence=timedelta(minutes=max_silence_in_min) if max_silence_in_min > 0 else None)
+                self._thing.listen_event(self._thing_status_info_changed, EventFilter(ThingStatusInfoChangedEvent))
                 self._switch_item=SwitchItem.get_item(data['oh_switch_item_name'])
                 self._switch_item.listen_event(self._sync_values, ItemStateChangedEventFilter())
+                self._switch_item.listen_event(self._item_updated, ItemStateUpdatedEventFilter())
                 self._power_consumption_item=NumberItem.get_item(data['oh_power_consumption_item_name'])
                 self._power_consumption_item.listen_event(self._sync_values, ItemStateChangedEventFilter())
+                self._power_consumption_item.listen_event(self._item_updated, ItemStateUpdatedEventFilter())
                 self._automation_enabled_switch_item=None
                 if 'oh_automation_enabled_switch_item_name' in data:
                     self._automation_enabled_switch_item=SwitchItem.get_item(data['oh_automation_enabled_switch_item_name'])
@@ -117,9 +127,20 @@ class SmartPlugSynchronizer(HABApp.Rule):
             log.info(f"No oh_automation_enabled_switch_item_name for SmartPlug with UUID {self._smartplug_uuid} configured.")
         
         self.run.every(start_time=timedelta(seconds=1), interval=timedelta(minutes=20), callback=self._check_state) # type: ignore
-        self.run.every(start_time=timedelta(seconds=1), interval=timedelta(minutes=21), callback=self._check_thing) # type: ignore
+        # the thing is only restarted in case it is stale (see ThingHealth)
+        self.run.every(start_time=timedelta(minutes=1), interval=timedelta(minutes=1), callback=self._check_thing) # type: ignore
         log.info(f"SmartPlug with UUID {self._smartplug_uuid} successfully initialized.")
 
+    async def _item_updated(self, event):
+        if self._health is not None:
+            self._health.updated(datetime.now())
+
+    async def _thing_status_info_changed(self, event):
+        if self._health is not None:
+            self._health.status_changed(datetime.now(), self._thing.status == 'ONLINE')
+        self._thing_status_changed.set()
+        await self._sync_values(event)
+
     async def _sync_values(self, event):
         async with self._lock:
             power_consumption=self._power_consumption_item.get_value()
@@ -160,20 +181,43 @@ class SmartPlugSynchronizer(HABApp.Rule):
         def _is_in_state() -> bool:
             return self._thing.status == 'ONLINE' if enable else self._thing.status != 'ONLINE'
         
+        self._thing_status_changed.clear()
         self.run.soon(lambda:self._thing.set_enabled(enable)) # type: ignore
-        retry_count=0
-        while not _is_in_state() and retry_count < 10:
-            await asyncio.sleep(1)
-            retry_count+=1
+        # wait for the status change of the thing (no polling)
+        try:
+            async with asyncio.timeout(10):
+                while not _is_in_state():
+                    await self._thing_status_changed.wait()
+                    self._thing_status_changed.clear()
+        except TimeoutError:
+            pass
         return _is_in_state()
 
     async def _check_thing(self):
-        async with self._lock:
-            # turn thing off and on again
-            if not (await self._check_thing_state_change(False)):
-                log.error(f"Failed to turn off thing {self._thing.name}")
-            elif not (await self._check_thing_state_change(True)):
-                log.error(f"Failed to turn on thing {self._thing.name}")
+        if self._health is None:
+            return
+        now=datetime.now()
+        # NOTE: the status is polled as well. A missed status event does not lead to a restart (or keep a stale thing alive).
+        self._health.status_changed(now, self._thing.status == 'ONLINE')
+        avoided=self._health.counters['restarts_avoided']
+        restart=self._health.check(now)
+        if self._health.counters['restarts_avoided'] > avoided:
+            log.info(f"Health of thing {self._thing.name}: {self._health.counters}")
+        if not restart:
+            return
+        log.warning(f"Thing {self._thing.name} is stale. Status {self._thing.status} since {self._health.offline_since}. "
+                    f"Last update of its items at {self._health.last_update} (expected cadence: {self._health.cadence}). Restarting it.")
+        # NOTE: the lock is not held during the restart. The values are synced by the status change of the thing.
+        # turn thing off and on again
+        success=False
+        if not (await self._check_thing_state_change(False)):
+            log.error(f"Failed to turn off thing {self._thing.name}")
+        elif not (await self._check_thing_state_change(True)):
+            log.error(f"Failed to turn on thing {self._thing.name}")
+        else:
+            success=True
+        self._health.restarted(datetime.now(), success)
+        log.info(f"Health of thing {self._thing.name}: {self._health.counters}")
 
 if 'openhab_plug_ids' in os.environ:
     for plug_id in os.environ['openhab_plug_ids'].split(','):
@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+from typing import Dict, Union
+
+class ThingHealth():
+    """
+    Staleness of an openHAB thing (e.g. a smart plug) based on its status.
+    The thing is stale in case it is not ONLINE for longer than min_stale_time.
+    NOTE: many plugs only report their power on change. An idle plug does not update its items at all.
+    Thus the time since the last update of its items is only taken into account in case max_silence is given.
+    The thing is stale then as well in case no update arrived within max_silence (but at least stale_factor times the expected cadence).
+    The expected cadence is the exponentially weighted mean of the intervals between two updates.
+    A stale thing is restarted with an exponential backoff. The backoff is reset once the thing is ONLINE (resp. delivers updates) again.
+    """
+    def __init__(self, now : datetime, online : bool = True, min_stale_time : timedelta = timedelta(minutes=5),
+                 max_silence : Union[None, timedelta] = None, stale_factor : float = 3,
+                 initial_backoff : timedelta = timedelta(minutes=5), max_backoff : timedelta = timedelta(hours=6),
+                 smoothing : float = 0.2, legacy_restart_interval : timedelta = timedelta(minutes=21)) -> None:
+        self._min_stale_time=min_stale_time
+        self._max_silence=max_silence
+        self._stale_factor=stale_factor
+        self._initial_backoff=initial_backoff
+        self._max_backoff=max_backoff
+        self._smoothing=smoothing
+        self._offline_since : Union[None, datetime] = None if online else now
+        self._last_update=now
+        self._cadence : Union[None, timedelta] = None
+        self._backoff=initial_backoff
+        self._next_restart=now
+        # restarts done before the thing was ONLINE resp. delivered updates again
+        self._pending_restarts=0
+        # the things used to be restarted periodically. A period without restart counts as avoided restart.
+        self._legacy_restart_interval=legacy_restart_interval
+        self._period_end=now + legacy_restart_interval
+        self._restarted_in_period=False
+        self._counters : Dict[str, int] = {'updates': 0, 'restarts': 0, 'failed_restarts': 0, 'restarts_avoided': 0}
+
+    @property
+    def last_update(self) -> datetime:
+        return self._last_update
+
+    @property
+    def offline_since(self) -> Union[None, datetime]:
+        return self._offline_since
+
+    @property
+    def cadence(self) -> Union[None, timedelta]:
+        return self._cadence
+
+    @property
+    def counters(self) -> Dict[str, int]:
+        return dict(self._counters)
+
+    def silence_time(self) -> Union[None, timedelta]:
+        """Time without updates after which the thing is stale. None in case the updates are not taken into account."""
+        if self._max_silence is None:
+            return None
+        if self._cadence is None:
+            return self._max_silence
+        return max(self._max_silence, self._cadence*self._stale_factor)
+
+    def _recovered(self) -> None:
+        if self._pending_restarts > 0:
+            self._pending_restarts=0
+            self._backoff=self._initial_backoff
+
+    def updated(self, now : datetime) -> None:
+        """Has to be called on each update of an item of the thing"""
+        self._counters['updates']+=1
+        interval=now - self._last_update
+        silence_time=self.silence_time()
+        # NOTE: intervals of stale (or restarted) things are not part of the cadence
+        if self._pending_restarts == 0 and (silence_time is None or interval <= silence_time):
+            self._cadence=interval if self._cadence is None else self._cadence + self._smoothing*(interval - self._cadence)
+        self._last_update=now
+        self._recovered()
+
+    def status_changed(self, now : datetime, online : bool) -> None:
+        """Has to be called on each change of the status of the thing. Calling it with an unchanged status (e.g. polled) is fine."""
+        if online:
+            self._offline_since=None
+            # NOTE: with max_silence given, the thing has to deliver updates again as well (see updated)
+            if self._max_silence is None:
+                self._recovered()
+        elif self._offline_since is None:
+            self._offline_since=now
+
+    def is_stale(self, now : datetime) -> bool:
+        if self._offline_since is not None and now - self._offline_since > self._min_stale_time:
+            return True
+        silence_time=self.silence_time()
+        return silence_time is not None and now - self._last_update > silence_time
+
+    def check(self, now : datetime) -> bool:
+        """Whether the thing should be restarted now. Has to be called periodically (more often than legacy_restart_interval)."""
+        while now >= self._period_end:
+            if not self._restarted_in_period:
+                self._counters['restarts_avoided']+=1
+            self._restarted_in_period=False
+            self._period_end+=self._legacy_restart_interval
+        return self.is_stale(now) and now >= self._next_restart
+
+    def restarted(self, now : datetime, success : bool) -> None:
+        self._counters['restarts' if success else 'failed_restarts']+=1
+        self._restarted_in_period=True
+        self._pending_restarts+=1
+        self._next_restart=now + self._backoff
+        self._backoff=min(2*self._backoff, self._max_backoff)
@@ -1,8 +1,10 @@
+import atexit
 import logging
+from logging.handlers import QueueListener, RotatingFileHandler
 from typing import Union
 from pathlib import Path
 from smartplug_energy_controller.config import ConfigParser, OpenHabConnectionConfig
-from smartplug_energy_controller.utils import OpenhabConnectionProtocol, OpenhabConnection
+from smartplug_energy_controller.utils import OpenhabConnectionProtocol, OpenhabConnection, DroppingQueueHandler, JsonFormatter
 
 try:
     import importlib.metadata
@@ -11,14 +13,26 @@ except:
     __version__ = 'development'
 
 _logger : Union[logging.Logger, None] = None
-def init_logger(file : Union[Path, None], level) -> None:
-    global _logger
+_log_listener : Union[QueueListener, None] = None
+def init_logger(file : Union[Path, None], level, max_bytes : int = 0, backup_count : int = 0, json_format : bool = False, 
+                queue_size : int = 10000) -> None:
+    """
+    The records are written by a separate thread (QueueListener). Thus a slow disk does not block the event loop.
+    The log file is rotated once it reaches max_bytes (0 disables the rotation).
+    """
+    global _logger, _log_listener
     if _logger is None:
         _logger = logging.getLogger('smartplug-energy-controller')
-        log_handler : Union[logging.FileHandler, logging.StreamHandler] = logging.FileHandler(file) if file else logging.StreamHandler() 
-        formatter = logging.Formatter("%(levelname)s: %(asctime)s: %(message)s")
+        log_handler : Union[logging.FileHandler, logging.StreamHandler] = \
+            RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backup_count) if file else logging.StreamHandler() 
+        formatter = JsonFormatter() if json_format else logging.Formatter("%(levelname)s: %(asctime)s: %(message)s")
         log_handler.setFormatter(formatter)
-        _logger.addHandler(log_handler)
+        queue_handler = DroppingQueueHandler(queue_size)
+        _log_listener = QueueListener(queue_handler.queue, log_handler)
+        _log_listener.start()
+        # NOTE: writes the remaining records on exit
+        atexit.register(_log_listener.stop)
+        _logger.addHandler(queue_handler)
         _logger.setLevel(logging.INFO)
         _logger.info(f"Starting smartplug-energy-controller version {__version__}")
         _logger.setLevel(level)
@@ -39,5 +53,6 @@ def get_oh_connection() -> Union[OpenhabConnectionProtocol, None]:
     return _oh_connection
 
 def init(cfg_parser : ConfigParser) -> None:
-    init_logger(cfg_parser.general.log_file, cfg_parser.general.log_level)
+    init_logger(cfg_parser.general.log_file, cfg_parser.general.log_level, cfg_parser.general.log_max_bytes, 
+                cfg_parser.general.log_backup_count, cfg_parser.general.log_json, cfg_parser.general.log_queue_size)
     init_oh_connection(cfg_parser.oh_connection)
\ No newline at end of file
@@ -1,45 +1,99 @@
-import uvicorn
+"""
+FastAPI app of the service. Use create_app(settings) to create it. Importing this module has no side effects.
+"""
+import os
+import tempfile
 
 from pathlib import Path
 root_path = str( Path(__file__).parent.absolute() )
 
-from fastapi import FastAPI, Request, HTTPException
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+from fastapi import FastAPI, APIRouter, Depends, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
-from typing import Union, cast
+from typing import Callable, Union, cast
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-from datetime import datetime
+from datetime import datetime, timedelta
+from dataclasses import asdict
 
 from smartplug_energy_controller import init, get_logger
 from smartplug_energy_controller.plug_controller import *
-from smartplug_energy_controller.plug_manager import PlugManager
+from smartplug_energy_controller.plug_manager import PlugManager, PendingLimitExceeded
 from smartplug_energy_controller.config import ConfigParser
+from smartplug_energy_controller.sites import Sites
+from smartplug_energy_controller.utils import Profiler, MonotonicClock, Scheduler, ClientSessionPool, versioned_response
 
 class Settings(BaseSettings):
     config_path : Path
     smartplug_energy_controller_port : int
-
-settings = Settings() # type: ignore
-cfg_parser = ConfigParser(settings.config_path, Path(f"{root_path}/../oh_to_smartplug_energy_controller/config.yml"))
-init(cfg_parser)
-manager=PlugManager.create(get_logger(), cfg_parser)
-app = FastAPI()
-
-async def set_base_load():
-    await manager.set_base_load()
-# Set up the scheduler
-scheduler = BackgroundScheduler()
-trigger = IntervalTrigger(hours=1)
-scheduler.add_job(set_base_load, trigger)
-scheduler.start()
-
-# Ensure the scheduler shuts down properly on application exit.
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    yield
-    scheduler.shutdown()
+    # Number of worker processes. With more than one worker, a single owner holds the state (see workers.py)
+    smartplug_energy_controller_workers : int = 1
+    # optional. Directory with one config file per site (<site>.yml). Enables the routes /sites/{site}/...
+    sites_config_dir : Union[None, Path] = None
+
+def create_app(settings : Union[None, Settings] = None) -> FastAPI:
+    """
+    Parses the config (and forwards it to HABApp), creates the plug controllers and the app. 
+    Settings are read from the environment in case none are given (e.g. uvicorn --factory).
+    The state is available via app.state (cfg_parser, manager, sites, scheduler, event_stream, ...).
+    """
+    settings = settings if settings is not None else Settings() # type: ignore
+    cfg_parser = ConfigParser(settings.config_path, Path(f"{root_path}/../oh_to_smartplug_energy_controller/config.yml"))
+    init(cfg_parser)
+    clock=MonotonicClock()
+    manager=PlugManager.create(get_logger(), cfg_parser, clock)
+    # http connection pool shared by the openHAB connections of all sites
+    session_pool = ClientSessionPool()
+    sites = Sites(get_logger(), clock, session_pool)
+    if settings.sites_config_dir is not None:
+        sites.load(settings.sites_config_dir)
+    # optional. Receive the events of openHAB directly instead of via the HABApp rules
+    event_stream = None
+    if cfg_parser.oh_connection is not None and cfg_parser.oh_connection.oh_event_stream:
+        from smartplug_energy_controller.openhab_events import OpenHabEventStream
+        event_stream=OpenHabEventStream(get_logger(), cfg_parser.oh_connection, manager, session_pool)
+
+    async def set_base_load():
+        await manager.set_base_load()
+        await sites.set_base_load()
+    # Set up the scheduler. It is started together with the event loop of the app.
+    scheduler = Scheduler(get_logger(), clock)
+    scheduler.add_job(set_base_load, timedelta(hours=1))
+
+    async def resync_openhab_plugs():
+        await manager.resync_openhab_plugs()
+        await sites.resync_openhab_plugs()
+    if cfg_parser.general.openhab_resync_interval_in_sec > 0:
+        scheduler.add_job(resync_openhab_plugs, timedelta(seconds=cfg_parser.general.openhab_resync_interval_in_sec))
+
+    # Ensure the scheduler shuts down properly on application exit.
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        scheduler.start()
+        if event_stream is not None:
+            event_stream.start()
+        yield
+        if event_stream is not None:
+            await event_stream.stop()
+        scheduler.shutdown()
+        await manager.close()
+        await sites.close()
+        await session_pool.close()
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.settings=settings
+    app.state.cfg_parser=cfg_parser
+    app.state.manager=manager
+    app.state.sites=sites
+    app.state.session_pool=session_pool
+    app.state.scheduler=scheduler
+    app.state.event_stream=event_stream
+    app.state.profiler=Profiler()
+    app.include_router(_router)
+    app.include_router(_sites_router)
+    app.include_router(_create_manager_router(_get_manager))
+    app.include_router(_create_manager_router(_get_site_manager), prefix="/sites/{site}")
+    return app
 
 class PlugValues(BaseModel):
     watt_consumed_at_plug: float
@@ -51,43 +105,124 @@ class SmartMeterValues(BaseModel):
     watt_produced: Union[None, float] = None
     timestamp : Union[None, datetime] = None
 
-@app.get("/")
-async def root(request: Request):
-    return {"message": f"Hallo from smartplug-energy-controller. It is {datetime.now()}"}
+def _create_manager_router(get_manager : Callable[..., PlugManager]) -> APIRouter:
+    router = APIRouter()
+
+    @router.get("/plug-info/{uuid}")
+    async def plug_info(uuid: str, manager: PlugManager = Depends(get_manager)):
+        return manager.plug(uuid).info
+
+    @router.get("/plug-state/{uuid}")
+    async def read_plug(uuid: str, request: Request, manager: PlugManager = Depends(get_manager)):
+        etag, state = await manager.plug(uuid).versioned_state()
+        return versioned_response(request, etag, state)
+
+    @router.put("/plug-state/{uuid}/enable")
+    async def enable_plug(uuid: str, manager: PlugManager = Depends(get_manager)):
+        await (manager.plug(uuid).set_enabled(True))
+
+    @router.put("/plug-state/{uuid}/disable")
+    async def disable_plug(uuid: str, manager: PlugManager = Depends(get_manager)):
+        await (manager.plug(uuid).set_enabled(False))
 
-@app.get("/plug-info/{uuid}")
-async def plug_info(uuid: str):
-    return manager.plug(uuid).info
+    @router.put("/plug-state/{uuid}")
+    async def update_plug(uuid: str, plug_values: PlugValues, manager: PlugManager = Depends(get_manager)):
+        if not isinstance(manager.plug(uuid), OpenHabPlugController):
+            raise HTTPException(status_code=501, detail=f"Plug with uuid {uuid} is not an OpenHabPlugController. Only OpenHabPlugController can be updated.")
+        openhab_plug_controller=cast(OpenHabPlugController, manager.plug(uuid))
+        await openhab_plug_controller.update_values(plug_values.watt_consumed_at_plug, plug_values.online, plug_values.is_on)
 
-@app.get("/plug-state/{uuid}")
-async def read_plug(uuid: str):
-    return await manager.plug(uuid).state
+    @router.get("/smart-meter")
+    async def smart_meter_get(request: Request, manager: PlugManager = Depends(get_manager)):
+        snapshot = manager.snapshot
+        return versioned_response(request, snapshot.etag(), dict(snapshot.state))
 
-@app.put("/plug-state/{uuid}/enable")
-async def enable_plug(uuid: str):
-    await (manager.plug(uuid).set_enabled(True))
+    @router.put("/smart-meter")
+    async def smart_meter_put(smart_meter_values: SmartMeterValues, manager: PlugManager = Depends(get_manager)):
+        try:
+            await manager.ingest_smart_meter_values(smart_meter_values.watt_obtained_from_provider, smart_meter_values.watt_produced, smart_meter_values.timestamp)
+        except PendingLimitExceeded as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={'Retry-After': '1'})
 
-@app.put("/plug-state/{uuid}/disable")
-async def disable_plug(uuid: str):
-    await (manager.plug(uuid).set_enabled(False))
+    @router.get("/debug/decisions")
+    async def debug_decisions(manager: PlugManager = Depends(get_manager)):
+        return [asdict(trace) for trace in manager.decisions]
 
-@app.put("/plug-state/{uuid}")
-async def update_plug(uuid: str, plug_values: PlugValues):
-    if not isinstance(manager.plug(uuid), OpenHabPlugController):
-        raise HTTPException(status_code=501, detail=f"Plug with uuid {uuid} is not an OpenHabPlugController. Only OpenHabPlugController can be updated.")
-    openhab_plug_controller=cast(OpenHabPlugController, manager.plug(uuid))
-    await openhab_plug_controller.update_values(plug_values.watt_consumed_at_plug, plug_values.online, plug_values.is_on)
+    @router.get("/debug/ingestion")
+    async def debug_ingestion(manager: PlugManager = Depends(get_manager)):
+        return manager.ingestion_metrics
 
-@app.get("/smart-meter")
-async def smart_meter_get():
-    return await manager.state
+    @router.get("/debug/actuations")
+    async def debug_actuations(manager: PlugManager = Depends(get_manager)):
+        return {uuid: manager.plug(uuid).actuation_metrics for uuid in manager.plug_uuids}
+
+    return router
+
+def _get_manager(request: Request) -> PlugManager:
+    return request.app.state.manager
+
+def _get_site_manager(site: str, request: Request) -> PlugManager:
+    sites : Sites = request.app.state.sites
+    if site not in sites:
+        raise HTTPException(status_code=404, detail=f"Unknown site {site}")
+    return sites[site].manager
+
+# routes which do not depend on the PlugManager(s). Used by the workers of the multi-worker mode as well (needs app.state.profiler).
+_router = APIRouter()
+
+@_router.get("/")
+async def root(request: Request):
+    return {"message": f"Hallo from smartplug-energy-controller. It is {datetime.now()}"}
 
-@app.put("/smart-meter")
-async def smart_meter_put(smart_meter_values: SmartMeterValues):
-    await manager.add_smart_meter_values(smart_meter_values.watt_obtained_from_provider, smart_meter_values.watt_produced, smart_meter_values.timestamp)
+@_router.put("/debug/profiling/start")
+async def start_profiling(request: Request, backend: str = 'cprofile'):
+    try:
+        request.app.state.profiler.start(backend)
+    except ImportError as e:
+        raise HTTPException(status_code=501, detail=f"Profiler backend {backend} is not installed. {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@_router.put("/debug/profiling/stop", response_class=PlainTextResponse)
+async def stop_profiling(request: Request):
+    try:
+        return request.app.state.profiler.stop()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+_sites_router = APIRouter()
+
+@_sites_router.get("/sites")
+async def read_sites(request: Request):
+    sites : Sites = request.app.state.sites
+    return {name: {'plugs': len(sites[name].manager.plugs()), 'memory_in_bytes': sites.memory_in_bytes(name)} for name in sites.names}
 
 def serve():
-    uvicorn.run(app, host="0.0.0.0", port=settings.smartplug_energy_controller_port)
+    import uvicorn
+    settings = Settings() # type: ignore
+    if settings.smartplug_energy_controller_workers > 1 and settings.sites_config_dir is not None:
+        # NOTE: the owner of the multi-worker mode holds a single PlugManager. The routes /sites/{site}/... are not available.
+        raise ValueError("Multi-site mode (sites_config_dir) is not supported with more than one worker")
+    app = create_app(settings)
+    if settings.smartplug_energy_controller_workers <= 1:
+        uvicorn.run(app, host="0.0.0.0", port=settings.smartplug_energy_controller_port)
+        return
+    from smartplug_energy_controller.workers import Owner
+    # multi-worker mode: the owner runs within this process. Socket and snapshot are located in shared memory (if available)
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as tmp_dir:
+        socket_path=Path(tmp_dir)/'owner.sock'
+        snapshot_file=Path(tmp_dir)/'snapshot'
+        owner=Owner(get_logger(), app.state.manager, app.state.scheduler, socket_path, snapshot_file, event_stream=app.state.event_stream)
+        owner.start()
+        os.environ['SMARTPLUG_ENERGY_CONTROLLER_OWNER_SOCKET']=str(socket_path)
+        os.environ['SMARTPLUG_ENERGY_CONTROLLER_SNAPSHOT_FILE']=str(snapshot_file)
+        try:
+            uvicorn.run("smartplug_energy_controller.workers:create_app_from_env", factory=True, host="0.0.0.0", 
+                        port=settings.smartplug_energy_controller_port, workers=settings.smartplug_energy_controller_workers)
+        finally:
+            owner.stop()
 
 if __name__ == "__main__":
-    serve()
\ No newline at end of file
+    serve()
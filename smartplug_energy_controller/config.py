@@ -1,7 +1,8 @@
 from ruamel.yaml import YAML
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Union, Dict, List
+from datetime import datetime, timedelta
+from typing import Union, Dict, List, Tuple
 from functools import cached_property
 
 @dataclass(frozen=True)
@@ -14,6 +15,29 @@ class SmartPlugConfig():
     # 0 means that the plug should be turned on only when no additional energy has to be obtained from the provider. 
     # 1 means that the plug should be turned on when the additional obtained energy from the provider is equal to the expected consumption.
     consumer_efficiency : float = 0
+    # Timeout of each request to the plug (e.g. turning it on) during an evaluation. The plug is skipped in case it does not answer in time. 0 means no limit.
+    io_timeout_in_sec : float = field(default=0, kw_only=True)
+    # The plug stays on (off) for at least this time after being turned on (off) by this service. 0 means no limit.
+    min_on_time_in_sec : float = field(default=0, kw_only=True)
+    min_off_time_in_sec : float = field(default=0, kw_only=True)
+    # Maximum number of times the plug is turned on or off by this service within one hour. 0 means no limit.
+    max_switches_per_hour : int = field(default=0, kw_only=True)
+    # Deferrable load: the plug has to be on for this time each day before the deadline (HH:MM). 0 means the plug is not deferrable.
+    # The plug is turned on within the slots with the highest expected surplus instead of the usual on/off logic.
+    runtime_in_min : float = field(default=0, kw_only=True)
+    deadline : str = field(default='', kw_only=True)
+
+    def __post_init__(self) -> None:
+        # NOTE: a deferrable load is planned within the slots (15 minutes) of one day
+        if self.runtime_in_min > 24*60 - 15:
+            raise ValueError(f"A runtime of {self.runtime_in_min} minutes does not fit into one day (at most {24*60 - 15} minutes)")
+        if self.runtime_in_min > 0:
+            if not self.deadline:
+                raise ValueError(f"A deadline (HH:MM) is required for a runtime of {self.runtime_in_min} minutes")
+            try:
+                datetime.strptime(self.deadline, '%H:%M')
+            except ValueError:
+                raise ValueError(f"Invalid deadline: {self.deadline}. Expected format: HH:MM")
 
 @dataclass(frozen=True)
 class TapoSmartPlugConfig(SmartPlugConfig):
@@ -28,12 +52,22 @@ class OpenHabSmartPlugConfig(SmartPlugConfig):
     oh_power_consumption_item_name : str = ''
     # optional. can be used to enable/disable a smartplug in terms of usage from this service. When disabled, the plug can be controlled manually.
     oh_automation_enabled_switch_item_name : str = '' 
+    # A command (ON/OFF) is not sent again until openHAB reports the new state or this time has passed.
+    confirmation_window_in_sec : float = field(default=30, kw_only=True)
+    # The thing is restarted by the HABApp rules in case its items are not updated within this time. 0 means only the status of the thing is checked.
+    # NOTE: many plugs only report their power on change. Choose a time much longer than the usual idle time of the plug.
+    oh_thing_max_silence_in_min : float = field(default=0, kw_only=True)
 
 @dataclass(frozen=True)
 class OpenHabConnectionConfig():
     oh_url : str = ''
     oh_user : str = ''
     oh_password : str = ''
+    # openHAB number items of the smart meter (used by the HABApp rules resp. the event stream)
+    oh_watt_obtained_from_provider_item : str = ''
+    oh_watt_produced_item : str = ''
+    # Subscribe to the event stream of openHAB (/rest/events) within this service instead of forwarding the events via HABApp
+    oh_event_stream : bool = False
 
 @dataclass(frozen=True)
 class GeneralConfig():
@@ -44,9 +78,46 @@ class GeneralConfig():
     eval_time_in_min : int = 5
     # initial value for the base load. Will be recalculated during the night
     default_base_load_in_watt : int = 250
+    # Number of evaluations that are kept in memory for debugging purposes (see GET /debug/decisions)
+    decision_trace_size : int = 100
+    # Only evaluate the newest smart meter values in case they are added faster than they can be evaluated
+    coalesce_smart_meter_values : bool = False
+    # Further smart meter values are rejected in case this amount is waiting to be evaluated
+    max_pending_smart_meter_values : int = 100
+    # Time budget of one evaluation (checking and switching the plugs). Plugs not checked within this time are skipped. 0 means no limit.
+    evaluation_deadline_in_sec : float = 0
+    # Turn on several plugs within one evaluation in case the surplus is sufficient (plugs are considered in the given order)
+    allocate_surplus : bool = False
+    # Plugs are turned on/off based on the values expected in this amount of seconds (trend of the latest values). 0 disables the forecast.
+    forecast_horizon_in_sec : float = 0
+    # Limits of the evaluated time frame. Within these limits the time frame grows with the volatility of the obtained watt. 0 disables the adaption.
+    min_eval_time_in_min : float = 0
+    max_eval_time_in_min : float = 0
+    # Standard deviation of the obtained watt at which the time frame reaches max_eval_time_in_min
+    volatility_reference_in_watt : float = 200
+    # Interval of reading the states of all openHAB plugs at once. Missed updates of openHAB are fixed then. 0 disables the resync.
+    openhab_resync_interval_in_sec : float = 300
+    # The log file is rotated once it reaches this size. 0 disables the rotation.
+    log_max_bytes : int = 10*1024*1024
+    # Number of rotated log files that are kept
+    log_backup_count : int = 3
+    # Write one json object per log record instead of plain text
+    log_json : bool = False
+    # Log records are written by a separate thread. Further records are dropped in case this amount is waiting to be written.
+    log_queue_size : int = 10000
+
+    @property
+    def forecast_horizon(self) -> Union[None, timedelta]:
+        return timedelta(seconds=self.forecast_horizon_in_sec) if self.forecast_horizon_in_sec > 0 else None
+
+    @property
+    def eval_time_limits(self) -> Union[None, Tuple[timedelta, timedelta]]:
+        if self.min_eval_time_in_min <= 0 or self.max_eval_time_in_min <= self.min_eval_time_in_min:
+            return None
+        return timedelta(minutes=self.min_eval_time_in_min), timedelta(minutes=self.max_eval_time_in_min)
 
 class ConfigParser():
-    def __init__(self, file : Path, habapp_config : Path) -> None:
+    def __init__(self, file : Path, habapp_config : Union[None, Path]) -> None:
         self._smart_plugs : Dict[str, SmartPlugConfig] = {}
         self._oh_connection : Union[None, OpenHabConnectionConfig] = None
         yaml=YAML(typ='safe', pure=True)
@@ -55,8 +126,12 @@ class ConfigParser():
         if 'openhab_connection' in data:
             self._oh_connection=OpenHabConnectionConfig(data['openhab_connection']['oh_url'], 
                                                         data['openhab_connection']['oh_user'], 
-                                                        data['openhab_connection']['oh_password'])
-            self._transfer_to_habapp(data['openhab_connection'], habapp_config)
+                                                        data['openhab_connection']['oh_password'], 
+                                                        data['openhab_connection'].get('oh_watt_obtained_from_provider_item', ''), 
+                                                        data['openhab_connection'].get('oh_watt_produced_item', ''), 
+                                                        data['openhab_connection'].get('oh_event_stream', OpenHabConnectionConfig.oh_event_stream))
+            if habapp_config is not None:
+                self._transfer_to_habapp(data['openhab_connection'], habapp_config)
 
     @property
     def general(self) -> GeneralConfig:
@@ -73,19 +148,40 @@ class ConfigParser():
     def plug(self, plug_uuid : str) -> SmartPlugConfig:
         return self._smart_plugs[plug_uuid]
 
+    @staticmethod
+    def _read_optional_plug_values(plug_cfg : dict) -> dict:
+        keys=['io_timeout_in_sec', 'min_on_time_in_sec', 'min_off_time_in_sec', 'max_switches_per_hour', 'runtime_in_min', 'deadline']
+        return {key: plug_cfg.get(key, getattr(SmartPlugConfig, key)) for key in keys}
+
     def _read_from_dict(self, data : dict):
-        self._general=GeneralConfig(Path(data['log_file']), data['log_level'], data['eval_time_in_min'], data['default_base_load_in_watt'])
+        self._general=GeneralConfig(Path(data['log_file']), data['log_level'], data['eval_time_in_min'], data['default_base_load_in_watt'], 
+                                    data.get('decision_trace_size', GeneralConfig.decision_trace_size),
+                                    data.get('coalesce_smart_meter_values', GeneralConfig.coalesce_smart_meter_values),
+                                    data.get('max_pending_smart_meter_values', GeneralConfig.max_pending_smart_meter_values),
+                                    data.get('evaluation_deadline_in_sec', GeneralConfig.evaluation_deadline_in_sec),
+                                    data.get('allocate_surplus', GeneralConfig.allocate_surplus),
+                                    data.get('forecast_horizon_in_sec', GeneralConfig.forecast_horizon_in_sec),
+                                    data.get('min_eval_time_in_min', GeneralConfig.min_eval_time_in_min),
+                                    data.get('max_eval_time_in_min', GeneralConfig.max_eval_time_in_min),
+                                    data.get('volatility_reference_in_watt', GeneralConfig.volatility_reference_in_watt),
+                                    data.get('openhab_resync_interval_in_sec', GeneralConfig.openhab_resync_interval_in_sec),
+                                    data.get('log_max_bytes', GeneralConfig.log_max_bytes),
+                                    data.get('log_backup_count', GeneralConfig.log_backup_count),
+                                    data.get('log_json', GeneralConfig.log_json),
+                                    data.get('log_queue_size', GeneralConfig.log_queue_size))
         for plug_uuid in data['smartplugs']:
             plug_cfg=data['smartplugs'][plug_uuid]
             if plug_cfg['type'] == 'tapo':
                 self._smart_plugs[plug_uuid]=TapoSmartPlugConfig(
                 plug_cfg['type'], plug_cfg['enabled'], plug_cfg['expected_consumption_in_watt'], plug_cfg['consumer_efficiency'], 
-                plug_cfg['id'], plug_cfg['auth_user'], plug_cfg['auth_passwd'])
+                plug_cfg['id'], plug_cfg['auth_user'], plug_cfg['auth_passwd'], **self._read_optional_plug_values(plug_cfg))
             elif plug_cfg['type'] == 'openhab':
                 self._smart_plugs[plug_uuid]=OpenHabSmartPlugConfig(
                 plug_cfg['type'], plug_cfg['enabled'], plug_cfg['expected_consumption_in_watt'], plug_cfg['consumer_efficiency'], 
                 plug_cfg['oh_thing_name'], plug_cfg['oh_switch_item_name'], plug_cfg['oh_power_consumption_item_name'], 
-                plug_cfg['oh_automation_enabled_switch_item_name'])
+                plug_cfg['oh_automation_enabled_switch_item_name'], **self._read_optional_plug_values(plug_cfg), 
+                confirmation_window_in_sec=plug_cfg.get('confirmation_window_in_sec', OpenHabSmartPlugConfig.confirmation_window_in_sec), 
+                oh_thing_max_silence_in_min=plug_cfg.get('oh_thing_max_silence_in_min', OpenHabSmartPlugConfig.oh_thing_max_silence_in_min))
             else:
                 raise ValueError(f"Unknown Plug type: {plug_cfg['type']}")
     
@@ -99,6 +195,9 @@ class ConfigParser():
         yaml.dump(habapp_config, habapp_config_path)
         # 2. write openhab item names and plugs to a .env that is later on read by the habapp rules
         with open(f"{habapp_config_path.parent}/.env", 'w') as f:
+            if data.get('oh_event_stream', False):
+                # NOTE: the events are handled by this service. The habapp rules must not forward them as well.
+                return
             if 'oh_watt_obtained_from_provider_item' in data and 'oh_watt_produced_item' in data:
                 f.write(f"oh_watt_obtained_from_provider_item={data['oh_watt_obtained_from_provider_item']}\n")
                 f.write(f"oh_watt_produced_item={data['oh_watt_produced_item']}\n")
@@ -0,0 +1,138 @@
+"""
+Scheduling of deferrable loads (e.g. a dishwasher or a trickle charger) which have to run for a given time before a daily deadline.
+
+The expected surplus of each slot of the day is learned from the smart meter values (SurplusProfile).
+Each deferrable load plans to run within the slots with the highest expected surplus before its deadline (DeferrableLoad).
+Plans are only recalculated when a new slot begins (at most one plan per slot and load, each limited to the slots of one day).
+A load is forced on as soon as the remaining time before the deadline is needed to complete its runtime.
+"""
+import heapq
+import math
+from datetime import datetime, time, timedelta
+from typing import List, Set, Tuple, Union
+
+class SurplusProfile():
+    """
+    Expected surplus (Watt) for each slot of the day. O(1) per value.
+    The mean of the values within a slot is added to the exponentially weighted average of this slot once the slot is over.
+    """
+    def __init__(self, slot : timedelta = timedelta(minutes=15), smoothing : float = 0.3) -> None:
+        assert timedelta(days=1) % slot == timedelta(0), "A day has to consist of whole slots"
+        self._slot=slot
+        self._smoothing=smoothing
+        self._expected : List[Union[None, float]] = [None]*(timedelta(days=1)//slot)
+        self._current_slot : Union[None, datetime] = None
+        self._current_sum=0.0
+        self._current_count=0
+
+    @property
+    def slot(self) -> timedelta:
+        return self._slot
+
+    def slot_start(self, timestamp : datetime) -> datetime:
+        midnight=datetime.combine(timestamp.date(), time(), timestamp.tzinfo)
+        return midnight + ((timestamp - midnight)//self._slot)*self._slot
+
+    def _index(self, slot_start : datetime) -> int:
+        return (slot_start - datetime.combine(slot_start.date(), time(), slot_start.tzinfo))//self._slot
+
+    def add(self, surplus : float, timestamp : datetime) -> None:
+        slot_start=self.slot_start(timestamp)
+        if self._current_slot is not None and slot_start != self._current_slot:
+            self._complete_current_slot()
+        self._current_slot=slot_start
+        self._current_sum+=surplus
+        self._current_count+=1
+
+    def _complete_current_slot(self) -> None:
+        assert self._current_slot is not None
+        if self._current_count > 0:
+            index=self._index(self._current_slot)
+            mean=self._current_sum/self._current_count
+            previous=self._expected[index]
+            self._expected[index]=mean if previous is None else previous + self._smoothing*(mean - previous)
+        self._current_sum=0.0
+        self._current_count=0
+
+    def expected(self, slot_start : datetime) -> float:
+        """Expected surplus of the slot. 0 in case nothing is known about this slot of the day yet."""
+        return self.expected_values(slot_start, 1)[0]
+
+    def expected_values(self, first_slot_start : datetime, count : int) -> List[float]:
+        """Expected surplus of count consecutive slots"""
+        first_index=self._index(first_slot_start)
+        expected=[self._expected[(first_index + i) % len(self._expected)] for i in range(count)]
+        return [value if value is not None else 0.0 for value in expected]
+
+class DeferrableLoad():
+    """Runtime accounting and plan of a load which has to run for runtime before the daily deadline"""
+    def __init__(self, runtime : timedelta, deadline : time, profile : SurplusProfile) -> None:
+        if runtime > timedelta(days=1) - profile.slot:
+            raise ValueError(f"The runtime of {runtime} has to fit into one day")
+        self._runtime=runtime
+        self._deadline_time=deadline
+        self._profile=profile
+        self._deadline : Union[None, datetime] = None
+        self._completed=timedelta()
+        self._on_since : Union[None, datetime] = None
+        self._planned_slots : Set[datetime] = set()
+        self._planned_for : Union[None, Tuple[datetime, datetime]] = None
+
+    @property
+    def deadline(self) -> Union[None, datetime]:
+        return self._deadline
+
+    @property
+    def planned_slots(self) -> List[datetime]:
+        return sorted(self._planned_slots)
+
+    def _next_deadline(self, timestamp : datetime) -> datetime:
+        deadline=datetime.combine(timestamp.date(), self._deadline_time, timestamp.tzinfo)
+        return deadline if deadline > timestamp else deadline + timedelta(days=1)
+
+    def remaining(self, timestamp : datetime) -> timedelta:
+        """Runtime still needed before the deadline"""
+        completed=self._completed
+        if self._on_since is not None:
+            completed+=timestamp - self._on_since
+        return max(timedelta(), self._runtime - completed)
+
+    def update(self, timestamp : datetime, is_on : bool) -> None:
+        """Has to be called with the state of the plug on every reading"""
+        if self._deadline is None or timestamp >= self._deadline:
+            # a new period begins. NOTE: a load running across the deadline counts for the new period from now on.
+            self._deadline=self._next_deadline(timestamp)
+            self._completed=timedelta()
+            self._on_since=timestamp if self._on_since is not None else None
+            self._planned_for=None
+        if is_on and self._on_since is None:
+            self._on_since=timestamp
+        elif not is_on and self._on_since is not None:
+            self._completed+=timestamp - self._on_since
+            self._on_since=None
+
+    def _plan(self, timestamp : datetime) -> None:
+        assert self._deadline is not None
+        slot=self._profile.slot
+        first_slot=self._profile.slot_start(timestamp)
+        expected=self._profile.expected_values(first_slot, math.ceil((self._deadline - first_slot)/slot))
+        needed=math.ceil(self.remaining(timestamp)/slot)
+        # highest expected surplus first. Earlier slots are preferred in case of equal surplus.
+        best=heapq.nlargest(needed, range(len(expected)), key=lambda index: (expected[index], -index))
+        self._planned_slots=set(first_slot + index*slot for index in best)
+        self._planned_for=(first_slot, self._deadline)
+
+    def should_run(self, timestamp : datetime) -> Tuple[bool, str]:
+        """Whether the load should run now and the reason ('done', 'forced', 'planned' or 'waiting'). Call update before."""
+        assert self._deadline is not None, "update has to be called first"
+        remaining=self.remaining(timestamp)
+        if remaining <= timedelta():
+            return False, 'done'
+        if self._deadline - timestamp <= remaining:
+            # no slack left
+            return True, 'forced'
+        if self._planned_for != (self._profile.slot_start(timestamp), self._deadline):
+            self._plan(timestamp)
+        if self._profile.slot_start(timestamp) in self._planned_slots:
+            return True, 'planned'
+        return False, 'waiting'
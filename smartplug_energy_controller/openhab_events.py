@@ -0,0 +1,244 @@
+"""
+In-process connector to the event stream of openHAB (server-sent events of /rest/events).
+
+Alternative to the HABApp rules of oh_to_smartplug_energy_controller: the events of the configured items are fed into the
+PlugManager directly instead of being forwarded via HABApp and a http request per event.
+The same events as in the HABApp rules are handled:
+    - the smart meter values are added on each update of the watt obtained item and each change of the watt produced item
+    - the values of an OpenHabPlugController are updated on each change of its thing status, switch item or power item
+    - the automation enabled switch item enables/disables the plug
+Only the configured items and things are subscribed (topic filter of openHAB).
+After each (re)connect the current states are read at once (see OpenhabConnection.read_states), changes missed in the meantime are applied.
+"""
+import asyncio
+import json
+from collections import Counter
+from dataclasses import dataclass
+from logging import Logger
+from typing import Dict, List, Set, Union, cast
+
+import aiohttp
+
+from smartplug_energy_controller.config import OpenHabConnectionConfig, OpenHabSmartPlugConfig
+from smartplug_energy_controller.plug_controller import OpenHabPlugController
+from smartplug_energy_controller.plug_manager import PlugManager, PendingLimitExceeded
+from smartplug_energy_controller.utils import ClientSessionPool, OpenhabConnection, parse_number_state
+
+@dataclass(frozen=True)
+class OpenHabEvent:
+    # e.g. ItemStateChangedEvent
+    type : str
+    # name of the item resp. UID of the thing
+    name : str
+    # new state of the item resp. status of the thing
+    value : Union[None, str]
+
+def parse_event(data : str) -> Union[None, OpenHabEvent]:
+    """Event of the data of a server-sent event. None in case it is no item or thing event."""
+    try:
+        event=json.loads(data)
+        topic=event['topic'].split('/')
+        payload=json.loads(event['payload'])
+        if len(topic) < 4:
+            return None
+        if topic[1] == 'items':
+            return OpenHabEvent(event['type'], topic[2], payload.get('value'))
+        if topic[1] == 'things':
+            # payload of ThingStatusInfoChangedEvent: [new status info, old status info]
+            status_info=payload[0] if isinstance(payload, list) else payload
+            return OpenHabEvent(event['type'], topic[2], status_info.get('status'))
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        pass
+    return None
+
+class OpenHabEventStream():
+    _item_changed='ItemStateChangedEvent'
+    _thing_changed='ThingStatusInfoChangedEvent'
+
+    def __init__(self, logger : Logger, oh_con_cfg : OpenHabConnectionConfig, manager : PlugManager,
+                 session_pool : Union[None, ClientSessionPool] = None, max_reconnect_delay_in_sec : float = 60) -> None:
+        self._logger=logger
+        self._oh_url=oh_con_cfg.oh_url
+        self._auth=aiohttp.BasicAuth(oh_con_cfg.oh_user, oh_con_cfg.oh_password) if oh_con_cfg.oh_user != '' else None
+        self._own_session_pool=session_pool is None
+        self._session_pool=session_pool if session_pool is not None else ClientSessionPool(limit=10)
+        self._oh_connection=OpenhabConnection(oh_con_cfg, logger, self._session_pool)
+        self._manager=manager
+        self._max_reconnect_delay_in_sec=max_reconnect_delay_in_sec
+        self._watt_obtained_item=oh_con_cfg.oh_watt_obtained_from_provider_item
+        self._watt_produced_item=oh_con_cfg.oh_watt_produced_item
+        # latest states of the subscribed items and things
+        self._item_states : Dict[str, Union[None, str]] = {}
+        self._thing_states : Dict[str, Union[None, str]] = {}
+        # plugs to be updated on a change of the item resp. thing
+        self._plugs_by_name : Dict[str, List[OpenHabPlugController]] = {}
+        self._plugs_by_automation_item : Dict[str, OpenHabPlugController] = {}
+        if self._watt_obtained_item != '' and self._watt_produced_item != '':
+            self._item_states[self._watt_obtained_item]=None
+            self._item_states[self._watt_produced_item]=None
+        for uuid in manager.plug_uuids:
+            plug=manager.plug(uuid)
+            if not isinstance(plug, OpenHabPlugController):
+                continue
+            plug_cfg=cast(OpenHabSmartPlugConfig, plug.cfg)
+            self._thing_states[plug_cfg.oh_thing_name]=None
+            for name in [plug_cfg.oh_thing_name, plug_cfg.oh_switch_item_name, plug_cfg.oh_power_consumption_item_name]:
+                self._plugs_by_name.setdefault(name, []).append(plug)
+                if name != plug_cfg.oh_thing_name:
+                    self._item_states[name]=None
+            if plug_cfg.oh_automation_enabled_switch_item_name != '':
+                self._item_states[plug_cfg.oh_automation_enabled_switch_item_name]=None
+                self._plugs_by_automation_item[plug_cfg.oh_automation_enabled_switch_item_name]=plug
+        # openHAB 4 sends an ItemStateUpdatedEvent after each update. openHAB 3 only sends the ItemStateEvent.
+        self._item_updated='ItemStateUpdatedEvent'
+        self._initialized_automation_items=False
+        self._connected=False
+        self._counters : Counter = Counter()
+        self._task : Union[None, asyncio.Task] = None
+        self._ingest_tasks : Set[asyncio.Task] = set()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    @property
+    def metrics(self) -> Dict[str, int]:
+        return {key: self._counters[key] for key in ['connects', 'events', 'ignored', 'smart_meter_values', 'plug_updates', 'errors']}
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task=asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task=None
+        for task in list(self._ingest_tasks):
+            task.cancel()
+        if self._own_session_pool:
+            await self._session_pool.close()
+
+    async def _run(self) -> None:
+        delay_in_sec=1.0
+        while True:
+            try:
+                await self._listen()
+                delay_in_sec=1.0
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self._counters['errors']+=1
+                self._logger.warning(f"Lost the event stream of openHAB: {e!r}. Reconnecting in {delay_in_sec} seconds.")
+            except Exception as e:
+                self._counters['errors']+=1
+                self._logger.exception(f"Caught Exception while reading the event stream of openHAB: {e}")
+            self._connected=False
+            await asyncio.sleep(delay_in_sec)
+            delay_in_sec=min(2*delay_in_sec, self._max_reconnect_delay_in_sec)
+
+    def _topics(self) -> str:
+        topics=[f"openhab/items/{name}/*" for name in self._item_states]
+        topics+=[f"openhab/things/{name}/statuschanged" for name in self._thing_states]
+        return ','.join(topics)
+
+    async def _listen(self) -> None:
+        session=self._session_pool.session
+        async with session.get(f"{self._oh_url}/rest/events", params={'topics': self._topics()}, auth=self._auth, ssl=False,
+                               headers={'Accept': 'text/event-stream'}, timeout=aiohttp.ClientTimeout(total=None)) as response:
+            if response.status != 200:
+                raise aiohttp.ClientError(f"Failed to subscribe to the events. Return code: {response.status}. text: {await response.text()}")
+            self._connected=True
+            self._counters['connects']+=1
+            self._logger.info("Subscribed to the event stream of openHAB")
+            # NOTE: the states are read after subscribing. Events received in the meantime are not lost.
+            await self._sync(session)
+            data : List[str] = []
+            async for line in response.content:
+                text=line.decode().rstrip('\r\n')
+                if text == '':
+                    if data:
+                        await self._handle('\n'.join(data))
+                        data=[]
+                elif text.startswith('data:'):
+                    data.append(text[6:] if text.startswith('data: ') else text[5:])
+        self._logger.warning("The event stream has been closed by openHAB")
+
+    async def _get(self, session : aiohttp.ClientSession, path : str) -> dict:
+        async with session.get(f"{self._oh_url}/rest/{path}", auth=self._auth, ssl=False) as response:
+            if response.status != 200:
+                raise aiohttp.ClientError(f"Failed to read /rest/{path}. Return code: {response.status}. text: {await response.text()}")
+            return await response.json()
+
+    async def _sync(self, session : aiohttp.ClientSession) -> None:
+        """Reads the current states of all subscribed items and things and applies them"""
+        version=str((await self._get(session, '')).get('runtimeInfo', {}).get('version', '4'))
+        self._item_updated='ItemStateEvent' if version.split('.')[0] in ['2', '3'] else 'ItemStateUpdatedEvent'
+        states=await self._oh_connection.read_states(set(self._item_states), set(self._thing_states))
+        if states is None:
+            raise aiohttp.ClientError("Failed to read the states of the items and things")
+        for name in self._item_states:
+            self._item_states[name]=states[0].get(name)
+        for name in self._thing_states:
+            self._thing_states[name]=states[1].get(name)
+        updated_plugs={id(plug): plug for plugs in self._plugs_by_name.values() for plug in plugs}
+        for plug in updated_plugs.values():
+            await self._update_plug(plug)
+        for name, plug in self._plugs_by_automation_item.items():
+            if not self._initialized_automation_items:
+                # the service holds the initial state of the automation enabled switch items (same as the HABApp rules)
+                await self._oh_connection.post_to_item(name, 'ON' if plug.enabled else 'OFF')
+            elif self._item_states[name] in ['ON', 'OFF'] and (self._item_states[name] == 'ON') != plug.enabled:
+                await plug.set_enabled(self._item_states[name] == 'ON')
+        self._initialized_automation_items=True
+
+    async def _handle(self, data : str) -> None:
+        self._counters['events']+=1
+        event=parse_event(data)
+        if event is None:
+            self._counters['ignored']+=1
+            return
+        if event.type == self._thing_changed and event.name in self._thing_states:
+            self._thing_states[event.name]=event.value
+        elif event.type in [self._item_changed, self._item_updated] and event.name in self._item_states:
+            self._item_states[event.name]=event.value
+        else:
+            self._counters['ignored']+=1
+            return
+        if (event.name == self._watt_obtained_item and event.type == self._item_updated) or \
+           (event.name == self._watt_produced_item and event.type == self._item_changed):
+            self._add_smart_meter_values()
+        if event.type != self._item_updated:
+            for plug in self._plugs_by_name.get(event.name, []):
+                await self._update_plug(plug)
+            if event.name in self._plugs_by_automation_item and event.value in ['ON', 'OFF']:
+                await self._plugs_by_automation_item[event.name].set_enabled(event.value == 'ON')
+
+    def _add_smart_meter_values(self) -> None:
+        watt_obtained=parse_number_state(self._item_states[self._watt_obtained_item])
+        if watt_obtained is None:
+            return
+        # NOTE: the evaluation may take a while (requests to the plugs). Reading the events must not wait for it.
+        task=asyncio.get_running_loop().create_task(self._ingest(watt_obtained, parse_number_state(self._item_states[self._watt_produced_item])))
+        self._ingest_tasks.add(task)
+        task.add_done_callback(self._ingest_tasks.discard)
+
+    async def _ingest(self, watt_obtained : float, watt_produced : Union[None, float]) -> None:
+        try:
+            await self._manager.ingest_smart_meter_values(watt_obtained, watt_produced)
+            self._counters['smart_meter_values']+=1
+        except PendingLimitExceeded as e:
+            self._counters['errors']+=1
+            self._logger.warning(f"Dropped smart meter values of openHAB. {e}")
+        except Exception as e:
+            self._counters['errors']+=1
+            self._logger.exception(f"Caught Exception while adding smart meter values of openHAB: {e}")
+
+    async def _update_plug(self, plug : OpenHabPlugController) -> None:
+        plug_cfg=cast(OpenHabSmartPlugConfig, plug.cfg)
+        watt_consumed=parse_number_state(self._item_states[plug_cfg.oh_power_consumption_item_name])
+        await plug.update_values(watt_consumed if watt_consumed is not None else 0.0,
+                                 self._thing_states[plug_cfg.oh_thing_name] == 'ONLINE',
+                                 self._item_states[plug_cfg.oh_switch_item_name] == 'ON')
+        self._counters['plug_updates']+=1
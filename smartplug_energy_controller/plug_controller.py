@@ -1,40 +1,76 @@
 from logging import Logger
 
 from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, timedelta
 from functools import cached_property
-from typing import Optional, Dict
+from typing import TYPE_CHECKING, Callable, Deque, List, Optional, Dict, Set, Tuple, Union, cast
 
-from plugp100.common.credentials import AuthCredential
-from plugp100.new.device_factory import connect, DeviceConnectConfiguration
-from plugp100.new.tapoplug import TapoPlug
+if TYPE_CHECKING:
+    # NOTE: plugp100 is imported on the first connect to a Tapo plug. Setups without Tapo plugs do not pay for importing it.
+    import aiohttp
+    from plugp100.new.tapoplug import TapoPlug
 
 from smartplug_energy_controller.config import *
 from smartplug_energy_controller import get_oh_connection
+from smartplug_energy_controller.utils import CircuitBreaker, Clock, MonotonicClock, OpenhabConnectionProtocol, StateSnapshot, parse_number_state
 
-import aiohttp
 import asyncio
 
 class PlugController(ABC):
-    def __init__(self, logger : Logger, plug_cfg : SmartPlugConfig) -> None:
+    def __init__(self, logger : Logger, plug_cfg : SmartPlugConfig, clock : Union[None, Clock] = None) -> None:
         self._logger=logger
         self._plug_cfg=plug_cfg
+        self._clock : Clock = clock if clock else MonotonicClock()
         assert self._plug_cfg.expected_consumption_in_watt >= 1
         assert self._plug_cfg.consumer_efficiency > 0 and self._plug_cfg.consumer_efficiency < 1
         self._watt_consumed_at_plug : float = self._plug_cfg.expected_consumption_in_watt
         self._consumer_efficiency=self._plug_cfg.consumer_efficiency
         self._enabled=self._plug_cfg.enabled # TODO: use/change "enabled" variable from cfg (-> make SmartPlugConfig not frozen)
         self._propose_to_turn_on=False
+        self._proposed_state_since=self._clock.now()
         self._lock : asyncio.Lock = asyncio.Lock()
+        self._snapshot=StateSnapshot()
+        # NOTE: used by controllers which have to reach the device via network (see TapoPlugController)
+        self._circuit_breaker=CircuitBreaker(self._clock, on_change=self._publish)
+        # commands sent to the plug. 'suppressed' and 'retried' are only used by controllers that wait for a confirmation.
+        self._actuation_counters : Dict[str, int] = {'sent': 0, 'suppressed': 0, 'retried': 0, 'resynced': 0}
+        # switches done by the PlugManager. Used to enforce the dwell times and the maximum number of switches per hour.
+        self._min_on_time=timedelta(seconds=self._plug_cfg.min_on_time_in_sec)
+        self._min_off_time=timedelta(seconds=self._plug_cfg.min_off_time_in_sec)
+        self._last_switch : Union[None, Tuple[bool, datetime]] = None
+        self._switch_times : Deque[datetime] = deque(maxlen=max(1, self._plug_cfg.max_switches_per_hour))
+        # last known state of the plug (None: unknown). Lets the PlugManager find candidates without any request to the plug.
+        self._known_state : Union[None, bool] = None
+        self._on_change : Union[None, Callable[[], None]] = None
+        self._publish()
+
+    def _publish(self) -> None:
+        # NOTE: has to be called after every change of the state
+        state : Dict[str, str] = {}
+        state['enabled'] = 'On' if self._enabled else 'Off'
+        state['proposed_state'] = 'On' if self._propose_to_turn_on else 'Off'
+        state['proposed_state_since'] = self._proposed_state_since.isoformat()
+        state['watt_consumed_at_plug'] = str(self._watt_consumed_at_plug)
+        state['circuit_breaker'] = self._circuit_breaker.state
+        if self._circuit_breaker.open_until is not None:
+            state['circuit_breaker_open_until'] = self._circuit_breaker.open_until.isoformat()
+        self._snapshot=self._snapshot.next(state)
+
+    @property
+    def snapshot(self) -> StateSnapshot:
+        return self._snapshot
+
+    async def versioned_state(self) -> Tuple[str, Dict[str, str]]:
+        """ETag and state of the plug. Does not wait for running changes (no lock)."""
+        snapshot=self._snapshot
+        # NOTE: the actual state is not part of the snapshot since it is owned by the plug (e.g. polled from a Tapo plug)
+        actual_state='On' if await self.is_on() else 'Off'
+        return snapshot.etag(actual_state), {**snapshot.state, 'actual_state': actual_state}
 
     @property
     async def state(self):
-        state : Dict[str, str] = {}
-        async with self._lock:
-            state['enabled'] = 'On' if self._enabled else 'Off'
-            state['proposed_state'] = 'On' if self._propose_to_turn_on else 'Off'
-            state['actual_state'] = 'On' if await self.is_on() else 'Off'
-            state['watt_consumed_at_plug'] = str(self._watt_consumed_at_plug)
-        return state
+        return (await self.versioned_state())[1]
 
     @property
     def enabled(self) -> bool:
@@ -47,6 +83,60 @@ class PlugController(ABC):
     async def set_enabled(self, enabled : bool) -> None:
         async with self._lock:
             self._enabled = enabled
+            self._publish()
+        self._notify()
+
+    @property
+    def known_state(self) -> Union[None, bool]:
+        """Last known state (on/off) of the plug without doing any request. None in case it is unknown (e.g. not reachable)."""
+        return self._known_state
+
+    def set_on_change(self, on_change : Union[None, Callable[[], None]]) -> None:
+        """on_change is called whenever the known state or the enabled flag changes"""
+        self._on_change=on_change
+
+    def _notify(self) -> None:
+        if self._on_change is not None:
+            self._on_change()
+
+    def _set_known_state(self, known_state : Union[None, bool]) -> None:
+        if self._known_state != known_state:
+            self._known_state=known_state
+            self._notify()
+
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        return self._circuit_breaker
+
+    def switch_allowed_from(self, turn_on : bool) -> datetime:
+        """Earliest time at which the plug may be turned on (off) according to the dwell times and the maximum number of switches per hour"""
+        allowed_from=datetime.min
+        if self._last_switch is not None:
+            last_turned_on, timestamp = self._last_switch
+            if last_turned_on and not turn_on:
+                allowed_from=timestamp + self._min_on_time
+            elif not last_turned_on and turn_on:
+                allowed_from=timestamp + self._min_off_time
+        if self._plug_cfg.max_switches_per_hour > 0 and len(self._switch_times) == self._plug_cfg.max_switches_per_hour:
+            # NOTE: the deque only keeps the latest max_switches_per_hour switches
+            allowed_from=max(allowed_from, self._switch_times[0] + timedelta(hours=1))
+        return allowed_from
+
+    @property
+    def last_switch(self) -> Union[None, Tuple[bool, datetime]]:
+        """Latest switch done by this service: (turned on, timestamp)"""
+        return self._last_switch
+
+    def record_switch(self, turn_on : bool, timestamp : datetime) -> None:
+        if self._last_switch is not None and self._last_switch[0] == turn_on:
+            # plug has already been switched to this state (e.g. by a repeated command)
+            return
+        self._last_switch=(turn_on, timestamp)
+        self._switch_times.append(timestamp)
+
+    @property
+    def actuation_metrics(self) -> Dict[str, int]:
+        return dict(self._actuation_counters)
 
     @property
     def watt_consumed(self) -> float:
@@ -69,27 +159,44 @@ class PlugController(ABC):
     def reset(self) -> None:
         pass
 
+    async def close(self) -> None:
+        """Releases the resources of the plug (e.g. http sessions). Called on shutdown."""
+        pass
+
     @abstractmethod
     async def is_on(self) -> bool:
         pass
 
+    def _propose(self, turn_on : bool) -> None:
+        if self._propose_to_turn_on != turn_on:
+            self._propose_to_turn_on=turn_on
+            self._proposed_state_since=self._clock.now()
+            self._publish()
+
     async def turn_on(self) -> bool:
-        self._propose_to_turn_on=True
+        self._propose(True)
         return True
 
     async def turn_off(self) -> bool:
-        self._propose_to_turn_on=False
+        self._propose(False)
         return True
 
 class TapoPlugController(PlugController):
+    # (encryption type, version) of the protocols tried while connecting. Same order as the protocol guessing of plugp100.
+    _protocols : List[Tuple[str, int]] = [('aes', 1), ('klap', 1), ('klap', 2)]
 
-    def __init__(self, logger : Logger, plug_cfg : TapoSmartPlugConfig) -> None:
-        super().__init__(logger, plug_cfg)
+    def __init__(self, logger : Logger, plug_cfg : TapoSmartPlugConfig, clock : Union[None, Clock] = None) -> None:
+        super().__init__(logger, plug_cfg, clock)
         self._cfg=plug_cfg
         assert self._cfg.id != ''
         assert self._cfg.auth_user != ''
         assert self._cfg.auth_passwd != ''
-        self._plug : Optional[TapoPlug] = None
+        self._plug : Optional['TapoPlug'] = None
+        # NOTE: the http session of the plug is owned by the controller. plugp100 does not close its own sessions in case connecting fails.
+        self._session : Optional['aiohttp.ClientSession'] = None
+        # protocol of the last successful connect. It is tried first on a reconnect.
+        self._protocol : Union[None, Tuple[str, int]] = None
+        self._closing : Set[asyncio.Task] = set()
 
     @cached_property
     def info(self) -> Dict[str, str]:
@@ -108,17 +215,67 @@ class TapoPlugController(PlugController):
             return False
 
     def reset(self) -> None:
+        if self._session is not None:
+            # close the http session of the plug in the background (see close)
+            task=asyncio.get_running_loop().create_task(self._session.close())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        self._session = None
         self._plug = None
+        self._set_known_state(None)
+
+    async def close(self) -> None:
+        self.reset()
+        await asyncio.gather(*self._closing)
 
     async def _update(self) -> None:
+        # NOTE: skip unreachable plugs instead of waiting for a network timeout on each reading
+        if not self._circuit_breaker.allow():
+            raise ConnectionError(f"Circuit breaker of Tapo Plug {self._cfg.id} is {self._circuit_breaker.state}")
+        succeeded=False
+        try:
+            await self._connect_and_update()
+            succeeded=True
+        finally:
+            # NOTE: a cancelled probe counts as failure. Otherwise the breaker would stay half open.
+            self._circuit_breaker.record_success() if succeeded else self._circuit_breaker.record_failure()
+            self._set_known_state(self._plug.is_on if succeeded and self._plug is not None else None)
+
+    async def _connect(self, encryption_type : str, encryption_version : int) -> None:
+        import aiohttp
+        from plugp100.common.credentials import AuthCredential
+        from plugp100.new.device_factory import connect, DeviceConnectConfiguration
+        credentials = AuthCredential(self._cfg.auth_user, self._cfg.auth_passwd)
+        # id is the ip-address of the plug. Optionally followed by the port (e.g. 192.168.1.10:80)
+        host, _, port = self._cfg.id.partition(':')
+        device_configuration = DeviceConnectConfiguration(
+            host=host,
+            port=int(port) if port else 80,
+            credentials=credentials,
+            encryption_type=encryption_type,
+            encryption_version=encryption_version
+        )
+        # NOTE: one session per attempt. plugp100 closes the session of a protocol which does not work.
+        # The cookie jar accepts the session cookie of a plug addressed by its ip-address (like the sessions created by plugp100).
+        session=aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True, quote_cookie=False))
+        try:
+            self._plug = await connect(device_configuration, session) # type: ignore
+        except BaseException:
+            await session.close()
+            raise
+        self._session=session
+        self._protocol=(encryption_type, encryption_version)
+
+    async def _connect_and_update(self) -> None:
         if self._plug is None:
-            credentials = AuthCredential(self._cfg.auth_user, self._cfg.auth_passwd)
-            device_configuration = DeviceConnectConfiguration(
-                host=self._cfg.id,
-                credentials=credentials
-            )
-            async with aiohttp.ClientSession() as session:
-                self._plug = await connect(device_configuration, session) # type: ignore
+            protocols=sorted(self._protocols, key=lambda protocol: protocol != self._protocol)
+            for i, (encryption_type, encryption_version) in enumerate(protocols):
+                try:
+                    await self._connect(encryption_type, encryption_version)
+                    break
+                except Exception:
+                    if i == len(protocols) - 1:
+                        raise
         await self._plug.update() # type: ignore
 
     async def is_on(self) -> bool:
@@ -133,6 +290,7 @@ class TapoPlugController(PlugController):
         base_rc = await super().turn_on()
         if base_rc and self._plug is not None:
             await self._plug.turn_on()
+            self._actuation_counters['sent']+=1
             self._logger.info("Turned Tapo Plug on")
             return await self.is_on()
         return False
@@ -141,21 +299,30 @@ class TapoPlugController(PlugController):
         base_rc = await super().turn_off()
         if base_rc and self._plug is not None:
             await self._plug.turn_off()
+            self._actuation_counters['sent']+=1
             self._logger.info("Turned Tapo Plug off")
             return not await self.is_on()
         return False
     
 class OpenHabPlugController(PlugController):
 
-    def __init__(self, logger : Logger, plug_cfg : OpenHabSmartPlugConfig) -> None:
-        super().__init__(logger, plug_cfg)
-        assert get_oh_connection() is not None
+    def __init__(self, logger : Logger, plug_cfg : OpenHabSmartPlugConfig, clock : Union[None, Clock] = None, 
+                 oh_connection : Union[None, OpenhabConnectionProtocol] = None) -> None:
+        super().__init__(logger, plug_cfg, clock)
+        # NOTE: Uses the global openHAB connection if none is given (multi-site mode uses one connection per site)
+        self._oh_connection=oh_connection
+        assert self._get_oh_connection() is not None
         self._plug_cfg=plug_cfg
         assert self._plug_cfg.oh_thing_name != ''
         assert self._plug_cfg.oh_switch_item_name != ''
         assert self._plug_cfg.oh_power_consumption_item_name != ''
         self._is_on = False
         self._online = True
+        self._known_state = False
+        # last command sent to openHAB which has not been confirmed (via update_values) yet
+        self._pending_command : Union[None, bool] = None
+        self._pending_command_since=self._clock.now()
+        self._confirmation_window=timedelta(seconds=self._plug_cfg.confirmation_window_in_sec)
 
     @cached_property
     def info(self) -> Dict[str, str]:
@@ -165,8 +332,16 @@ class OpenHabPlugController(PlugController):
         info['oh_switch_item_name'] = self._plug_cfg.oh_switch_item_name
         info['oh_power_consumption_item_name'] = self._plug_cfg.oh_power_consumption_item_name
         info['oh_automation_enabled_switch_item_name'] = self._plug_cfg.oh_automation_enabled_switch_item_name
+        info['oh_thing_max_silence_in_min'] = str(cast(OpenHabSmartPlugConfig, self._plug_cfg).oh_thing_max_silence_in_min)
         return info
 
+    def _get_oh_connection(self) -> Union[None, OpenhabConnectionProtocol]:
+        return self._oh_connection if self._oh_connection is not None else get_oh_connection()
+
+    @property
+    def oh_connection(self) -> Union[None, OpenhabConnectionProtocol]:
+        return self._get_oh_connection()
+
     def reset(self) -> None:
         pass
 
@@ -176,33 +351,63 @@ class OpenHabPlugController(PlugController):
     async def is_on(self) -> bool:
         return self._is_on
     
+    async def _send_command(self, turn_on : bool) -> bool:
+        command='ON' if turn_on else 'OFF'
+        now=self._clock.now()
+        if self._pending_command == turn_on:
+            if now - self._pending_command_since < self._confirmation_window:
+                # NOTE: the same command is on its way. Sending it again would only cause additional (radio) traffic.
+                self._actuation_counters['suppressed']+=1
+                self._logger.debug(f"Suppressed command {command}. Waiting for the confirmation of the command sent at {self._pending_command_since}")
+                return True
+            self._actuation_counters['retried']+=1
+            self._logger.warning(f"Command {command} has not been confirmed within {self._confirmation_window}. Sending it again.")
+        oh_connection = self._get_oh_connection()
+        if oh_connection is None:
+            self._logger.error(f"OpenHabConnection is not set. Cannot send command {command} to plug")
+            return False
+        success=await oh_connection.post_to_item(self._plug_cfg.oh_switch_item_name, command)
+        if success:
+            self._actuation_counters['sent']+=1
+            self._pending_command=turn_on
+            self._pending_command_since=now
+            self._logger.info(f"Turned OpenHabPlug Plug {command.lower()}")
+        return success
+
     async def turn_on(self) -> bool:
         base_rc = await super().turn_on()
-        oh_connection = get_oh_connection()
-        if oh_connection is None:
-            self._logger.error("OpenHabConnection is not set. Cannot turn on plug")
-        elif base_rc:
-            success=await oh_connection.post_to_item(self._plug_cfg.oh_switch_item_name, 'ON')
-            if success:
-                self._logger.info("Turned OpenHabPlug Plug on")
-            return success
-        return False
+        return base_rc and await self._send_command(True)
 
     async def turn_off(self) -> bool:
         base_rc = await super().turn_off()
-        oh_connection = get_oh_connection()
-        if oh_connection is None:
-            self._logger.error("OpenHabConnection is not set. Cannot turn off plug")
-        elif base_rc:
-            success=await oh_connection.post_to_item(self._plug_cfg.oh_switch_item_name, 'OFF')
-            if success:
-                self._logger.info("Turned OpenHabPlug Plug off")
-            return success
-        return False
+        return base_rc and await self._send_command(False)
     
     async def update_values(self, watt_consumed_at_plug: float, online : bool, is_on : bool) -> None:
         async with self._lock:
             self._watt_consumed_at_plug=watt_consumed_at_plug
             self._online=online
             self._is_on=is_on
-        self._logger.debug(f"Updated values of OpenHabPlugController to {watt_consumed_at_plug}, {online}, {is_on}")
\ No newline at end of file
+            if self._pending_command == is_on:
+                # command has been confirmed
+                self._pending_command=None
+            self._publish()
+        self._set_known_state(is_on if online else None)
+        self._logger.debug("Updated values of OpenHabPlugController to %s, %s, %s", watt_consumed_at_plug, online, is_on)
+
+    async def resync(self, item_states : Dict[str, str], thing_states : Dict[str, str]) -> bool:
+        """
+        Applies the states read from openHAB (see OpenhabConnection.read_states) in case they differ from the known values.
+        Returns True in case they differed (e.g. an update of openHAB has been missed).
+        """
+        if self._plug_cfg.oh_switch_item_name not in item_states or self._plug_cfg.oh_thing_name not in thing_states:
+            self._logger.warning(f"Unable to resync OpenHabPlugController. Item {self._plug_cfg.oh_switch_item_name} or thing {self._plug_cfg.oh_thing_name} not found.")
+            return False
+        watt_consumed=parse_number_state(item_states.get(self._plug_cfg.oh_power_consumption_item_name))
+        values=(watt_consumed if watt_consumed is not None else self._watt_consumed_at_plug, 
+                thing_states[self._plug_cfg.oh_thing_name] == 'ONLINE', item_states[self._plug_cfg.oh_switch_item_name] == 'ON')
+        if values == (self._watt_consumed_at_plug, self._online, self._is_on):
+            return False
+        self._actuation_counters['resynced']+=1
+        self._logger.info(f"Resynced OpenHabPlugController. Values {self._watt_consumed_at_plug}, {self._online}, {self._is_on} differed from openHAB.")
+        await self.update_values(*values)
+        return True
\ No newline at end of file
@@ -1,115 +1,377 @@
 from __future__ import annotations
 import sys
 from logging import Logger
-from typing import Dict, Union, cast
+from typing import Awaitable, Callable, Dict, Deque, Iterator, Tuple, Union, cast
+from collections import deque
 
 import asyncio
+import math
+import time
 
 from smartplug_energy_controller.utils import *
 from smartplug_energy_controller.config import *
 from smartplug_energy_controller.plug_controller import *
+from smartplug_energy_controller.deferrable import DeferrableLoad, SurplusProfile
+
+class PendingLimitExceeded(RuntimeError):
+    pass
 
 class PlugManager():
     _efficiency_tolerance=0.075
+    # maximum deviation of the forecast from the median in standard deviations of the evaluated watt obtained
+    _forecast_tolerance=2.0
 
     def __init__(self, logger : Logger, eval_time_in_min : int, default_base_load_in_watt : int, 
-                 min_expected_freq : timedelta = timedelta(seconds=90)) -> None:
+                 min_expected_freq : timedelta = timedelta(seconds=90), decision_trace_size : int = 100, 
+                 clock : Union[None, Clock] = None, coalesce : bool = False, max_pending : int = 100, 
+                 evaluation_deadline : Union[None, timedelta] = None, allocate_surplus : bool = False, 
+                 forecast_horizon : Union[None, timedelta] = None, eval_time_limits : Union[None, Tuple[timedelta, timedelta]] = None, 
+                 volatility_reference_in_watt : float = 200, efficiency_tolerance : Union[None, float] = None) -> None:
         self._logger=logger
+        if efficiency_tolerance is not None:
+            self._efficiency_tolerance=efficiency_tolerance
+        self._clock : Clock = clock if clock else MonotonicClock()
+        # optional (min, max) of the evaluated time frame. Adapted to the volatility of the watt obtained (see _adapt_eval_time)
+        self._eval_time_limits=eval_time_limits
+        self._volatility_reference_in_watt=volatility_reference_in_watt
+        eval_time=timedelta(minutes=eval_time_in_min)
+        if self._eval_time_limits is not None:
+            eval_time=min(max(eval_time, self._eval_time_limits[0]), self._eval_time_limits[1])
         # Add a dummy value to the rolling watt-obtained values to assure valid state at the beginning
-        self._watt_obtained_values=RollingValues(timedelta(minutes=eval_time_in_min),
-                                                 [ValueEntry(sys.float_info.max, datetime.now())])
+        self._watt_obtained_values=RollingValues(eval_time, [ValueEntry(sys.float_info.max, self._clock.now())])
+        # NOTE: the volatility is always measured over the longest time frame. A short time frame contains too few values.
+        self._volatility_values=RollingValues(self._eval_time_limits[1] if self._eval_time_limits else eval_time)
         self._base_load : float = default_base_load_in_watt
         self._min_expected_freq = min_expected_freq
         self._watt_produced : Union[None, float] = None
         self._break_even : Union[None, float] = None
         self._latest_mean = sys.float_info.max
         self._having_overproduction = False
+        # act ahead of the evaluation window: decisions are based on the values expected at the end of the forecast horizon
+        self._forecast_horizon=forecast_horizon
+        self._watt_obtained_forecaster=TrendForecaster(eval_time/2, eval_time)
+        self._watt_produced_forecaster=TrendForecaster(eval_time/2, eval_time)
+        self._latest_forecast : Union[None, float] = None
+        # values the decisions are based on. Equal to the median resp. the latest produced value without forecasting.
+        self._expected_watt_obtained = self._latest_mean
+        self._expected_watt_produced : Union[None, float] = None
         self._controllers : Dict[str, PlugController] = {}
+        # priority of a plug is its position in _controllers (0 = highest prio)
+        self._controllers_by_priority : List[Tuple[str, PlugController]] = []
+        self._index=PriorityIndex()
+        # plugs which have to run for a given time before a deadline. These are not part of the usual on/off logic (see _handle_deferrable_plugs).
+        self._deferrable_loads : Dict[str, DeferrableLoad] = {}
+        self._surplus_profile=SurplusProfile()
         self._lock : asyncio.Lock = asyncio.Lock()
+        self._decisions : Deque[DecisionTrace] = deque(maxlen=decision_trace_size)
+        self._snapshot=StateSnapshot()
+        self._publish()
+        # ingestion of smart meter values (see ingest_smart_meter_values)
+        self._coalesce=coalesce
+        self._max_pending=max_pending
+        self._pending=0
+        self._latest_values : Union[None, Tuple[float, Union[None, float], datetime]] = None
+        self._next_evaluation : Union[None, asyncio.Future] = None
+        self._evaluator : Union[None, asyncio.Task] = None
+        self._ingestion_counters : Dict[str, int] = {'evaluations': 0, 'skipped_evaluations': 0, 'rejected': 0, 'deadline_exceeded': 0}
+        # NOTE: None means no deadline. The requests to a plug are limited by its I/O timeout nevertheless.
+        self._evaluation_deadline=evaluation_deadline
+        self._watchdog=TimeoutWatchdog()
+        # distribute the surplus to several plugs within one evaluation (see _handle_turn_on_plug)
+        self._allocate_surplus=allocate_surplus
+        # expected consumption and timestamp of the plugs turned on during the current overproduction (allocated surplus)
+        self._allocations : Dict[str, Tuple[float, datetime]] = {}
+
+    def _publish(self) -> None:
+        # NOTE: has to be called after every change of the state
+        state : Dict[str, float] = {}
+        state['base_load'] = self._base_load
+        state['min_expected_freq_in_sec'] = self._min_expected_freq.total_seconds()
+        if self._watt_produced is not None:
+            state['watt_produced'] = self._watt_produced
+        if self._break_even is not None:
+            state['break_even'] = self._break_even
+        state['latest_mean'] = self._latest_mean
+        state['eval_time_in_sec'] = self._watt_obtained_values.time_delta().total_seconds()
+        if self._latest_forecast is not None:
+            state['latest_forecast'] = self._latest_forecast
+        self._snapshot=self._snapshot.next(state)
+
+    @property
+    def snapshot(self) -> StateSnapshot:
+        """Latest published state. Readers do not need (and do not wait for) the lock."""
+        return self._snapshot
 
     @property
     async def state(self):
-        state : Dict[str, float] = {}
-        async with self._lock:
-            state['base_load'] = self._base_load
-            state['min_expected_freq_in_sec'] = self._min_expected_freq.total_seconds()
-            if self._watt_produced is not None:
-                state['watt_produced'] = self._watt_produced
-            if self._break_even is not None:
-                state['break_even'] = self._break_even
-            state['latest_mean'] = self._latest_mean
-        return state
+        return dict(self._snapshot.state)
     
     async def set_base_load(self) -> None:
         async with self._lock:
             if self._watt_obtained_values.value_count() > 1:
                 self._base_load = min(self._base_load, self._watt_obtained_values.mean())
+                self._publish()
+
+    async def close(self) -> None:
+        """Releases the resources of all plugs (e.g. http sessions). Called on shutdown."""
+        for controller in self._controllers.values():
+            await controller.close()
+
+    async def resync_openhab_plugs(self) -> None:
+        """
+        Reads the states of all openHAB plugs at once (one request for the items and one for the things per openHAB connection).
+        Plugs whose values differ from the states in openHAB (missed updates) are fixed.
+        """
+        plugs_by_connection : Dict[int, Tuple[OpenhabConnectionProtocol, List[OpenHabPlugController]]] = {}
+        for controller in self._controllers.values():
+            if isinstance(controller, OpenHabPlugController) and controller.oh_connection is not None:
+                plugs_by_connection.setdefault(id(controller.oh_connection), (controller.oh_connection, []))[1].append(controller)
+        for oh_connection, plugs in plugs_by_connection.values():
+            item_names={name for plug in plugs for name in [cast(OpenHabSmartPlugConfig, plug.cfg).oh_switch_item_name, 
+                                                            cast(OpenHabSmartPlugConfig, plug.cfg).oh_power_consumption_item_name]}
+            states=await oh_connection.read_states(item_names, {cast(OpenHabSmartPlugConfig, plug.cfg).oh_thing_name for plug in plugs})
+            if states is None:
+                self._logger.warning("Failed to resync the openHAB plugs")
+                continue
+            resynced=[await plug.resync(*states) for plug in plugs]
+            self._logger.debug(f"Resynced {sum(resynced)} of {len(plugs)} openHAB plugs")
 
     def _add_plug_controller(self, uuid : str, controller : PlugController) -> None:
         self._controllers[uuid]=controller
+        if controller.cfg.runtime_in_min > 0:
+            self._deferrable_loads[uuid]=DeferrableLoad(timedelta(minutes=controller.cfg.runtime_in_min), 
+                                                        datetime.strptime(controller.cfg.deadline, '%H:%M').time(), self._surplus_profile)
+        priority=len(self._controllers_by_priority)
+        self._controllers_by_priority.append((uuid, controller))
+        controller.set_on_change(lambda: self._update_index(priority))
+        self._update_index(priority)
+
+    def _update_index(self, priority : int) -> None:
+        uuid, controller=self._controllers_by_priority[priority]
+        self._index.update(priority, controller.enabled and uuid not in self._deferrable_loads, controller.known_state)
+
+    def _candidates(self, turn_on : bool) -> Iterator[Tuple[str, PlugController]]:
+        """
+        Enabled plugs which are (possibly) off in the order of their prio (highest prio first) in case of turn_on. 
+        Enabled plugs which are (possibly) on in reversed order otherwise.
+        NOTE: Changes of the index while iterating (e.g. a plug has been turned on) are taken into account.
+        """
+        priority=self._index.next_off() if turn_on else self._index.next_on()
+        while priority is not None:
+            yield self._controllers_by_priority[priority]
+            priority=self._index.next_off(priority) if turn_on else self._index.next_on(priority)
 
     def plug(self, plug_uuid : str) -> PlugController:
         return self._controllers[plug_uuid]
 
     def plugs(self) -> List[PlugController]:
         return list(self._controllers.values())
+
+    @property
+    def plug_uuids(self) -> List[str]:
+        return list(self._controllers.keys())
     
-    async def _handle_turn_on_plug(self) -> None:
+    def _report_deadline_exceeded(self, trace : DecisionTrace) -> None:
+        if not trace.deadline_exceeded:
+            trace.deadline_exceeded=True
+            self._ingestion_counters['deadline_exceeded']+=1
+            self._logger.warning(f"Evaluation exceeded its deadline of {self._evaluation_deadline}. Remaining plugs are skipped.")
+
+    async def _run_plug_step(self, trace : DecisionTrace, deadline : float, uuid : str, controller : PlugController, action : str, 
+                             step : Callable[[str, PlugController, PlugDecision], Awaitable[bool]]) -> bool:
+        """
+        Runs a step of the evaluation for a single plug and records its decision in the trace.
+        The step is skipped once the deadline has passed. It has to finish within the I/O timeout of the plug.
+        The plug is reset in case of a timeout or an exception. Returns True in case no further plugs are to be checked.
+        """
+        decision=PlugDecision(uuid)
+        trace.plugs.append(decision)
+        start=time.perf_counter()
+        if start >= deadline:
+            self._report_deadline_exceeded(trace)
+            decision.result='deadline_exceeded'
+            return False
+        # NOTE: wait for a plug at most for its I/O timeout (0: no limit) and never beyond the deadline of the evaluation
+        io_timeout=controller.cfg.io_timeout_in_sec if controller.cfg.io_timeout_in_sec > 0 else float('inf')
+        self._watchdog.arm(min(io_timeout, deadline - start))
+        try:
+            return await step(uuid, controller, decision)
+        except asyncio.CancelledError:
+            if not self._watchdog.timed_out():
+                raise
+            # state of the plug is unknown -> skip it in this evaluation
+            decision.result='timeout'
+            self._logger.warning(f"Plug with UUID {uuid} did not answer in time. Skipping it in this evaluation.")
+            controller.reset()
+        except Exception as e:
+            decision.result='exception'
+            # Just log as warning since the plug could just be unconnected 
+            self._logger.warning(f"Caught Exception while {action} Plug with UUID {uuid}. Exception message: {e}")
+            self._logger.warning("About to reset controller now.")
+            controller.reset()
+        finally:
+            self._watchdog.disarm()
+            decision.duration_in_ms=(time.perf_counter()-start)*1000
+        return False
+
+    async def _handle_turn_on_plug(self, trace : DecisionTrace, deadline : float) -> None:
         assert self._having_overproduction
-        # check plugs in given order (highest prio to lowest prio)
-        for uuid, controller in self._controllers.items():
-            try:
-                if controller.enabled and await controller.is_online() and not await controller.is_on():
-                    turn_on = True
-                    if self._watt_produced is not None and self._break_even is not None:
-                        efficiency_factor=max(0.0, controller.consumer_efficiency - PlugManager._efficiency_tolerance)
-                        # NOTE: expect the plug to consume at least the expected consumption to avoid "flickering" of the plug
-                        expected_watt_consumption = max(controller.watt_consumed, controller.cfg.expected_consumption_in_watt)
-                        turn_on = (self._watt_produced - self._break_even) > expected_watt_consumption*(1 - efficiency_factor)
-                    if turn_on:
-                        # if turning on fails due to connection issues -> continue with next plug
-                        # Usually the plug should not be online in this case, but having this additional check makes it more robust.   
-                        if not await controller.turn_on():
-                            continue
-                    # NOTE: Only check the controller which is off and has the highest prio
-                    # Implementing consumer balancing would be to much overhead. 
-                    break
-            except Exception as e:
-                # Just log as warning since the plug could just be unconnected 
-                self._logger.warning(f"Caught Exception while turning on Plug with UUID {uuid}. Exception message: {e}")
-                self._logger.warning("About to reset controller now.")
-                controller.reset()
-
-    async def _handle_turn_off_plug(self) -> None:
+        # surplus which is not yet used by plugs turned on within this evaluation
+        surplus : Union[None, float] = None
+        if self._expected_watt_produced is not None and self._break_even is not None:
+            surplus=self._expected_watt_produced - self._break_even
+        if self._allocate_surplus and surplus is not None:
+            # NOTE: the median reflects the load of a plug turned on only once the evaluated time frame has passed.
+            # Until then the surplus allocated to the plug is not available for other plugs.
+            time_frame=self._watt_obtained_values.time_delta()
+            self._allocations={uuid: allocation for uuid, allocation in self._allocations.items() if trace.timestamp - allocation[1] < time_frame}
+            surplus-=sum(watt for watt, _ in self._allocations.values())
+
+        async def turn_on(uuid : str, controller : PlugController, decision : PlugDecision) -> bool:
+            nonlocal surplus
+            if trace.timestamp < controller.switch_allowed_from(True):
+                # NOTE: checked before any request to the plug
+                decision.result='locked'
+                return False
+            if not await controller.is_online():
+                decision.result='offline'
+                return False
+            if await controller.is_on():
+                decision.result='on'
+                return False
+            turn_on = True
+            # NOTE: expect the plug to consume at least the expected consumption to avoid "flickering" of the plug
+            expected_watt_consumption = max(controller.watt_consumed, controller.cfg.expected_consumption_in_watt)
+            if surplus is not None:
+                efficiency_factor=max(0.0, controller.consumer_efficiency - self._efficiency_tolerance)
+                turn_on = surplus > expected_watt_consumption*(1 - efficiency_factor)
+            if turn_on:
+                # if turning on fails due to connection issues -> continue with next plug
+                # Usually the plug should not be online in this case, but having this additional check makes it more robust.   
+                if not await controller.turn_on():
+                    decision.result='turn_on_failed'
+                    return False
+                controller.record_switch(True, trace.timestamp)
+                decision.result='turned_on'
+            else:
+                decision.result='below_threshold'
+            if self._allocate_surplus and surplus is not None:
+                # greedy allocation: the remaining surplus is offered to the plugs with lower prio (e.g. smaller consumers)
+                if turn_on:
+                    surplus-=expected_watt_consumption
+                    self._allocations[uuid]=(expected_watt_consumption, trace.timestamp)
+                return False
+            # NOTE: Only check the controller which is off and has the highest prio
+            return True
+
+        # check plugs in given order (highest prio to lowest prio). Plugs known to be on or disabled are not checked at all.
+        for uuid, controller in self._candidates(turn_on=True):
+            if await self._run_plug_step(trace, deadline, uuid, controller, 'turning on', turn_on):
+                break
+
+    async def _handle_turn_off_plug(self, trace : DecisionTrace, deadline : float) -> None:
         assert not self._having_overproduction
-        # check plugs in reversed order (lowest prio to highest prio)
-        for uuid, controller in reversed(self._controllers.items()):
-            try:
-                if controller.enabled and await controller.is_online() and await controller.is_on():
-                    efficiency_factor=min(1.0, controller.consumer_efficiency + PlugManager._efficiency_tolerance)
-                    if self._latest_mean > controller.watt_consumed*efficiency_factor:
-                        # if turning off fails due to connection issues -> continue with next plug
-                        # Usually the plug should not be online in this case, but having this additional check makes it more robust.   
-                        if not await controller.turn_off():
-                            continue
-                    # NOTE: Only check the controller which is on and has the lowest prio
-                    # Implementing consumer balancing would be to much overhead 
-                    break
-            except Exception as e:
-                # Just log as warning since the plug could just be unconnected 
-                self._logger.warning(f"Caught Exception while turning off Plug with UUID {uuid}. Exception message: {e}")
-                self._logger.warning("About to reset controller now.")
-                controller.reset()
+
+        async def turn_off(uuid : str, controller : PlugController, decision : PlugDecision) -> bool:
+            if trace.timestamp < controller.switch_allowed_from(False):
+                # NOTE: checked before any request to the plug
+                decision.result='locked'
+                # NOTE: a temporary lock does not change the order. Plugs with higher prio are not turned off instead.
+                # Only a plug turned off by this service (locked by the maximum number of switches) is skipped.
+                return controller.last_switch is None or controller.last_switch[0]
+            if not await controller.is_online():
+                decision.result='offline'
+                return False
+            if not await controller.is_on():
+                decision.result='off'
+                return False
+            efficiency_factor=min(1.0, controller.consumer_efficiency + self._efficiency_tolerance)
+            if self._expected_watt_obtained > controller.watt_consumed*efficiency_factor:
+                # if turning off fails due to connection issues -> continue with next plug
+                # Usually the plug should not be online in this case, but having this additional check makes it more robust.   
+                if not await controller.turn_off():
+                    decision.result='turn_off_failed'
+                    return False
+                controller.record_switch(False, trace.timestamp)
+                decision.result='turned_off'
+            else:
+                decision.result='below_threshold'
+            # NOTE: Only check the controller which is on and has the lowest prio
+            # Implementing consumer balancing would be to much overhead 
+            return True
+
+        # check plugs in reversed order (lowest prio to highest prio). Plugs known to be off or disabled are not checked at all.
+        for uuid, controller in self._candidates(turn_on=False):
+            if await self._run_plug_step(trace, deadline, uuid, controller, 'turning off', turn_off):
+                break
+
+    def _adapt_eval_time(self) -> None:
+        assert self._eval_time_limits is not None
+        min_eval_time, max_eval_time=self._eval_time_limits
+        # NOTE: short time frame on stable days to react fast. Long time frame on cloudy days to avoid flickering plugs.
+        volatility=min(1.0, math.sqrt(self._volatility_values.variance())/self._volatility_reference_in_watt)
+        eval_time=timedelta(seconds=round((min_eval_time + (max_eval_time - min_eval_time)*volatility).total_seconds()))
+        if eval_time != self._watt_obtained_values.time_delta():
+            self._logger.debug("Evaluated time frame has been changed from %s to %s", self._watt_obtained_values.time_delta(), eval_time)
+            self._watt_obtained_values.set_time_delta(eval_time)
+            # NOTE: the forecasters follow the same time frame. Otherwise they react slower (faster) than the median.
+            for forecaster in [self._watt_obtained_forecaster, self._watt_produced_forecaster]:
+                forecaster.set_time_constants(eval_time/2, eval_time)
+
+    async def _handle_deferrable_plugs(self, trace : DecisionTrace, deadline : float) -> None:
+
+        async def run_deferrable(uuid : str, controller : PlugController, decision : PlugDecision) -> bool:
+            load=self._deferrable_loads[uuid]
+            if not await controller.is_online():
+                decision.result='offline'
+                return False
+            is_on=await controller.is_on()
+            load.update(trace.timestamp, is_on)
+            # result is 'done', 'forced', 'planned' or 'waiting' in case the plug is already in the desired state
+            run, decision.result=load.should_run(trace.timestamp)
+            if run == is_on:
+                return False
+            # NOTE: the dwell times are ignored when the plug is forced on. Otherwise the deadline could be missed.
+            if decision.result != 'forced' and trace.timestamp < controller.switch_allowed_from(run):
+                decision.result='locked'
+            elif not await (controller.turn_on() if run else controller.turn_off()):
+                decision.result='turn_on_failed' if run else 'turn_off_failed'
+            else:
+                controller.record_switch(run, trace.timestamp)
+                load.update(trace.timestamp, run)
+                decision.result='turned_on' if run else 'turned_off'
+            return False
+
+        for uuid in self._deferrable_loads:
+            controller=self._controllers[uuid]
+            if controller.enabled:
+                await self._run_plug_step(trace, deadline, uuid, controller, 'handling deferrable', run_deferrable)
 
     def _evaluate(self, watt_produced : Union[None, float] = None) -> bool:
+        if self._eval_time_limits is not None:
+            self._adapt_eval_time()
         if self._watt_obtained_values.value_count() < 2:
-            self._logger.error(f"Not enough values in the evaluated timeframe of {self._watt_obtained_values.time_delta()}. Make sure to add values more frequently.")
+            self._logger.error("Not enough values in the evaluated timeframe of %s. Make sure to add values more frequently.", self._watt_obtained_values.time_delta())
             return False
         if self._watt_obtained_values[-1].timestamp - self._watt_obtained_values[-2].timestamp > self._min_expected_freq:
-            self._logger.warning(f"Values are not added frequently enough. The minimum frequency is {self._min_expected_freq}. Some features might not work as intended.")
+            self._logger.warning("Values are not added frequently enough. The minimum frequency is %s. Some features might not work as intended.", self._min_expected_freq)
         had_overprotection = self._having_overproduction
         self._latest_mean = self._watt_obtained_values.median()
-        self._having_overproduction = self._latest_mean < 1
+        self._expected_watt_obtained = self._latest_mean
+        self._expected_watt_produced = watt_produced
+        if self._forecast_horizon is not None:
+            self._latest_forecast=self._watt_obtained_forecaster.forecast(self._forecast_horizon)
+            if self._latest_forecast is not None:
+                # NOTE: the forecast is only used to act earlier. The trend of the raw values follows single spikes, the median does not.
+                # Thus the forecast is limited to the spread of the evaluated values around the median.
+                deviation=self._forecast_tolerance*math.sqrt(self._watt_obtained_values.variance())
+                self._expected_watt_obtained=min(max(self._latest_forecast, self._latest_mean - deviation), self._latest_mean + deviation)
+            produced_forecast=self._watt_produced_forecaster.forecast(self._forecast_horizon)
+            if watt_produced is not None and produced_forecast is not None:
+                self._expected_watt_produced=max(0.0, produced_forecast)
+        self._having_overproduction = self._expected_watt_obtained < 1
+        if not self._having_overproduction:
+            self._allocations.clear()
         old_break_even = self._break_even
         if not had_overprotection and self._having_overproduction:
             if watt_produced is not None and self._watt_produced is not None:
@@ -118,34 +380,165 @@ class PlugManager():
                 self._break_even = watt_produced
             else:
                 self._break_even = None
-            self._logger.info(f"Break-even value has been updated from {old_break_even} to {self._break_even}")
+            self._logger.info("Break-even value has been updated from %s to %s", old_break_even, self._break_even)
         elif had_overprotection and self._having_overproduction and self._break_even is not None:
             # decrease break-even value when overproduction is still present
             self._break_even = self._base_load + 0.975*max(self._break_even - self._base_load, 0.0)
             if old_break_even != self._break_even:
-                self._logger.info(f"Break-even value has been updated from {old_break_even} to {self._break_even}")
+                self._logger.info("Break-even value has been updated from %s to %s", old_break_even, self._break_even)
         self._watt_produced=watt_produced
         return True
 
+    def _add_values(self, watt_obtained_from_provider : float, watt_produced : Union[None, float], timestamp : datetime) -> None:
+        self._watt_obtained_values.add(ValueEntry(watt_obtained_from_provider, timestamp))
+        if self._eval_time_limits is not None:
+            self._volatility_values.add(ValueEntry(watt_obtained_from_provider, timestamp))
+        if self._deferrable_loads:
+            # NOTE: the produced watt does not depend on the plugs being on. Thus it is preferred.
+            self._surplus_profile.add(watt_produced - self._base_load if watt_produced is not None else -watt_obtained_from_provider, timestamp)
+        if self._forecast_horizon is not None:
+            self._watt_obtained_forecaster.add(watt_obtained_from_provider, timestamp)
+            if watt_produced is not None:
+                self._watt_produced_forecaster.add(watt_produced, timestamp)
+
     async def add_smart_meter_values(self, watt_obtained_from_provider : float, watt_produced : Union[None, float] = None, timestamp : Union[None, datetime] = None):
         async with self._lock:
-            self._watt_obtained_values.add(ValueEntry(watt_obtained_from_provider, timestamp if timestamp else datetime.now()))
-            self._logger.debug(f"Added values: watt_obtained_from_provider={watt_obtained_from_provider}, watt_produced={watt_produced}")
-            if self._evaluate(watt_produced):
-                await self._handle_turn_on_plug() if self._having_overproduction else await self._handle_turn_off_plug()
+            start=time.perf_counter()
+            timestamp=timestamp if timestamp else self._clock.now()
+            self._add_values(watt_obtained_from_provider, watt_produced, timestamp)
+            # NOTE: lazy formatting (hot path). The message is only formatted in case debug logging is enabled.
+            self._logger.debug("Added values: watt_obtained_from_provider=%s, watt_produced=%s", watt_obtained_from_provider, watt_produced)
+            await self._evaluate_and_handle_plugs(watt_obtained_from_provider, watt_produced, timestamp, start)
+
+    async def _evaluate_and_handle_plugs(self, watt_obtained_from_provider : float, watt_produced : Union[None, float], timestamp : datetime, start : float) -> None:
+        assert self._lock.locked()
+        trace=DecisionTrace(timestamp, watt_obtained_from_provider, watt_produced, self._base_load)
+        evaluated=self._evaluate(watt_produced)
+        trace.timings_in_ms['evaluate']=(time.perf_counter()-start)*1000
+        handle_start=time.perf_counter()
+        deadline=handle_start + self._evaluation_deadline.total_seconds() if self._evaluation_deadline else float('inf')
+        self._watchdog.bind()
+        if evaluated:
+            trace.median=self._latest_mean
+            trace.forecast=self._latest_forecast
+            trace.break_even=self._break_even
+            trace.branch='turn_on' if self._having_overproduction else 'turn_off'
+            await self._handle_turn_on_plug(trace, deadline) if self._having_overproduction else await self._handle_turn_off_plug(trace, deadline)
+            trace.timings_in_ms[trace.branch]=(time.perf_counter()-handle_start)*1000
+        if self._deferrable_loads:
+            # NOTE: deferrable plugs are handled even if the values are not sufficient for an evaluation. Their deadline has to be kept.
+            deferrable_start=time.perf_counter()
+            await self._handle_deferrable_plugs(trace, deadline)
+            trace.timings_in_ms['deferrable']=(time.perf_counter()-deferrable_start)*1000
+        trace.timings_in_ms['total']=(time.perf_counter()-start)*1000
+        self._decisions.append(trace)
+        self._ingestion_counters['evaluations']+=1
+        self._publish()
+
+    async def ingest_smart_meter_values(self, watt_obtained_from_provider : float, watt_produced : Union[None, float] = None, timestamp : Union[None, datetime] = None):
+        """
+        Entry point for smart meter values of the API. Returns after the values have been evaluated.
+        Raises PendingLimitExceeded in case too many values are waiting to be evaluated (backpressure).
+        With coalescing enabled, values are added to the rolling values at once. 
+        Only the newest values are evaluated, intermediate evaluations are skipped.
+        """
+        if self._pending >= self._max_pending:
+            self._ingestion_counters['rejected']+=1
+            raise PendingLimitExceeded(f"{self._pending} smart meter values are waiting to be evaluated")
+        self._pending+=1
+        try:
+            if self._coalesce:
+                await self._add_coalesced(watt_obtained_from_provider, watt_produced, timestamp)
+            else:
+                await self.add_smart_meter_values(watt_obtained_from_provider, watt_produced, timestamp)
+        finally:
+            self._pending-=1
+
+    async def _add_coalesced(self, watt_obtained_from_provider : float, watt_produced : Union[None, float], timestamp : Union[None, datetime]) -> None:
+        # NOTE: adding values does not need the lock. Evaluations only read the rolling values synchronously.
+        timestamp=timestamp if timestamp else self._clock.now()
+        self._add_values(watt_obtained_from_provider, watt_produced, timestamp)
+        if self._latest_values is not None:
+            # the values added before have not been evaluated yet and never will be
+            self._ingestion_counters['skipped_evaluations']+=1
+        self._latest_values=(watt_obtained_from_provider, watt_produced, timestamp)
+        if self._next_evaluation is None:
+            self._next_evaluation=asyncio.get_running_loop().create_future()
+        next_evaluation=self._next_evaluation
+        if self._evaluator is None or self._evaluator.done():
+            self._evaluator=asyncio.get_running_loop().create_task(self._evaluate_latest())
+        # NOTE: All requests which added values in the meantime share this evaluation
+        await asyncio.shield(next_evaluation)
+
+    async def _evaluate_latest(self) -> None:
+        future : Union[None, asyncio.Future] = None
+        try:
+            while self._latest_values is not None and self._next_evaluation is not None:
+                async with self._lock:
+                    values, self._latest_values=self._latest_values, None
+                    future, self._next_evaluation=self._next_evaluation, None
+                    try:
+                        await self._evaluate_and_handle_plugs(*values, time.perf_counter())
+                        future.set_result(None)
+                    except Exception as e:
+                        future.set_exception(e)
+                    future=None
+        finally:
+            # NOTE: the evaluator has been cancelled (e.g. on shutdown). The waiting requests must not hang.
+            # The next values start a new evaluator.
+            for pending in [future, self._next_evaluation]:
+                if pending is not None and not pending.done():
+                    pending.cancel()
+            self._latest_values=None
+            self._next_evaluation=None
+            self._evaluator=None
+
+    @property
+    def ingestion_metrics(self) -> Dict[str, Union[bool, int]]:
+        return {'coalesce': self._coalesce, 'pending': self._pending, 'max_pending': self._max_pending, **self._ingestion_counters}
+
+    @property
+    def latest_forecast(self) -> Union[None, float]:
+        """Watt obtained from the provider expected at the end of the forecast horizon (as of the latest evaluation)"""
+        return self._latest_forecast
+
+    @property
+    def clock(self) -> Clock:
+        return self._clock
+
+    @property
+    def decisions(self) -> List[DecisionTrace]:
+        """Latest evaluations (oldest first). The amount of kept evaluations is limited by decision_trace_size."""
+        return list(self._decisions)
+
+    @staticmethod
+    def from_config(logger : Logger, general : GeneralConfig, clock : Union[None, Clock] = None, 
+                    efficiency_tolerance : Union[None, float] = None) -> PlugManager:
+        """Creates a PlugManager without plugs. Used by the service and by the replay of recorded values."""
+        return PlugManager(logger, general.eval_time_in_min, general.default_base_load_in_watt, 
+                           decision_trace_size=general.decision_trace_size, clock=clock, 
+                           coalesce=general.coalesce_smart_meter_values, 
+                           max_pending=general.max_pending_smart_meter_values, 
+                           evaluation_deadline=timedelta(seconds=general.evaluation_deadline_in_sec) if general.evaluation_deadline_in_sec > 0 else None, 
+                           allocate_surplus=general.allocate_surplus, 
+                           forecast_horizon=general.forecast_horizon, 
+                           eval_time_limits=general.eval_time_limits, 
+                           volatility_reference_in_watt=general.volatility_reference_in_watt, 
+                           efficiency_tolerance=efficiency_tolerance)
 
     @staticmethod
-    def create(logger : Logger, cfg_parser : ConfigParser) -> PlugManager:
-        manager=PlugManager(logger, cfg_parser.general.eval_time_in_min, cfg_parser.general.default_base_load_in_watt)
+    def create(logger : Logger, cfg_parser : ConfigParser, clock : Union[None, Clock] = None, 
+               oh_connection : Union[None, OpenhabConnectionProtocol] = None) -> PlugManager:
+        manager=PlugManager.from_config(logger, cfg_parser.general, clock)
         for uuid in cfg_parser.plug_uuids:
             plug_cfg = cfg_parser.plug(uuid)
             plug_controller : Union[OpenHabPlugController, TapoPlugController, None]=None
             if plug_cfg.type == 'openhab':
                 plug_cfg = cast(OpenHabSmartPlugConfig, plug_cfg)
-                plug_controller = OpenHabPlugController(logger, plug_cfg)
+                plug_controller = OpenHabPlugController(logger, plug_cfg, manager.clock, oh_connection)
             else:
                 plug_cfg = cast(TapoSmartPlugConfig, plug_cfg)
-                plug_controller = TapoPlugController(logger, plug_cfg)
+                plug_controller = TapoPlugController(logger, plug_cfg, manager.clock)
             manager._add_plug_controller(uuid, plug_controller)
             logger.info(f"Added Plug Controller for plug with uuid {uuid} using these config values:")
             logger.info(plug_cfg)
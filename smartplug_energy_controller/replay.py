@@ -0,0 +1,253 @@
+"""
+Replay recorded smart meter values through the decision logic of the PlugManager.
+
+The plugs of the given config are replaced by simulated plugs which consume their expected consumption while being on.
+The recorded values are expected to be measured without the controlled plugs.
+Columns: timestamp (ISO 8601 or unix time in seconds), obtained (Watt obtained from the provider, negative values for feed-in),
+produced (Watt produced, optional).
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field, asdict, replace
+from datetime import datetime, timedelta
+from functools import cached_property
+from itertools import chain
+from pathlib import Path
+from typing import Deque, Dict, Iterable, Iterator, List, Tuple, Union
+
+from smartplug_energy_controller.config import ConfigParser, GeneralConfig, SmartPlugConfig
+from smartplug_energy_controller.plug_controller import PlugController
+from smartplug_energy_controller.plug_manager import PlugManager
+from smartplug_energy_controller.utils import Scheduler, VirtualClock
+
+Reading = Tuple[datetime, float, Union[None, float]]
+
+def _parse_timestamp(value : str) -> datetime:
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+def read_csv(file : Path) -> Iterator[Reading]:
+    with open(file, newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0] == 'timestamp':
+                continue
+            produced = row[2] if len(row) > 2 else ''
+            yield _parse_timestamp(row[0]), float(row[1]), float(produced) if produced != '' else None
+
+def read_parquet(file : Path) -> Iterator[Reading]:
+    # pyarrow is an optional dependency which is only needed to replay parquet files
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(file)
+    columns = [name for name in ['timestamp', 'obtained', 'produced'] if name in parquet_file.schema.names]
+    for batch in parquet_file.iter_batches(columns=columns):
+        data = batch.to_pydict()
+        produced_values = data.get('produced', [None]*batch.num_rows)
+        for timestamp, obtained, produced in zip(data['timestamp'], data['obtained'], produced_values):
+            yield (timestamp if isinstance(timestamp, datetime) else datetime.fromtimestamp(timestamp)), obtained, produced
+
+def read_readings(file : Path) -> Iterator[Reading]:
+    return read_parquet(file) if file.suffix == '.parquet' else read_csv(file)
+
+@dataclass(frozen=True)
+class ScheduleEntry:
+    timestamp : datetime
+    plug_uuid : str
+    state : str
+
+@dataclass()
+class PlugResult:
+    switch_count : int = 0
+    on_time_in_h : float = 0
+    consumption_in_kwh : float = 0
+
+@dataclass()
+class ReplayResult:
+    readings : int = 0
+    simulated_time_in_h : float = 0
+    processing_time_in_sec : float = 0
+    grid_draw_in_kwh : float = 0
+    grid_draw_without_plugs_in_kwh : float = 0
+    feed_in_in_kwh : float = 0
+    plug_consumption_in_kwh : float = 0
+    # energy consumed by the plugs which has not been obtained from the provider
+    self_consumption_in_kwh : float = 0
+    self_consumption_ratio : float = 0
+    switch_count : int = 0
+    # mean absolute error of the forecasted watt obtained from the provider (see forecast_horizon_in_sec)
+    forecast_count : int = 0
+    forecast_mae_in_watt : float = 0
+    plugs : Dict[str, PlugResult] = field(default_factory=dict)
+    schedule : List[ScheduleEntry] = field(default_factory=list)
+
+class SimulatedPlugController(PlugController):
+    def __init__(self, logger : logging.Logger, plug_cfg : SmartPlugConfig, uuid : str, replay : 'Replay', clock : VirtualClock) -> None:
+        super().__init__(logger, plug_cfg, clock)
+        self._uuid=uuid
+        self._replay=replay
+        self._is_on=False
+        self._known_state=False
+
+    @cached_property
+    def info(self) -> Dict[str, str]:
+        return {'type': 'simulated'}
+
+    def reset(self) -> None:
+        pass
+
+    async def is_online(self) -> bool:
+        return True
+
+    async def is_on(self) -> bool:
+        return self._is_on
+
+    def _switch(self, on : bool) -> None:
+        if self._is_on != on:
+            self._is_on=on
+            self._set_known_state(on)
+            self._replay.switched(self._uuid, on)
+
+    async def turn_on(self) -> bool:
+        await super().turn_on()
+        self._switch(True)
+        return True
+
+    async def turn_off(self) -> bool:
+        await super().turn_off()
+        self._switch(False)
+        return True
+
+class Replay():
+    """The PlugManager is created from the general config like in the service. Only the clock is simulated."""
+    def __init__(self, logger : logging.Logger, plug_cfgs : Dict[str, SmartPlugConfig], general : GeneralConfig,
+                 efficiency_tolerance : Union[None, float] = None, record_schedule : bool = True) -> None:
+        self._logger=logger
+        self._plug_cfgs=plug_cfgs
+        self._general=general
+        self._efficiency_tolerance=efficiency_tolerance
+        self._record_schedule=record_schedule
+        self._forecast_horizon=general.forecast_horizon
+        self._result=ReplayResult()
+        self._clock=VirtualClock()
+
+    def switched(self, plug_uuid : str, on : bool) -> None:
+        self._result.plugs[plug_uuid].switch_count += 1
+        self._result.switch_count += 1
+        if self._record_schedule:
+            self._result.schedule.append(ScheduleEntry(self._clock.now(), plug_uuid, 'On' if on else 'Off'))
+
+    def _create_manager(self) -> Tuple[PlugManager, List[Tuple[str, SimulatedPlugController]]]:
+        manager=PlugManager.from_config(self._logger, self._general, self._clock, self._efficiency_tolerance)
+        controllers : List[Tuple[str, SimulatedPlugController]] = []
+        for uuid, plug_cfg in self._plug_cfgs.items():
+            controller=SimulatedPlugController(self._logger, plug_cfg, uuid, self, self._clock)
+            manager._add_plug_controller(uuid, controller)
+            controllers.append((uuid, controller))
+            self._result.plugs[uuid]=PlugResult()
+        return manager, controllers
+
+    async def run(self, readings : Iterable[Reading]) -> ReplayResult:
+        start=time.perf_counter()
+        iterator=iter(readings)
+        first=next(iterator, None)
+        if first is None:
+            return self._result
+        # the manager adds its initial (dummy) value at the current time of the clock
+        self._clock.set(first[0] - timedelta(seconds=1))
+        manager, controllers=self._create_manager()
+        scheduler=Scheduler(self._logger, self._clock)
+        scheduler.add_job(manager.set_base_load, timedelta(hours=1))
+        result=self._result
+        # values of the previous interval (watt obtained without plugs, consumption of each plug)
+        prev_timestamp=first[0]
+        prev_obtained=0.0
+        prev_loads : List[float] = [0.0]*len(controllers)
+        # (timestamp the forecast is made for, forecasted value)
+        forecasts : Deque[Tuple[datetime, float]] = deque()
+        forecast_error_sum=0.0
+        for timestamp, obtained, produced in chain([first], iterator):
+            result.readings += 1
+            # integrate the energy of the previous interval
+            dt_in_h=(timestamp - prev_timestamp).total_seconds()/3600
+            prev_load=sum(prev_loads)
+            net=prev_obtained + prev_load
+            result.grid_draw_in_kwh += max(0.0, net)*dt_in_h/1000
+            result.feed_in_in_kwh += max(0.0, -net)*dt_in_h/1000
+            result.grid_draw_without_plugs_in_kwh += max(0.0, prev_obtained)*dt_in_h/1000
+            result.plug_consumption_in_kwh += prev_load*dt_in_h/1000
+            for (uuid, _), load in zip(controllers, prev_loads):
+                if load > 0:
+                    plug_result=result.plugs[uuid]
+                    plug_result.on_time_in_h += dt_in_h
+                    plug_result.consumption_in_kwh += load*dt_in_h/1000
+
+            # the smart meter measures the consumption of the plugs as well (but no feed-in)
+            self._clock.set(timestamp)
+            measured=max(0.0, obtained + prev_load)
+            # compare forecasts with the first value measured at (or after) the forecasted time
+            while forecasts and forecasts[0][0] <= timestamp:
+                forecast_error_sum += abs(forecasts.popleft()[1] - measured)
+                result.forecast_count += 1
+            await manager.ingest_smart_meter_values(measured, produced, timestamp)
+            if self._forecast_horizon is not None and manager.latest_forecast is not None:
+                forecasts.append((timestamp + self._forecast_horizon, manager.latest_forecast))
+            await scheduler.run_due_jobs()
+            prev_timestamp=timestamp
+            prev_obtained=obtained
+            prev_loads=[controller.watt_consumed if controller._is_on else 0.0 for _, controller in controllers]
+
+        result.simulated_time_in_h=(prev_timestamp - first[0]).total_seconds()/3600
+        result.forecast_mae_in_watt=forecast_error_sum/result.forecast_count if result.forecast_count > 0 else 0
+        result.self_consumption_in_kwh=result.plug_consumption_in_kwh - (result.grid_draw_in_kwh - result.grid_draw_without_plugs_in_kwh)
+        result.self_consumption_ratio=result.self_consumption_in_kwh/result.plug_consumption_in_kwh if result.plug_consumption_in_kwh > 0 else 0
+        result.processing_time_in_sec=time.perf_counter() - start
+        return result
+
+def create_args_parser() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(description="Replay recorded smart meter values through the decision logic of smartplug-energy-controller")
+    parser.add_argument('config', type=Path, help="config.yml of smartplug-energy-controller. All plugs are simulated.")
+    parser.add_argument('input', type=Path, help="CSV or parquet file with the columns timestamp, obtained, produced")
+    parser.add_argument('--eval-time-in-min', type=int, default=None, help="Overrides eval_time_in_min of the config")
+    parser.add_argument('--efficiency-tolerance', type=float, default=None, help=f"Overrides the efficiency tolerance (default {PlugManager._efficiency_tolerance})")
+    parser.add_argument('--forecast-horizon-in-sec', type=float, default=None, help="Overrides forecast_horizon_in_sec of the config (0 disables the forecast)")
+    parser.add_argument('--schedule', type=Path, default=None, help="CSV file the plug schedule (switch events) is written to")
+    parser.add_argument('--output', type=Path, default=None, help="JSON file the summary is written to")
+    parser.add_argument('--log-level', type=int, default=logging.ERROR)
+    return parser
+
+def main() -> None:
+    args = create_args_parser().parse_args()
+    logging.basicConfig(stream=sys.stderr, level=args.log_level)
+    cfg_parser = ConfigParser(args.config, None)
+    general = cfg_parser.general
+    if args.eval_time_in_min:
+        general = replace(general, eval_time_in_min=args.eval_time_in_min)
+    if args.forecast_horizon_in_sec is not None:
+        general = replace(general, forecast_horizon_in_sec=args.forecast_horizon_in_sec)
+    replay = Replay(logging.getLogger('smartplug-energy-controller-replay'), 
+                    {uuid: cfg_parser.plug(uuid) for uuid in cfg_parser.plug_uuids},
+                    general, args.efficiency_tolerance, record_schedule=args.schedule is not None)
+    result = asyncio.run(replay.run(read_readings(args.input)))
+    if args.schedule:
+        with open(args.schedule, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['timestamp', 'plug_uuid', 'state'])
+            for entry in result.schedule:
+                writer.writerow([entry.timestamp.isoformat(), entry.plug_uuid, entry.state])
+    summary = asdict(result)
+    summary.pop('schedule')
+    summary['readings_per_sec'] = result.readings/result.processing_time_in_sec if result.processing_time_in_sec > 0 else 0
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == '__main__':
+    main()
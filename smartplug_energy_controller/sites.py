@@ -0,0 +1,72 @@
+from logging import Logger
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Union
+
+from smartplug_energy_controller.config import ConfigParser
+from smartplug_energy_controller.plug_manager import PlugManager
+from smartplug_energy_controller.utils import Clock, ClientSessionPool, OpenhabConnection, OpenhabConnectionProtocol, deep_sizeof
+
+@dataclass()
+class Site:
+    name : str
+    cfg_parser : ConfigParser
+    manager : PlugManager
+    oh_connection : Union[None, OpenhabConnectionProtocol]
+
+class Sites():
+    """
+    Sites (e.g. households) served by one process (multi-site mode).
+    Each site has its own config, PlugManager (incl. lock) and openHAB connection.
+    All sites share the event loop, the clock and the http connection pool.
+    """
+    def __init__(self, logger : Logger, clock : Clock, session_pool : ClientSessionPool) -> None:
+        self._logger=logger
+        self._clock=clock
+        self._session_pool=session_pool
+        self._sites : Dict[str, Site] = {}
+
+    def add(self, name : str, cfg_parser : ConfigParser, oh_connection : Union[None, OpenhabConnectionProtocol] = None) -> Site:
+        if name in self._sites:
+            raise ValueError(f"Site {name} has already been added")
+        logger=self._logger.getChild(name)
+        if oh_connection is None and cfg_parser.oh_connection is not None:
+            oh_connection=OpenhabConnection(cfg_parser.oh_connection, logger, self._session_pool)
+        site=Site(name, cfg_parser, PlugManager.create(logger, cfg_parser, self._clock, oh_connection), oh_connection)
+        self._sites[name]=site
+        self._logger.info(f"Added site {name} with {len(cfg_parser.plug_uuids)} plugs")
+        return site
+
+    def load(self, config_dir : Path) -> None:
+        """Adds a site for each config file (<site>.yml) of the given directory"""
+        for file in sorted(config_dir.glob('*.yml')):
+            self.add(file.stem, ConfigParser(file, None))
+
+    def __getitem__(self, name : str) -> Site:
+        return self._sites[name]
+
+    def __contains__(self, name : str) -> bool:
+        return name in self._sites
+
+    def __len__(self) -> int:
+        return len(self._sites)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._sites.keys())
+
+    def memory_in_bytes(self, name : str) -> int:
+        # objects shared by all sites are not counted
+        return deep_sizeof(self._sites[name], (self._clock, self._session_pool, self._logger))
+
+    async def set_base_load(self) -> None:
+        for site in self._sites.values():
+            await site.manager.set_base_load()
+
+    async def resync_openhab_plugs(self) -> None:
+        for site in self._sites.values():
+            await site.manager.resync_openhab_plugs()
+
+    async def close(self) -> None:
+        for site in self._sites.values():
+            await site.manager.close()
@@ -0,0 +1,208 @@
+"""
+Parameter sweep over recorded smart meter values.
+
+Every combination of the given parameter grids is replayed (see replay.py) in a process pool using all CPU cores.
+The recorded values are shared with the worker processes via shared memory. Only the parameters are sent per task.
+The results are ranked by self-consumption (descending) and switch count (ascending).
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict, replace
+from datetime import datetime, timedelta
+from itertools import product
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+from smartplug_energy_controller.config import ConfigParser, GeneralConfig, SmartPlugConfig
+from smartplug_energy_controller.plug_manager import PlugManager
+from smartplug_energy_controller.replay import Replay, Reading, read_readings
+
+@dataclass(frozen=True)
+class SweepParameters:
+    eval_time_in_min : int
+    efficiency_tolerance : float
+    # (plug uuid, value) for each plug
+    consumer_efficiency : Tuple[Tuple[str, float], ...]
+    expected_consumption_in_watt : Tuple[Tuple[str, int], ...]
+
+@dataclass(frozen=True)
+class SweepResult:
+    parameters : SweepParameters
+    self_consumption_in_kwh : float
+    self_consumption_ratio : float
+    switch_count : int
+    grid_draw_in_kwh : float
+    feed_in_in_kwh : float
+    processing_time_in_sec : float
+
+def create_grid(plug_cfgs : Dict[str, SmartPlugConfig], eval_times_in_min : List[int], efficiency_tolerances : List[float],
+                consumer_efficiencies : Dict[str, List[float]], expected_consumptions : Dict[str, List[int]]) -> List[SweepParameters]:
+    """
+    Creates every combination of the given values.
+    Plugs without given consumer efficiencies/expected consumptions use the value of their config.
+    """
+    uuids=list(plug_cfgs.keys())
+    efficiency_grid=product(*[[(uuid, value) for value in consumer_efficiencies.get(uuid, [plug_cfgs[uuid].consumer_efficiency])] for uuid in uuids])
+    consumption_grid=product(*[[(uuid, value) for value in expected_consumptions.get(uuid, [plug_cfgs[uuid].expected_consumption_in_watt])] for uuid in uuids])
+    return [SweepParameters(eval_time, tolerance, efficiencies, consumptions)
+            for eval_time, tolerance, efficiencies, consumptions in product(eval_times_in_min, efficiency_tolerances, list(efficiency_grid), list(consumption_grid))]
+
+class SharedReadings():
+    """
+    Readings stored in shared memory blocks of chunk_size rows. Each row consists of three doubles:
+    seconds since the first timestamp, obtained and produced (NaN if not available).
+    The readings are streamed into the blocks. They are never held in memory as a whole (e.g. a year of 1 second values).
+    """
+    def __init__(self, readings : Iterable[Reading], chunk_size : int = 1024*1024) -> None:
+        self.chunk_size=chunk_size
+        self.count=0
+        self.start_time=datetime.min
+        self._blocks : List[SharedMemory] = []
+        rows : Union[None, memoryview[float]] = None
+        try:
+            for timestamp, obtained, produced in readings:
+                index=3*(self.count % chunk_size)
+                if index == 0:
+                    if rows is not None:
+                        rows.release()
+                    else:
+                        self.start_time=timestamp
+                    self._blocks.append(SharedMemory(create=True, size=3*8*chunk_size))
+                    rows=self._blocks[-1].buf.cast('d')
+                rows[index]=(timestamp - self.start_time).total_seconds()
+                rows[index + 1]=obtained
+                rows[index + 2]=produced if produced is not None else float('nan')
+                self.count+=1
+        except BaseException:
+            if rows is not None:
+                rows.release()
+            self.close()
+            raise
+        if rows is not None:
+            rows.release()
+        if self.count == 0:
+            raise ValueError("No readings given")
+
+    @property
+    def names(self) -> List[str]:
+        return [block.name for block in self._blocks]
+
+    def close(self) -> None:
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks=[]
+
+# state of a worker process
+_worker_blocks : List[SharedMemory] = []
+_worker_plug_cfgs : Dict[str, SmartPlugConfig] = {}
+_worker_general : GeneralConfig = GeneralConfig()
+_worker_readings : Tuple[int, int, datetime] = (0, 0, datetime.min)
+
+def _init_worker(shm_names : List[str], chunk_size : int, count : int, start_time : datetime, 
+                 plug_cfgs : Dict[str, SmartPlugConfig], general : GeneralConfig) -> None:
+    global _worker_blocks, _worker_plug_cfgs, _worker_general, _worker_readings
+    _worker_blocks=[SharedMemory(name=name) for name in shm_names]
+    _worker_plug_cfgs=plug_cfgs
+    _worker_general=general
+    _worker_readings=(count, chunk_size, start_time)
+
+def _iter_worker_readings() -> Iterator[Reading]:
+    count, chunk_size, start_time=_worker_readings
+    for block_index, block in enumerate(_worker_blocks):
+        rows=block.buf.cast('d')
+        try:
+            for index in range(0, 3*min(chunk_size, count - block_index*chunk_size), 3):
+                produced=rows[index + 2]
+                yield start_time + timedelta(seconds=rows[index]), rows[index + 1], None if produced != produced else produced
+        finally:
+            rows.release()
+
+def _run(parameters : SweepParameters) -> SweepResult:
+    efficiencies=dict(parameters.consumer_efficiency)
+    consumptions=dict(parameters.expected_consumption_in_watt)
+    plug_cfgs={uuid: replace(cfg, consumer_efficiency=efficiencies[uuid], expected_consumption_in_watt=consumptions[uuid])
+               for uuid, cfg in _worker_plug_cfgs.items()}
+    logger=logging.getLogger('smartplug-energy-controller-sweep')
+    replay=Replay(logger, plug_cfgs, replace(_worker_general, eval_time_in_min=parameters.eval_time_in_min),
+                  parameters.efficiency_tolerance, record_schedule=False)
+    result=asyncio.run(replay.run(_iter_worker_readings()))
+    return SweepResult(parameters, result.self_consumption_in_kwh, result.self_consumption_ratio, result.switch_count,
+                       result.grid_draw_in_kwh, result.feed_in_in_kwh, result.processing_time_in_sec)
+
+def rank(results : Iterable[SweepResult]) -> List[SweepResult]:
+    return sorted(results, key=lambda result: (-result.self_consumption_in_kwh, result.switch_count))
+
+def sweep(readings : Iterable[Reading], plug_cfgs : Dict[str, SmartPlugConfig], general : GeneralConfig,
+          grid : List[SweepParameters], max_workers : Union[None, int] = None) -> List[SweepResult]:
+    shared_readings=SharedReadings(readings)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(shared_readings.names, shared_readings.chunk_size, shared_readings.count, shared_readings.start_time, 
+                                           plug_cfgs, general)) as executor:
+            return rank(executor.map(_run, grid))
+    finally:
+        shared_readings.close()
+
+def _parse_plug_values(values : List[str], plug_uuids : List[str], value_type : type) -> Dict[str, List]:
+    """Parses values of the form [UUID=]v1,v2,... Values without UUID are used for all plugs."""
+    result : Dict[str, List] = {}
+    for value in values:
+        uuid, _, grid = value.rpartition('=')
+        for plug_uuid in ([uuid] if uuid else plug_uuids):
+            if plug_uuid not in plug_uuids:
+                raise ValueError(f"Unknown plug uuid: {plug_uuid}")
+            result[plug_uuid]=[value_type(v) for v in grid.split(',')]
+    return result
+
+def create_args_parser() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(description="Parameter sweep over recorded smart meter values")
+    parser.add_argument('config', type=Path, help="config.yml of smartplug-energy-controller. All plugs are simulated.")
+    parser.add_argument('input', type=Path, help="CSV or parquet file with the columns timestamp, obtained, produced")
+    parser.add_argument('--eval-time-in-min', type=int, nargs='+', default=None)
+    parser.add_argument('--efficiency-tolerance', type=float, nargs='+', default=[PlugManager._efficiency_tolerance])
+    parser.add_argument('--consumer-efficiency', type=str, action='append', default=[],
+                        help="[UUID=]v1,v2,... Can be given multiple times. Without UUID the values are used for all plugs.")
+    parser.add_argument('--expected-consumption', type=str, action='append', default=[],
+                        help="[UUID=]v1,v2,... Can be given multiple times. Without UUID the values are used for all plugs.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--top', type=int, default=10, help="Number of best results that are printed")
+    parser.add_argument('--output', type=Path, default=None, help="CSV file all ranked results are written to")
+    return parser
+
+def main() -> None:
+    args=create_args_parser().parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+    cfg_parser=ConfigParser(args.config, None)
+    plug_cfgs={uuid: cfg_parser.plug(uuid) for uuid in cfg_parser.plug_uuids}
+    grid=create_grid(plug_cfgs, args.eval_time_in_min if args.eval_time_in_min else [cfg_parser.general.eval_time_in_min], args.efficiency_tolerance,
+                     _parse_plug_values(args.consumer_efficiency, cfg_parser.plug_uuids, float),
+                     _parse_plug_values(args.expected_consumption, cfg_parser.plug_uuids, int))
+    print(f"Evaluating {len(grid)} parameter combinations with {args.workers} workers", file=sys.stderr)
+    start=time.perf_counter()
+    results=sweep(read_readings(args.input), plug_cfgs, cfg_parser.general, grid, args.workers)
+    wall_time=time.perf_counter() - start
+    busy_time=sum(result.processing_time_in_sec for result in results)
+    print(f"Finished in {wall_time:.1f}s. Parallel efficiency: {busy_time/(wall_time*min(args.workers, len(grid)))*100:.0f}%", file=sys.stderr)
+    for result in results[:args.top]:
+        print(json.dumps(asdict(result)))
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer=csv.writer(f)
+            writer.writerow(['rank', 'self_consumption_in_kwh', 'self_consumption_ratio', 'switch_count', 'grid_draw_in_kwh', 'feed_in_in_kwh',
+                             'eval_time_in_min', 'efficiency_tolerance', 'consumer_efficiency', 'expected_consumption_in_watt'])
+            for index, result in enumerate(results):
+                writer.writerow([index + 1, result.self_consumption_in_kwh, result.self_consumption_ratio, result.switch_count,
+                                 result.grid_draw_in_kwh, result.feed_in_in_kwh, result.parameters.eval_time_in_min, result.parameters.efficiency_tolerance,
+                                 json.dumps(dict(result.parameters.consumer_efficiency)), json.dumps(dict(result.parameters.expected_consumption_in_watt))])
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,33 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import List, Any, Dict, Protocol
-from logging import Logger
-import aiohttp
+from typing import TYPE_CHECKING, List, Any, Awaitable, Callable, Deque, Dict, Mapping, Protocol, Set, Tuple, TypeVar, Union
+from collections import deque
+from bisect import bisect_left, bisect_right, insort
+from logging import Logger, LogRecord
+from logging.handlers import QueueHandler
+from types import BuiltinFunctionType, FunctionType, MappingProxyType, ModuleType
+from uuid import uuid4
+import asyncio
+import copy
+import gc
+import heapq
+import math
+import sys
+import time
+import cProfile
+import pstats
+import io
+import json
+import logging
+import queue
 
 from smartplug_energy_controller.config import OpenHabConnectionConfig
 
+if TYPE_CHECKING:
+    # NOTE: imported where needed. Tools like the replay do not pay for importing them.
+    import aiohttp
+    from fastapi import Request, Response
+
 @dataclass(frozen=True)
 class SavingFromPlug():
     watt_value : float
@@ -41,7 +63,19 @@ class Ratio:
 class RollingValues:
     def __init__(self, window_time_delta : timedelta, init_values : List[ValueEntry] = []) -> None:
         self._time_delta = window_time_delta
-        self._values : List[ValueEntry] = init_values.copy()
+        self._values : Deque[ValueEntry] = deque()
+        # Weighted value (value * time since the previous value) of each value except the first one.
+        # Entries are (weighted value, sequence number, value). _sorted_weights is kept sorted to get the median in O(log n).
+        self._weights : Deque[Tuple[float, int, float]] = deque()
+        self._sorted_weights : List[Tuple[float, int, float]] = []
+        self._seq = 0
+        # sums of the (shifted) weighted values to get the variance in O(1). Recalculated from time to time to avoid rounding errors.
+        self._shift = 0.0
+        self._sum = 0.0
+        self._sum_of_squares = 0.0
+        self._removed_since_recalculation = 0
+        for value in init_values:
+            self.add(value)
 
     def value_count(self) -> int:
         return len(self._values)
@@ -52,14 +86,50 @@ class RollingValues:
     def time_delta(self) -> timedelta:
         return self._time_delta
 
+    def set_time_delta(self, window_time_delta : timedelta) -> None:
+        """Values outside of a shorter window are dropped at once. A longer window is filled by the values added afterwards."""
+        self._time_delta = window_time_delta
+        self._trim()
+
+    def variance(self) -> float:
+        """Variance of the values within the window (except the first one)"""
+        if len(self._weights) < 2:
+            return 0.0
+        mean = self._sum/len(self._weights)
+        return max(0.0, self._sum_of_squares/len(self._weights) - mean*mean)
+
+    def _recalculate_sums(self) -> None:
+        self._shift = self._weights[0][2] if self._weights else 0.0
+        self._sum = sum(weight[2] - self._shift for weight in self._weights)
+        self._sum_of_squares = sum((weight[2] - self._shift)**2 for weight in self._weights)
+        self._removed_since_recalculation = 0
+
+    def _trim(self) -> None:
+        while self._values[-1].timestamp - self._values[0].timestamp >= self._time_delta:
+            self._values.popleft()
+            # the new first value is not weighted anymore (the value before is unknown)
+            weight = self._weights.popleft()
+            del self._sorted_weights[bisect_left(self._sorted_weights, weight)]
+            self._sum -= weight[2] - self._shift
+            self._sum_of_squares -= (weight[2] - self._shift)**2
+            self._removed_since_recalculation += 1
+        # NOTE: amortized O(1) since the sums are recalculated after (at least) as many removals as there are values
+        if self._removed_since_recalculation > len(self._weights):
+            self._recalculate_sums()
+
     def add(self, value : ValueEntry):
         if len(self._values) != 0:
             assert value.timestamp > self._values[-1].timestamp, "Timestamps must be in ascending order"
+            self._seq += 1
+            weight = (value.value*(value.timestamp - self._values[-1].timestamp).total_seconds(), self._seq, value.value)
+            self._weights.append(weight)
+            insort(self._sorted_weights, weight)
+            self._sum += value.value - self._shift
+            self._sum_of_squares += (value.value - self._shift)**2
         
         # append value and trim list according to time delta
         self._values.append(value)
-        while self._values[-1].timestamp - self._values[0].timestamp >= self._time_delta:
-            self._values = self._values[1:]
+        self._trim()
 
     def ratio(self, threshold_value : float) -> Ratio:
         assert len(self._values) > 1, "Not enough values to calculate ratio"
@@ -74,44 +144,577 @@ class RollingValues:
     
     def _calc_weighted_values(self) -> List[float]:
         assert len(self._values) > 1, "Not enough values to calculate weighted values"
-        weighted_values : List[float] = []
         total_time_range = (self._values[-1].timestamp - self._values[0].timestamp).total_seconds()
-        for index in range(1, len(self._values)):
-            relative_value = self._values[index].value*(self._values[index].timestamp - self._values[index-1].timestamp).total_seconds()
-            weighted_values.append(relative_value/total_time_range)
-        return weighted_values
+        return [weighted_value/total_time_range for weighted_value, _, _ in self._weights]
 
     def mean(self) -> float:
         return sum(self._calc_weighted_values())
     
     def median(self) -> float:
-        weighted_values = self._calc_weighted_values()
-        median_index = weighted_values.index(sorted(weighted_values)[len(weighted_values)//2]) # use floor division operator
-        return self._values[median_index+1].value
+        assert len(self._values) > 1, "Not enough values to calculate the median"
+        median_weight = self._sorted_weights[len(self._sorted_weights)//2][0] # use floor division operator
+        # in case of equal weighted values the oldest value is used
+        return self._sorted_weights[bisect_left(self._sorted_weights, (median_weight,))][2]
+
+@dataclass()
+class PlugDecision:
+    uuid : str
+    # result of the check, e.g. 'offline', 'on', 'off', 'below_threshold', 'above_threshold', 'turned_on', 'turn_on_failed', 'locked', 'timeout', 'deadline_exceeded'
+    result : str = ''
+    duration_in_ms : float = 0
+
+@dataclass()
+class DecisionTrace:
+    timestamp : datetime
+    watt_obtained_from_provider : float
+    watt_produced : Union[None, float]
+    base_load : float
+    median : Union[None, float] = None
+    break_even : Union[None, float] = None
+    # branch taken during the evaluation: 'not_evaluated', 'turn_on' or 'turn_off'
+    branch : str = 'not_evaluated'
+    plugs : List[PlugDecision] = field(default_factory=list)
+    timings_in_ms : Dict[str, float] = field(default_factory=dict)
+    # True in case some plugs have not been checked since the time budget of the evaluation has been used up
+    deadline_exceeded : bool = False
+    # expected watt obtained from the provider at the end of the forecast horizon (None if forecasting is disabled)
+    forecast : Union[None, float] = None
+
+# NOTE: changes with every start. Thus ETags of a previous run never match (versions start at 0 again).
+_ETAG_EPOCH=uuid4().hex[:8]
+
+@dataclass(frozen=True)
+class StateSnapshot:
+    """
+    Immutable, versioned state. A new snapshot is published by replacing the reference to the previous one.
+    Thus readers never need a lock and never see a partially updated state.
+    """
+    version : int = 0
+    state : Mapping[str, Any] = field(default_factory=lambda: MappingProxyType({}))
+
+    def next(self, state : Dict[str, Any]) -> 'StateSnapshot':
+        return StateSnapshot(self.version+1, MappingProxyType(state))
+
+    def etag(self, *extra : str) -> str:
+        return '"' + '-'.join([_ETAG_EPOCH, str(self.version), *extra]) + '"'
+
+def etag_matches(if_none_match : Union[None, str], etag : str) -> bool:
+    if not if_none_match:
+        return False
+    tags=[tag.strip() for tag in if_none_match.split(',')]
+    # weak comparison (RFC 9110)
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
+def versioned_response(request : 'Request', etag : str, content : Any) -> 'Response':
+    """Empty 304 response in case the client already knows this version (If-None-Match), the content otherwise"""
+    from fastapi import Response
+    from fastapi.responses import JSONResponse
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    return JSONResponse(content, headers={'ETag': etag})
+
+class Profiler():
+    """
+    Opt-in profiler for the running event loop. Everything executed in the thread that started the profiler is captured.
+    Supported backends are 'cprofile' and 'pyinstrument' (needs the optional pyinstrument package).
+    """
+    def __init__(self) -> None:
+        self._backend : Union[None, str] = None
+        self._profiler : Any = None
+
+    @property
+    def running(self) -> bool:
+        return self._profiler is not None
+
+    def start(self, backend : str = 'cprofile') -> None:
+        if self.running:
+            raise RuntimeError("Profiler is already running.")
+        if backend == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif backend == 'pyinstrument':
+            from pyinstrument import Profiler as PyinstrumentProfiler
+            self._profiler = PyinstrumentProfiler(async_mode='disabled')
+            self._profiler.start()
+        else:
+            raise ValueError(f"Unknown profiler backend: {backend}")
+        self._backend = backend
+
+    def stop(self, sort_by : str = 'cumulative', limit : int = 50) -> str:
+        if not self.running:
+            raise RuntimeError("Profiler is not running.")
+        profiler, self._profiler = self._profiler, None
+        if self._backend == 'pyinstrument':
+            profiler.stop()
+            return profiler.output_text()
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats(sort_by).print_stats(limit)
+        return stream.getvalue()
+
+_exception_formatter=logging.Formatter()
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands the log records over to a bounded queue (see logging.handlers.QueueListener). Logging never blocks the caller.
+    Records are dropped in case the queue is full (e.g. the disk is too slow). The amount of dropped records is logged as 
+    soon as the queue has room again.
+    """
+    def __init__(self, queue_size : int) -> None:
+        # NOTE: the size is limited by the handler instead of the queue. The sentinel of QueueListener.stop has to fit in any case.
+        self._queue : queue.Queue=queue.Queue()
+        super().__init__(self._queue)
+        self._queue_size=queue_size
+        self._dropped=0
+        self._dropped_since_report=0
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def emit(self, record : LogRecord) -> None:
+        # NOTE: checked before the record is prepared. Dropped records are not formatted at all.
+        if self._queue.qsize() >= self._queue_size:
+            self._dropped+=1
+            self._dropped_since_report+=1
+            return
+        super().emit(record)
+
+    def prepare(self, record : LogRecord) -> LogRecord:
+        # NOTE: the message is formatted by the caller (like the stdlib does). The arguments could be changed afterwards.
+        # Formatting the record (e.g. as json) and the I/O are left to the handlers of the listener (other thread).
+        record=copy.copy(record)
+        record.msg=record.getMessage()
+        record.args=None
+        if record.exc_info and not record.exc_text:
+            record.exc_text=_exception_formatter.formatException(record.exc_info)
+        return record
+
+    def enqueue(self, record : LogRecord) -> None:
+        if self._dropped_since_report > 0:
+            self._queue.put_nowait(logging.makeLogRecord({'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                                         'msg': "Dropped %s log records. The log handler is too slow.", 
+                                                         'args': (self._dropped_since_report,)}))
+            self._dropped_since_report=0
+        self._queue.put_nowait(record)
+
+class JsonFormatter(logging.Formatter):
+    """One json object per record (structured logging)"""
+    def format(self, record : LogRecord) -> str:
+        entry={'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text=self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception']=record.exc_text
+        return json.dumps(entry)
+
+class Clock(Protocol):
+    def now(self) -> datetime: ...
+    async def sleep(self, seconds : float) -> None: ...
+
+class MonotonicClock():
+    """Wall-clock time at creation advanced by time.monotonic(). Does not jump on NTP or DST changes."""
+    def __init__(self) -> None:
+        self._start=datetime.now()
+        self._start_monotonic=time.monotonic()
+
+    def now(self) -> datetime:
+        return self._start + timedelta(seconds=time.monotonic() - self._start_monotonic)
+
+    async def sleep(self, seconds : float) -> None:
+        await asyncio.sleep(seconds)
+
+class VirtualClock():
+    """
+    Clock which is only advanced explicitly, e.g. to replay or simulate days within seconds.
+    Sleeping tasks are woken up as soon as the clock has been advanced beyond their wake-up time.
+    """
+    def __init__(self, start : Union[None, datetime] = None) -> None:
+        self._now=start if start else datetime(2000, 1, 1)
+        # (wake-up time, sequence number, future) as heap
+        self._sleepers : List[Tuple[datetime, int, asyncio.Future]] = []
+        self._seq=0
+
+    def now(self) -> datetime:
+        return self._now
+
+    def set(self, timestamp : datetime) -> None:
+        if timestamp < self._now:
+            raise ValueError(f"Virtual time must not go backwards ({timestamp} < {self._now})")
+        self._now=timestamp
+        while self._sleepers and self._sleepers[0][0] <= timestamp:
+            future=heapq.heappop(self._sleepers)[2]
+            if not future.done():
+                future.set_result(None)
+
+    def advance(self, time_delta : timedelta) -> None:
+        self.set(self._now + time_delta)
+
+    async def sleep(self, seconds : float) -> None:
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        self._seq += 1
+        future=asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self._now + timedelta(seconds=seconds), self._seq, future))
+        await future
+
+@dataclass()
+class ScheduledJob:
+    func : Callable[[], Awaitable[None]]
+    interval : timedelta
+    next_run_time : datetime
+
+class Scheduler():
+    """Runs async jobs periodically according to the given clock."""
+    def __init__(self, logger : Logger, clock : Clock) -> None:
+        self._logger=logger
+        self._clock=clock
+        self._jobs : List[ScheduledJob] = []
+        self._task : Union[None, asyncio.Task] = None
+
+    def add_job(self, func : Callable[[], Awaitable[None]], interval : timedelta) -> None:
+        self._jobs.append(ScheduledJob(func, interval, self._clock.now() + interval))
+
+    async def run_due_jobs(self) -> None:
+        now=self._clock.now()
+        for job in self._jobs:
+            if job.next_run_time <= now:
+                job.next_run_time=now + job.interval
+                try:
+                    await job.func()
+                except Exception as e:
+                    self._logger.exception(f"Caught Exception while running scheduled job {job.func.__name__}: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await self.run_due_jobs()
+            next_run_time=min((job.next_run_time for job in self._jobs), default=self._clock.now() + timedelta(minutes=1))
+            await self._clock.sleep((next_run_time - self._clock.now()).total_seconds())
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task=asyncio.get_running_loop().create_task(self._run())
+
+    def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task=None
+
+class TimeoutWatchdog():
+    """
+    Timeouts for a sequence of requests (e.g. to the plugs during evaluations) using a single timer.
+    Unlike asyncio.timeout, arming does not schedule and cancel a timer each time. It only stores the expiry time.
+    The timer is moved only in case it would fire too late. In case it fires too early it is scheduled again.
+    The armed task is cancelled on expiry. Only one task may arm the watchdog at a time.
+    """
+    def __init__(self) -> None:
+        self._loop : Union[None, asyncio.AbstractEventLoop] = None
+        self._time : Callable[[], float] = time.monotonic
+        self._task : Union[None, asyncio.Task] = None
+        self._expiry : Union[None, float] = None
+        self._expired=False
+        self._handle : Union[None, asyncio.TimerHandle] = None
+        self._handle_when=float('inf')
+
+    def _schedule(self, when : float) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle=self._loop.call_at(when, self._on_timer) # type: ignore
+        self._handle_when=when
+
+    def _on_timer(self) -> None:
+        self._handle=None
+        self._handle_when=float('inf')
+        if self._expiry is None or self._task is None:
+            return
+        if self._time() >= self._expiry:
+            self._expired=True
+            self._task.cancel()
+        else:
+            self._schedule(self._expiry)
+
+    def bind(self) -> None:
+        """Binds the watchdog to the current task. Has to be called before arming it (e.g. once per evaluation)."""
+        loop=asyncio.get_running_loop()
+        if loop is not self._loop:
+            self.close()
+            self._loop=loop
+            self._time=loop.time
+        self._task=asyncio.current_task()
+
+    def arm(self, timeout : float) -> None:
+        self._expiry=expiry=self._time() + timeout
+        if self._handle_when > expiry:
+            self._schedule(expiry)
+
+    def disarm(self) -> None:
+        # NOTE: the timer keeps running. It stops as soon as it fires while being disarmed.
+        self._expiry=None
+        self._expired=False
+
+    def timed_out(self) -> bool:
+        """To be called on asyncio.CancelledError: True in case the watchdog (and nobody else) has cancelled the task"""
+        if not self._expired or self._task is None:
+            return False
+        self._expired=False
+        return self._task.uncancel() == 0
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle=None
+        self._handle_when=float('inf')
+
+class CircuitBreaker():
+    """
+    Skips requests to an unreachable device.
+    closed: requests are allowed. open: after failure_threshold consecutive failures requests are skipped until the backoff has passed.
+    half_open: a single probe is allowed. A failing probe opens the breaker again with twice the backoff (up to max_backoff).
+    """
+    def __init__(self, clock : Clock, failure_threshold : int = 3, backoff : timedelta = timedelta(seconds=30), 
+                 max_backoff : timedelta = timedelta(minutes=30), on_change : Union[None, Callable[[], None]] = None) -> None:
+        assert failure_threshold >= 1
+        self._clock=clock
+        self._failure_threshold=failure_threshold
+        self._initial_backoff=backoff
+        self._max_backoff=max_backoff
+        self._on_change=on_change
+        self._state='closed'
+        self._failures=0
+        self._backoff=backoff
+        self._open_until : Union[None, datetime] = None
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def failures(self) -> int:
+        return self._failures
+
+    @property
+    def open_until(self) -> Union[None, datetime]:
+        return self._open_until
+
+    def _set_state(self, state : str) -> None:
+        if self._state != state:
+            self._state=state
+            if self._on_change is not None:
+                self._on_change()
+
+    def allow(self) -> bool:
+        if self._state == 'closed':
+            return True
+        if self._state == 'open' and self._open_until is not None and self._clock.now() >= self._open_until:
+            self._set_state('half_open')
+            return True
+        # NOTE: only one probe at a time while half open
+        return False
+
+    def record_success(self) -> None:
+        self._failures=0
+        self._backoff=self._initial_backoff
+        self._open_until=None
+        self._set_state('closed')
+
+    def record_failure(self) -> None:
+        self._failures+=1
+        if self._state == 'half_open':
+            self._backoff=min(self._backoff*2, self._max_backoff)
+        elif self._state == 'open' or self._failures < self._failure_threshold:
+            return
+        self._open_until=self._clock.now() + self._backoff
+        self._set_state('open')
+
+class TrendForecaster():
+    """
+    Exponentially weighted level and linear trend (Holt's linear method) of irregularly sampled values. O(1) per value.
+    The weight of older values decays with the given time constants. The trend is extrapolated to forecast future values.
+    """
+    def __init__(self, level_time_constant : timedelta, trend_time_constant : timedelta) -> None:
+        self.set_time_constants(level_time_constant, trend_time_constant)
+        self._level : Union[None, float] = None
+        self._trend_per_sec : float = 0
+        self._timestamp=datetime.min
+
+    def set_time_constants(self, level_time_constant : timedelta, trend_time_constant : timedelta) -> None:
+        """Applies to the values added afterwards. The current level and trend are kept."""
+        self._level_time_constant=level_time_constant.total_seconds()
+        self._trend_time_constant=trend_time_constant.total_seconds()
+
+    @property
+    def level(self) -> Union[None, float]:
+        return self._level
+
+    @property
+    def trend_per_sec(self) -> float:
+        return self._trend_per_sec
+
+    def add(self, value : float, timestamp : datetime) -> None:
+        if self._level is None:
+            self._level=value
+            self._timestamp=timestamp
+            return
+        dt=(timestamp - self._timestamp).total_seconds()
+        if dt <= 0:
+            # NOTE: values need to be added in ascending order. Values with the same timestamp are ignored.
+            return
+        predicted=self._level + self._trend_per_sec*dt
+        level=predicted + (1 - math.exp(-dt/self._level_time_constant))*(value - predicted)
+        self._trend_per_sec+=(1 - math.exp(-dt/self._trend_time_constant))*((level - self._level)/dt - self._trend_per_sec)
+        self._level=level
+        self._timestamp=timestamp
+
+    def forecast(self, horizon : timedelta) -> Union[None, float]:
+        """Expected value at the time of the latest value + horizon. None in case no value has been added yet."""
+        if self._level is None:
+            return None
+        return self._level + self._trend_per_sec*horizon.total_seconds()
+
+class PriorityIndex():
+    """
+    Sorted priorities (0 = highest prio) of the plugs which are candidates for being turned on (off) resp. off (on).
+    A plug with unknown state is part of both sets. Disabled plugs are part of none.
+    Finding the next candidate is O(log n). No request to any plug is needed.
+    """
+    def __init__(self) -> None:
+        self._on : List[int] = []
+        self._off : List[int] = []
+
+    @staticmethod
+    def _set(priorities : List[int], priority : int, contained : bool) -> None:
+        index=bisect_left(priorities, priority)
+        present=index < len(priorities) and priorities[index] == priority
+        if contained and not present:
+            priorities.insert(index, priority)
+        elif not contained and present:
+            del priorities[index]
+
+    def update(self, priority : int, enabled : bool, is_on : Union[None, bool]) -> None:
+        self._set(self._on, priority, enabled and is_on is not False)
+        self._set(self._off, priority, enabled and is_on is not True)
+
+    def next_off(self, after : int = -1) -> Union[None, int]:
+        """Highest prio of the plugs (possibly) off with a lower prio than after"""
+        index=bisect_right(self._off, after)
+        return self._off[index] if index < len(self._off) else None
+
+    def next_on(self, before : Union[None, int] = None) -> Union[None, int]:
+        """Lowest prio of the plugs (possibly) on with a higher prio than before"""
+        index=bisect_left(self._on, before) if before is not None else len(self._on)
+        return self._on[index-1] if index > 0 else None
+
+def deep_sizeof(obj : Any, shared : Tuple[Any, ...] = ()) -> int:
+    """
+    Approximate memory in bytes of all objects reachable from obj.
+    The given shared objects (and everything only reachable via them), types, modules, functions, loggers and event loops are not counted.
+    """
+    seen = set(id(o) for o in shared)
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, ModuleType, FunctionType, BuiltinFunctionType, Logger, asyncio.AbstractEventLoop)):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        stack.extend(gc.get_referents(o))
+    return size
+
+class ClientSessionPool():
+    """
+    aiohttp.ClientSession (and therefore connection pool) shared by several connections.
+    The session is created lazily since it has to be created within the running event loop.
+    """
+    def __init__(self, limit : int = 100) -> None:
+        self._limit=limit
+        self._session : Union[None, 'aiohttp.ClientSession'] = None
+
+    @property
+    def session(self) -> 'aiohttp.ClientSession':
+        import aiohttp
+        if self._session is None or self._session.closed:
+            self._session=aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._limit))
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session=None
+
+def parse_number_state(state : Union[None, str]) -> Union[None, float]:
+    """Value of the state of an openHAB number item. None in case the state is no number (e.g. NULL or UNDEF)."""
+    # NOTE: states of number items with a unit contain the unit (e.g. '123.4 W')
+    if state is None:
+        return None
+    try:
+        return float(state.split(' ')[0])
+    except ValueError:
+        return None
+
+ItemAndThingStates = Tuple[Dict[str, str], Dict[str, str]]
+T = TypeVar('T')
 
 class OpenhabConnectionProtocol(Protocol):
     async def post_to_item(self, oh_item_name : str, value : Any) -> bool: ...
+    async def read_states(self, item_names : Set[str], thing_uids : Set[str]) -> Union[None, ItemAndThingStates]: ...
         
 class OpenhabConnection():
-    def __init__(self, oh_con_cfg : OpenHabConnectionConfig, logger : Logger) -> None:
+    def __init__(self, oh_con_cfg : OpenHabConnectionConfig, logger : Logger, session_pool : Union[None, ClientSessionPool] = None) -> None:
         self._oh_url=oh_con_cfg.oh_url
         self._logger=logger
+        import aiohttp
         self._auth=aiohttp.BasicAuth(oh_con_cfg.oh_user, oh_con_cfg.oh_password) if oh_con_cfg.oh_user != '' else None
+        self._session_pool=session_pool
 
-    async def post_to_item(self, oh_item_name : str, value : Any) -> bool:
+    async def _post(self, session : 'aiohttp.ClientSession', oh_item_name : str, value : Any) -> bool:
+        async with session.post(url=f"{self._oh_url}/rest/items/{oh_item_name}", data=str(value), ssl=False,
+                                auth=self._auth, headers={'Content-Type': 'text/plain'}) as response:
+            if response.status != 200:
+                self._logger.warning(f"Failed to post value to openhab item {oh_item_name}. Return code: {response.status}. text: {await response.text()})")
+                return False
+        return True
+
+    async def _get(self, session : 'aiohttp.ClientSession', path : str, params : Dict[str, str]) -> Any:
+        async with session.get(url=f"{self._oh_url}/rest/{path}", params=params, ssl=False, auth=self._auth) as response:
+            if response.status != 200:
+                self._logger.warning(f"Failed to read /rest/{path} of openhab. Return code: {response.status}. text: {await response.text()})")
+                return None
+            return await response.json()
+
+    async def _read_states(self, session : 'aiohttp.ClientSession', item_names : Set[str], thing_uids : Set[str]) -> Union[None, ItemAndThingStates]:
+        # NOTE: the items resp. things can not be filtered by name. Only the needed fields are requested.
+        items=await self._get(session, 'items', {'fields': 'name,state', 'recursive': 'false'}) if item_names else []
+        things=await self._get(session, 'things', {'summary': 'true'}) if thing_uids else []
+        if items is None or things is None:
+            return None
+        return ({item['name']: item['state'] for item in items if item['name'] in item_names}, 
+                {thing['UID']: thing['statusInfo']['status'] for thing in things if thing['UID'] in thing_uids})
+
+    async def _request(self, request : Callable[['aiohttp.ClientSession'], Awaitable[T]], default : T) -> T:
+        import aiohttp
         try:
-            async with aiohttp.ClientSession(auth=self._auth, headers={'Content-Type': 'text/plain'}) as session:
-                async with session.post(url=f"{self._oh_url}/rest/items/{oh_item_name}", data=str(value), ssl=False) as response:
-                    if response.status != 200:
-                        self._logger.warning(f"Failed to post value to openhab item {oh_item_name}. Return code: {response.status}. text: {await response.text()})")
-                        return False
+            if self._session_pool is not None:
+                return await request(self._session_pool.session)
+            async with aiohttp.ClientSession() as session:
+                return await request(session)
+        except asyncio.CancelledError:
+            # NOTE: e.g. the TimeoutWatchdog of the evaluation. Swallowing it would hide the timeout (and leak the cancel request).
+            raise
         except aiohttp.ClientError as e:
-            self._logger.warning("Caught Exception while posting to openHAB: " + str(e))
-            return False
+            self._logger.warning("Caught Exception while requesting openHAB: " + str(e))
+            return default
         except Exception as e:
             self._logger.exception("Caught Exception: " + str(e))
-            return False
-        except:
-            self._logger.exception("Caught unknow exception")
-            return False
-        return True
\ No newline at end of file
+            return default
+
+    async def post_to_item(self, oh_item_name : str, value : Any) -> bool:
+        return await self._request(lambda session: self._post(session, oh_item_name, value), False)
+
+    async def read_states(self, item_names : Set[str], thing_uids : Set[str]) -> Union[None, ItemAndThingStates]:
+        """
+        States of the given items and status of the given things (one request for all items and one for all things).
+        Items resp. things unknown to openHAB are missing. None in case the states could not be read.
+        """
+        return await self._request(lambda session: self._read_states(session, item_names, thing_uids), None)
@@ -0,0 +1,429 @@
+"""
+Multi-worker mode.
+
+A single owner (running in the process of serve()) holds the PlugManager and does all evaluations and actuations.
+The uvicorn workers serve this app: reads are answered from a snapshot of the owner state in shared memory,
+writes are forwarded to the owner via a unix domain socket (one json object per line).
+"""
+import asyncio
+import json
+import mmap
+import struct
+import threading
+import time
+from dataclasses import asdict
+from datetime import datetime
+from logging import Logger
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Set, Tuple, Union
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic_settings import BaseSettings
+
+from smartplug_energy_controller.app import PlugValues, SmartMeterValues, _router
+from smartplug_energy_controller.plug_controller import OpenHabPlugController
+from smartplug_energy_controller.plug_manager import PlugManager, PendingLimitExceeded
+from smartplug_energy_controller.utils import DecisionTrace, Profiler, Scheduler, versioned_response
+
+if TYPE_CHECKING:
+    from smartplug_energy_controller.openhab_events import OpenHabEventStream
+
+# sequence number (odd while being written) and length of the payload
+_HEADER = struct.Struct('<QQ')
+
+class SnapshotWriter():
+    """
+    Publishes json snapshots into a memory mapped file. Readers detect concurrent writes via the sequence number (seqlock).
+    The file grows in case a snapshot exceeds the capacity. Readers map the file again once the length exceeds their mapping.
+    """
+    def __init__(self, file : Path, capacity : int = 4*1024*1024) -> None:
+        with open(file, 'wb') as f:
+            f.truncate(_HEADER.size + capacity)
+        self._file=open(file, 'r+b')
+        self._mmap=mmap.mmap(self._file.fileno(), 0)
+        self._capacity=capacity
+        self._seq=0
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def write(self, value : Any) -> None:
+        payload=json.dumps(value, default=str).encode()
+        struct.pack_into('<Q', self._mmap, 0, self._seq + 1)
+        if len(payload) > self._capacity:
+            # NOTE: the file only grows. The mappings of the readers stay valid for the previous size.
+            while len(payload) > self._capacity:
+                self._capacity*=2
+            # resizes the file as well
+            self._mmap.resize(_HEADER.size + self._capacity)
+        self._mmap[_HEADER.size:_HEADER.size + len(payload)]=payload
+        struct.pack_into('<Q', self._mmap, 8, len(payload))
+        self._seq += 2
+        struct.pack_into('<Q', self._mmap, 0, self._seq)
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+class SnapshotReader():
+    _max_backoff_in_sec=0.001
+
+    def __init__(self, file : Path, timeout_in_sec : float = 1) -> None:
+        self._file=file
+        self._timeout_in_sec=timeout_in_sec
+        self._mmap : Union[None, mmap.mmap] = None
+        # the parsed snapshot is cached until a new one has been published
+        self._seq=0
+        self._value : Dict[str, Any] = {}
+
+    def _map(self) -> mmap.mmap:
+        if self._mmap is not None:
+            self._mmap.close()
+        with open(self._file, 'rb') as f:
+            self._mmap=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def read(self) -> Dict[str, Any]:
+        """Raises RuntimeError in case no consistent snapshot can be read within the timeout (e.g. none has been published yet)"""
+        snapshot=self._mmap if self._mmap is not None else self._map()
+        deadline=time.monotonic() + self._timeout_in_sec
+        backoff_in_sec=0.0
+        while True:
+            seq, length=_HEADER.unpack_from(snapshot, 0)
+            if seq != 0 and seq % 2 == 0:
+                if seq == self._seq:
+                    return self._value
+                if _HEADER.size + length > len(snapshot):
+                    # the file has grown
+                    snapshot=self._map()
+                    continue
+                payload=snapshot[_HEADER.size:_HEADER.size + length]
+                if _HEADER.unpack_from(snapshot, 0)[0] == seq:
+                    self._value=json.loads(payload)
+                    self._seq=seq
+                    return self._value
+            if time.monotonic() >= deadline:
+                raise RuntimeError("Unable to read a consistent snapshot")
+            # NOTE: the owner is writing. Yield the CPU to it first, then back off exponentially.
+            time.sleep(backoff_in_sec)
+            backoff_in_sec=min(max(2*backoff_in_sec, 0.00001), self._max_backoff_in_sec)
+
+class Owner():
+    """Holds the PlugManager in multi-worker mode. Runs its own event loop in a background thread."""
+    def __init__(self, logger : Logger, manager : PlugManager, scheduler : Scheduler, socket_path : Path, snapshot_file : Path,
+                 plug_refresh_in_sec : float = 5, event_stream : Union[None, 'OpenHabEventStream'] = None, 
+                 published_decisions : int = 20) -> None:
+        self._logger=logger
+        self._manager=manager
+        self._scheduler=scheduler
+        # optional. Runs within the event loop of the owner (like the scheduler)
+        self._event_stream=event_stream
+        self._socket_path=socket_path
+        self._snapshot=SnapshotWriter(snapshot_file)
+        self._plug_refresh_in_sec=plug_refresh_in_sec
+        self._plug_states : Dict[str, Dict[str, str]] = {}
+        self._plug_etags : Dict[str, str] = {}
+        # NOTE: only the latest decision traces are published. Each publish serializes all of them.
+        self._published_decisions=published_decisions
+        # converted decision traces (traces are not changed after being added to the manager)
+        self._decisions : List[Tuple[DecisionTrace, Dict[str, Any]]] = []
+        # publish which is awaited by all requests handled in the meantime
+        self._pending_publish : Union[None, asyncio.Future] = None
+        self._refresh_plugs=False
+        self._loop : Union[None, asyncio.AbstractEventLoop] = None
+        self._stopping : Union[None, asyncio.Event] = None
+        self._server : Union[None, asyncio.AbstractServer] = None
+        # connection handlers, publishes and the refresh of the plugs. Cancelled on stop.
+        self._tasks : Set[asyncio.Task] = set()
+        self._ready=threading.Event()
+        self._thread=threading.Thread(target=self._run, name='smartplug-energy-controller-owner', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+        if not self._ready.wait(timeout=30):
+            raise RuntimeError("Owner did not start in time")
+
+    def stop(self) -> None:
+        """Shuts down the owner (see _shutdown) and closes its event loop"""
+        if self._loop is not None and self._stopping is not None and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+        self._thread.join(timeout=10)
+        self._snapshot.close()
+
+    def _run(self) -> None:
+        self._loop=asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve())
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        finally:
+            self._loop.close()
+
+    async def _serve(self) -> None:
+        self._stopping=asyncio.Event()
+        await self._start()
+        self._ready.set()
+        try:
+            await self._stopping.wait()
+        finally:
+            await self._shutdown()
+
+    def _track(self, task : asyncio.Task) -> None:
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _start(self) -> None:
+        await self._publish(refresh_plugs=True)
+        self._server=await asyncio.start_unix_server(self._handle_connection, path=str(self._socket_path))
+        self._scheduler.start()
+        if self._event_stream is not None:
+            self._event_stream.start()
+        self._track(asyncio.get_running_loop().create_task(self._refresh_plugs_periodically()))
+
+    async def _shutdown(self) -> None:
+        # NOTE: no further connections are accepted while the running tasks are cancelled
+        if self._server is not None:
+            self._server.close()
+        tasks=list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+        if self._event_stream is not None:
+            await self._event_stream.stop()
+        self._scheduler.shutdown()
+        await self._manager.close()
+
+    async def _refresh_plugs_periodically(self) -> None:
+        # NOTE: The state of Tapo plugs is only known by polling them. Refresh them in the background instead of after each reading.
+        while True:
+            await asyncio.sleep(self._plug_refresh_in_sec)
+            try:
+                await self._publish(refresh_plugs=True)
+            except Exception as e:
+                self._logger.exception(f"Caught Exception while refreshing the states of the plugs: {e}")
+
+    def _converted_decisions(self) -> List[Dict[str, Any]]:
+        known={id(trace): converted for trace, converted in self._decisions}
+        self._decisions=[(trace, known[id(trace)] if id(trace) in known else asdict(trace)) 
+                         for trace in self._manager.decisions[-self._published_decisions:]]
+        return [converted for _, converted in self._decisions]
+
+    async def _publish(self, refresh_plugs : bool) -> None:
+        if refresh_plugs:
+            for uuid in self._manager.plug_uuids:
+                self._plug_etags[uuid], self._plug_states[uuid]=await self._manager.plug(uuid).versioned_state()
+        manager_snapshot=self._manager.snapshot
+        # NOTE: ETags are created by the owner. Thus they are the same for all workers.
+        self._snapshot.write({'smart_meter': dict(manager_snapshot.state), 'plug_states': self._plug_states,
+                              'etags': {'smart_meter': manager_snapshot.etag(), 'plug_states': self._plug_etags},
+                              'plug_info': {uuid: self._manager.plug(uuid).info for uuid in self._manager.plug_uuids},
+                              'decisions': self._converted_decisions(), 'ingestion': self._manager.ingestion_metrics,
+                              'actuations': {uuid: self._manager.plug(uuid).actuation_metrics for uuid in self._manager.plug_uuids}})
+
+    async def _publish_coalesced(self, refresh_plugs : bool) -> None:
+        # NOTE: Requests which are handled while a publish is pending share this publish. 
+        # The request returns after its changes are visible to all workers.
+        self._refresh_plugs=self._refresh_plugs or refresh_plugs
+        if self._pending_publish is None:
+            self._pending_publish=asyncio.get_running_loop().create_future()
+            asyncio.get_running_loop().call_soon(self._start_publish, self._pending_publish)
+        await asyncio.shield(self._pending_publish)
+
+    def _start_publish(self, future : asyncio.Future) -> None:
+        async def publish() -> None:
+            self._pending_publish=None
+            refresh_plugs, self._refresh_plugs=self._refresh_plugs, False
+            try:
+                await self._publish(refresh_plugs)
+                future.set_result(None)
+            except Exception as e:
+                future.set_exception(e)
+        self._track(asyncio.get_running_loop().create_task(publish()))
+
+    async def _handle_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        self._track(asyncio.current_task()) # type: ignore
+        try:
+            while line := await reader.readline():
+                request=json.loads(line)
+                try:
+                    refresh_plugs=await self._handle(request['op'], request['args'])
+                    await self._publish_coalesced(refresh_plugs)
+                    response : Dict[str, Any] = {'status': 200}
+                except PendingLimitExceeded as e:
+                    response={'status': 503, 'detail': str(e)}
+                except KeyError as e:
+                    response={'status': 404, 'detail': f"Unknown plug {e}"}
+                except HTTPException as e:
+                    response={'status': e.status_code, 'detail': e.detail}
+                except Exception as e:
+                    self._logger.exception(f"Caught Exception while handling forwarded request {request['op']}: {e}")
+                    response={'status': 500, 'detail': str(e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except asyncio.CancelledError:
+            # NOTE: cancelled on shutdown (see _shutdown). This is the outermost coroutine of the connection.
+            # It returns normally since asyncio logs an error for connection handlers ending cancelled.
+            pass
+        except Exception as e:
+            self._logger.exception(f"Caught Exception while handling a forwarded request: {e}")
+        finally:
+            writer.close()
+
+    async def _handle(self, op : str, args : Dict[str, Any]) -> bool:
+        """Handles the forwarded request. Returns True in case the states of the plugs have to be refreshed."""
+        if op == 'smart_meter':
+            timestamp=datetime.fromisoformat(args['timestamp']) if args.get('timestamp') else None
+            await self._manager.ingest_smart_meter_values(args['watt_obtained_from_provider'], args.get('watt_produced'), timestamp)
+            decisions=self._manager.decisions
+            return bool(decisions) and any(d.result in ('turned_on', 'turned_off') for d in decisions[-1].plugs)
+        controller=self._manager.plug(args['uuid'])
+        if op == 'enable':
+            await controller.set_enabled(True)
+        elif op == 'disable':
+            await controller.set_enabled(False)
+        elif op == 'plug_state':
+            if not isinstance(controller, OpenHabPlugController):
+                raise HTTPException(status_code=501, detail=f"Plug with uuid {args['uuid']} is not an OpenHabPlugController. Only OpenHabPlugController can be updated.")
+            await controller.update_values(args['watt_consumed_at_plug'], args['online'], args['is_on'])
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown operation {op}")
+        return True
+
+class OwnerClient():
+    """Forwards requests to the owner. Keeps up to max_connections open connections."""
+    def __init__(self, socket_path : Path, max_connections : int = 4) -> None:
+        self._socket_path=socket_path
+        self._max_connections=max_connections
+        self._connection_count=0
+        self._idle : List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._available : Union[None, asyncio.Condition] = None
+
+    async def _acquire(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self._available is None:
+            self._available=asyncio.Condition()
+        async with self._available:
+            while not self._idle and self._connection_count >= self._max_connections:
+                await self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._connection_count += 1
+        try:
+            return await asyncio.open_unix_connection(str(self._socket_path))
+        except:
+            await self._release(None)
+            raise
+
+    async def _release(self, connection : Union[None, Tuple[asyncio.StreamReader, asyncio.StreamWriter]]) -> None:
+        assert self._available is not None
+        async with self._available:
+            if connection is None:
+                self._connection_count -= 1
+            else:
+                self._idle.append(connection)
+            self._available.notify()
+
+    async def request(self, op : str, **args : Any) -> Dict[str, Any]:
+        connection=await self._acquire()
+        try:
+            reader, writer=connection
+            writer.write(json.dumps({'op': op, 'args': args}, default=str).encode() + b'\n')
+            await writer.drain()
+            line=await reader.readline()
+            if not line:
+                raise ConnectionError("Connection to owner has been closed")
+        except:
+            connection[1].close()
+            await self._release(None)
+            raise
+        await self._release(connection)
+        return json.loads(line)
+
+class WorkerSettings(BaseSettings):
+    smartplug_energy_controller_owner_socket : Path
+    smartplug_energy_controller_snapshot_file : Path
+
+def create_worker_app(socket_path : Path, snapshot_file : Path) -> FastAPI:
+    """Serves the routes of create_app (except the multi-site mode) from the snapshot and the owner"""
+    app = FastAPI()
+    # NOTE: profiles the worker process
+    app.state.profiler = Profiler()
+    app.include_router(_router)
+    snapshot = SnapshotReader(snapshot_file)
+    owner = OwnerClient(socket_path)
+
+    async def forward(op : str, **args : Any) -> None:
+        try:
+            response = await owner.request(op, **args)
+        except OSError as e:
+            raise HTTPException(status_code=503, detail=f"Owner is not reachable. {e}")
+        if response['status'] != 200:
+            raise HTTPException(status_code=response['status'], detail=response.get('detail'))
+
+    def read_snapshot() -> Dict[str, Any]:
+        try:
+            return snapshot.read()
+        except RuntimeError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={'Retry-After': '1'})
+
+    def read(key : str, uuid : Union[None, str] = None, value : Union[None, Dict[str, Any]] = None) -> Any:
+        value = read_snapshot()[key] if value is None else value[key]
+        if uuid is None:
+            return value
+        if uuid not in value:
+            raise HTTPException(status_code=404, detail=f"Unknown plug {uuid}")
+        return value[uuid]
+
+    def read_versioned(request : Request, key : str, uuid : Union[None, str] = None) -> Response:
+        # NOTE: read ETag and value from the same snapshot
+        value = read_snapshot()
+        return versioned_response(request, read(key, uuid, value['etags']), read(key, uuid, value))
+
+    @app.get("/plug-info/{uuid}")
+    async def plug_info(uuid: str):
+        return read('plug_info', uuid)
+
+    @app.get("/plug-state/{uuid}")
+    async def read_plug(uuid: str, request: Request):
+        return read_versioned(request, 'plug_states', uuid)
+
+    @app.put("/plug-state/{uuid}/enable")
+    async def enable_plug(uuid: str):
+        await forward('enable', uuid=uuid)
+
+    @app.put("/plug-state/{uuid}/disable")
+    async def disable_plug(uuid: str):
+        await forward('disable', uuid=uuid)
+
+    @app.put("/plug-state/{uuid}")
+    async def update_plug(uuid: str, plug_values: PlugValues):
+        await forward('plug_state', uuid=uuid, **plug_values.model_dump())
+
+    @app.get("/smart-meter")
+    async def smart_meter_get(request: Request):
+        return read_versioned(request, 'smart_meter')
+
+    @app.put("/smart-meter")
+    async def smart_meter_put(smart_meter_values: SmartMeterValues):
+        await forward('smart_meter', **smart_meter_values.model_dump())
+
+    @app.get("/debug/decisions")
+    async def debug_decisions():
+        return read('decisions')
+
+    @app.get("/debug/ingestion")
+    async def debug_ingestion():
+        return read('ingestion')
+
+    @app.get("/debug/actuations")
+    async def debug_actuations():
+        return read('actuations')
+
+    return app
+
+def create_app_from_env() -> FastAPI:
+    """Factory used by uvicorn in each worker process"""
+    settings = WorkerSettings() # type: ignore
+    return create_worker_app(settings.smartplug_energy_controller_owner_socket, settings.smartplug_energy_controller_snapshot_file)
@@ -32,7 +32,10 @@ config_file=Path(f"{test_path}/data/config.example.yml")
 os.environ['CONFIG_PATH']=config_file.as_posix()
 os.environ['SMARTPLUG_ENERGY_CONTROLLER_PORT']='8000'
 
-from smartplug_energy_controller.app import app
+from smartplug_energy_controller.app import create_app, Settings
+from smartplug_energy_controller.config import ConfigParser
+app = create_app(Settings()) # type: ignore
+sites = app.state.sites
 _client = TestClient(app)
 
 @dataclass()
@@ -92,6 +95,7 @@ class TestAppBasic(unittest.TestCase):
         assert response.json()['oh_switch_item_name'] == 'oh_smartplug_switch'
         assert response.json()['oh_power_consumption_item_name'] == 'oh_smartplug_power'
         assert response.json()['oh_automation_enabled_switch_item_name'] == 'oh_automation_enabled'
+        assert response.json()['oh_thing_max_silence_in_min'] == '0'
     
     def test_get_plug_state(self, *mocks) -> None:
         response = _client.get("/plug-state/5268704d-34c2-4e38-9d3f-73c4775babca")
@@ -216,10 +220,99 @@ class TestAppAdvanced(unittest.TestCase):
         for mock in mocks:
             mock.assert_called()
 
+class TestAppDebug(unittest.TestCase):
+    def test_decisions(self) -> None:
+        response = _client.get("/debug/decisions")
+        assert response.status_code == 200
+        assert isinstance(response.json(), list)
+
+    def test_ingestion(self) -> None:
+        response = _client.get("/debug/ingestion")
+        assert response.status_code == 200
+        self.assertEqual(response.json()['coalesce'], False)
+        self.assertEqual(response.json()['pending'], 0)
+        self.assertEqual(response.json()['max_pending'], 100)
+
+    def test_actuations(self) -> None:
+        response = _client.get("/debug/actuations")
+        assert response.status_code == 200
+        self.assertEqual(len(response.json()), 4)
+        assert all(set(metrics.keys()) == {'sent', 'suppressed', 'retried', 'resynced'} for metrics in response.json().values())
+
+    def test_profiling(self) -> None:
+        response = _client.put("/debug/profiling/stop")
+        assert response.status_code == 409
+        response = _client.put("/debug/profiling/start", params={'backend': 'unknown'})
+        assert response.status_code == 400
+        response = _client.put("/debug/profiling/start")
+        assert response.status_code == 200
+        response = _client.put("/debug/profiling/start")
+        assert response.status_code == 409
+        _client.get("/")
+        response = _client.put("/debug/profiling/stop")
+        assert response.status_code == 200
+        assert "function calls" in response.text
+
+class TestAppSites(unittest.TestCase):
+    def test_sites(self) -> None:
+        if 'home' not in sites:
+            sites.add('home', ConfigParser(config_file, None), OpenhabConnectionMock(logger))
+        oh_uuid='5f5f39a3-e392-48a4-aa62-0bc6959f35d2'
+        response = _client.get("/sites/unknown/smart-meter")
+        assert response.status_code == 404
+        response = _client.put("/sites/home/smart-meter", json={'watt_obtained_from_provider': 300})
+        assert response.status_code == 200
+        response = _client.put(f"/sites/home/plug-state/{oh_uuid}", json={'watt_consumed_at_plug': 123, 'online': True, 'is_on': True})
+        assert response.status_code == 200
+        response = _client.get(f"/sites/home/plug-state/{oh_uuid}")
+        assert response.status_code == 200
+        assert response.json()['actual_state'] == 'On'
+        assert response.json()['watt_consumed_at_plug'] == '123.0'
+        # the state of the site is independent from the state of the default site
+        response = _client.get(f"/plug-state/{oh_uuid}")
+        assert response.json()['watt_consumed_at_plug'] != '123.0'
+        response = _client.get("/sites/home/debug/decisions")
+        self.assertEqual(len(response.json()), 1)
+        response = _client.get("/sites")
+        assert response.status_code == 200
+        self.assertEqual(response.json()['home']['plugs'], 4)
+        self.assertGreater(response.json()['home']['memory_in_bytes'], 0)
+
+class TestAppSnapshots(unittest.TestCase):
+    def test_etag(self) -> None:
+        response = _client.get("/smart-meter")
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        # nothing new -> empty response
+        response = _client.get("/smart-meter", headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        # NOTE: timestamp after the ones of TestAppAdvanced
+        response = _client.put("/smart-meter", json={'watt_obtained_from_provider': 300, 'timestamp': (datetime.now() + timedelta(days=1)).isoformat()})
+        assert response.status_code == 200
+        response = _client.get("/smart-meter", headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        oh_uuid='5f5f39a3-e392-48a4-aa62-0bc6959f35d2'
+        response = _client.get(f"/plug-state/{oh_uuid}")
+        etag = response.headers['ETag']
+        response = _client.get(f"/plug-state/{oh_uuid}", headers={'If-None-Match': f'"other", {etag}'})
+        assert response.status_code == 304
+        response = _client.put(f"/plug-state/{oh_uuid}/disable")
+        response = _client.get(f"/plug-state/{oh_uuid}", headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.json()['enabled'] == 'Off'
+        response = _client.put(f"/plug-state/{oh_uuid}/enable")
+
 def load_tests(loader, standard_tests, pattern):
     suite = unittest.TestSuite()
     suite.addTests(loader.loadTestsFromTestCase(TestAppBasic))
     suite.addTests(loader.loadTestsFromTestCase(TestAppAdvanced))
+    suite.addTests(loader.loadTestsFromTestCase(TestAppDebug))
+    suite.addTests(loader.loadTestsFromTestCase(TestAppSites))
+    suite.addTests(loader.loadTestsFromTestCase(TestAppSnapshots))
     return suite
 
 if __name__ == '__main__':
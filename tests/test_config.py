@@ -14,6 +14,7 @@ logger = logging.getLogger(__name__)
 from pathlib import Path
 test_path = Path(__file__).parent.absolute()
 config_file=Path(f"{test_path}/data/config.example.yml")
+scheduling_config_file=Path(f"{test_path}/data/config.scheduling.yml")
 habapp_config_path=Path(f"{test_path}/../oh_to_smartplug_energy_controller/config.yml")
 
 class TestConfig(unittest.TestCase):
@@ -28,13 +29,37 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(parser.plug('5268704d-34c2-4e38-9d3f-73c4775babca'), 
                          TapoSmartPlugConfig('tapo', True, 111, 0.1, '192.168.110.1', 'test_user_1', 'test_passwd_1'))
         self.assertEqual(parser.plug('46742b02-aabb-47a7-9207-92b7dcea4875'), 
-                         TapoSmartPlugConfig('tapo', True, 222, 0.2, '192.168.110.2', 'test_user_2', 'test_passwd_2'))
+                         TapoSmartPlugConfig('tapo', True, 222, 0.2, '192.168.110.2', 'test_user_2', 'test_passwd_2', io_timeout_in_sec=3))
         self.assertEqual(parser.plug('5f5f39a3-e392-48a4-aa62-0bc6959f35d2'),
                          OpenHabSmartPlugConfig('openhab', True, 333, 0.3, 'oh_smartplug_thing', 'oh_smartplug_switch', 'oh_smartplug_power', 'oh_automation_enabled'))
         self.assertEqual(parser.plug('5def8014-c16d-41aa-a01d-c19a0801f65c'), 
-                         OpenHabSmartPlugConfig('openhab', True, 444, 0.4, 'oh_smartplug_thing_2', 'oh_smartplug_switch_2', 'oh_smartplug_power_2', 'oh_automation_enabled_2'))
-        self.assertEqual(parser.oh_connection, OpenHabConnectionConfig('http://localhost:8080', 'openhab', 'secret'))
+                         OpenHabSmartPlugConfig('openhab', True, 444, 0.4, 'oh_smartplug_thing_2', 'oh_smartplug_switch_2', 'oh_smartplug_power_2', 'oh_automation_enabled_2', 
+                                                confirmation_window_in_sec=60, oh_thing_max_silence_in_min=720))
+        self.assertEqual(parser.oh_connection, OpenHabConnectionConfig('http://localhost:8080', 'openhab', 'secret', 
+                                                                       'smart_meter_overall_consumption', 'system_balkonkraftwerk_now', False))
         
+    def test_scheduling(self) -> None:
+        parser=ConfigParser(scheduling_config_file, None)
+        self.assertEqual(parser.plug('0b0f1c5e-4d0e-4f7a-9c1e-3c5b2a8d7e61'), 
+                         TapoSmartPlugConfig('tapo', True, 500, 0.5, '192.168.110.3', 'test_user_3', 'test_passwd_3', 
+                                             runtime_in_min=120, deadline='18:00'))
+        self.assertEqual(parser.plug('7e2d9a41-6b3c-4f58-8a0d-1f4e6c9b2d37'), 
+                         TapoSmartPlugConfig('tapo', True, 800, 0.3, '192.168.110.4', 'test_user_4', 'test_passwd_4', 
+                                             min_on_time_in_sec=600, min_off_time_in_sec=300, max_switches_per_hour=4))
+        self.assertIsNone(parser.oh_connection)
+
+    def test_deferrable_plug_without_deadline(self) -> None:
+        with self.assertRaises(ValueError):
+            SmartPlugConfig('tapo', True, 111, 0.1, runtime_in_min=120)
+        with self.assertRaises(ValueError):
+            OpenHabSmartPlugConfig('openhab', True, 333, 0.3, runtime_in_min=120, deadline='6pm')
+        self.assertEqual(TapoSmartPlugConfig('tapo', True, 111, 0.1, runtime_in_min=120, deadline='18:00').deadline, '18:00')
+        # the deadline is not needed for plugs which are not deferrable
+        self.assertEqual(SmartPlugConfig('tapo', True, 111, 0.1).runtime_in_min, 0)
+        # the runtime has to fit into one day
+        with self.assertRaises(ValueError):
+            SmartPlugConfig('tapo', True, 111, 0.1, runtime_in_min=24*60, deadline='18:00')
+
     def test_transfer_to_habapp(self) -> None:
         parser=ConfigParser(config_file, habapp_config_path)
         yaml=YAML(typ='safe', pure=True)
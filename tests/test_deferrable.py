@@ -0,0 +1,76 @@
+import logging
+import sys
+import unittest
+from datetime import datetime, time, timedelta
+
+from smartplug_energy_controller.deferrable import DeferrableLoad, SurplusProfile
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+class TestSurplusProfile(unittest.TestCase):
+    def test_expected(self) -> None:
+        profile=SurplusProfile(timedelta(hours=1), smoothing=0.5)
+        day=datetime(2024, 6, 1)
+        self.assertEqual(profile.expected(day + timedelta(hours=12)), 0)
+        for minute in range(0, 120, 10):
+            profile.add(100 if minute < 60 else 300, day + timedelta(hours=12, minutes=minute))
+        # the current slot is added once it is over
+        self.assertEqual(profile.expected(day + timedelta(hours=12)), 100)
+        self.assertEqual(profile.expected(day + timedelta(hours=13)), 0)
+        profile.add(0, day + timedelta(days=1, hours=12))
+        self.assertEqual(profile.expected(day + timedelta(hours=13)), 300)
+        profile.add(0, day + timedelta(days=1, hours=13))
+        self.assertEqual(profile.expected(day + timedelta(days=1, hours=12)), 50)
+        self.assertEqual(profile.slot_start(day + timedelta(hours=12, minutes=59)), day + timedelta(hours=12))
+
+class TestDeferrableLoad(unittest.TestCase):
+    def _create_profile(self) -> SurplusProfile:
+        # surplus around noon on the previous day
+        profile=SurplusProfile(timedelta(hours=1))
+        day=datetime(2024, 5, 31)
+        for hour in range(25):
+            profile.add(1000 - abs(12 - hour)*100, day + timedelta(hours=hour))
+        return profile
+
+    def test_plan(self) -> None:
+        load=DeferrableLoad(timedelta(hours=2), time(18), self._create_profile())
+        now=datetime(2024, 6, 1, 8)
+        load.update(now, False)
+        self.assertEqual(load.deadline, datetime(2024, 6, 1, 18))
+        self.assertEqual(load.should_run(now), (False, 'waiting'))
+        self.assertEqual(load.planned_slots, [datetime(2024, 6, 1, 11), datetime(2024, 6, 1, 12)])
+        now=datetime(2024, 6, 1, 11, 30)
+        load.update(now, False)
+        self.assertEqual(load.should_run(now), (True, 'planned'))
+        load.update(now, True)
+        now=datetime(2024, 6, 1, 13, 30)
+        load.update(now, True)
+        self.assertEqual(load.remaining(now), timedelta())
+        self.assertEqual(load.should_run(now), (False, 'done'))
+        # the runtime is needed again after the deadline
+        now=datetime(2024, 6, 1, 18)
+        load.update(now, False)
+        self.assertEqual(load.deadline, datetime(2024, 6, 2, 18))
+        self.assertEqual(load.remaining(now), timedelta(hours=2))
+
+    def test_forced(self) -> None:
+        load=DeferrableLoad(timedelta(hours=2), time(18), self._create_profile())
+        # the best slots have passed (e.g. the plug has been offline) -> the best remaining slots are used
+        now=datetime(2024, 6, 1, 15)
+        load.update(now, False)
+        self.assertEqual(load.should_run(now), (True, 'planned'))
+        load.update(now, True)
+        self.assertEqual(load.remaining(now + timedelta(minutes=30)), timedelta(hours=1, minutes=30))
+        # the plug runs as soon as there is no slack anymore
+        load=DeferrableLoad(timedelta(hours=2), time(18), self._create_profile())
+        load.update(datetime(2024, 6, 1, 16), False)
+        self.assertEqual(load.should_run(datetime(2024, 6, 1, 16)), (True, 'forced'))
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")
@@ -0,0 +1,88 @@
+import asyncio
+import io
+import logging
+import os
+import signal
+import sys
+import time
+import unittest
+
+from oh_to_smartplug_energy_controller.entry_point import Supervisor
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+# dummy child: floods its output and crashes
+_crashing_child=[sys.executable, '-c', "import sys\n"
+                 "for _ in range(1000): sys.stdout.write('x'*1023 + '\\n')\n"
+                 "sys.stderr.write('crash\\n')\n"
+                 "sys.exit(3)"]
+
+class TestSupervisor(unittest.IsolatedAsyncioTestCase):
+    async def test_restart_crashing_child(self) -> None:
+        stdout, stderr=io.BytesIO(), io.BytesIO()
+        supervisor=Supervisor(_crashing_child, initial_backoff_in_sec=0.05, max_backoff_in_sec=0.1, max_restarts=3,
+                              stdout=stdout, stderr=stderr)
+        self.assertEqual(await asyncio.wait_for(supervisor.run(), timeout=30), 3)
+        # the whole output of each run is forwarded
+        self.assertEqual(len(stdout.getvalue()), 4*1000*1024)
+        self.assertEqual(stderr.getvalue().count(b'crash\n'), 4)
+        self.assertEqual(supervisor.exit_codes, [3, 3, 3, 3])
+        # exponential backoff up to max_backoff_in_sec
+        self.assertEqual(supervisor.backoffs_in_sec, [0.05, 0.1, 0.1])
+        health=supervisor.health
+        self.assertFalse(health['running'])
+        self.assertEqual(health['restarts'], 3)
+        self.assertEqual(health['last_exit_code'], 3)
+
+    async def test_backoff_reset_after_stable_run(self) -> None:
+        supervisor=Supervisor(_crashing_child, initial_backoff_in_sec=0.05, stable_time_in_sec=0, max_restarts=2,
+                              stdout=io.BytesIO(), stderr=io.BytesIO())
+        await asyncio.wait_for(supervisor.run(), timeout=30)
+        self.assertEqual(supervisor.backoffs_in_sec, [0.05, 0.05])
+
+    async def test_idle_and_forward_signal(self) -> None:
+        stdout=io.BytesIO()
+        sleeping_child=[sys.executable, '-c', "import signal, sys, time\n"
+                        "signal.signal(signal.SIGTERM, lambda *_: sys.exit(7))\n"
+                        "print('ready', flush=True)\n"
+                        "time.sleep(60)"]
+        supervisor=Supervisor(sleeping_child, stdout=stdout, stderr=io.BytesIO())
+        task=asyncio.get_running_loop().create_task(supervisor.run())
+        deadline=time.monotonic() + 10
+        while stdout.getvalue() != b'ready\n':
+            self.assertLess(time.monotonic(), deadline)
+            await asyncio.sleep(0.05)
+        self.assertTrue(supervisor.health['running'])
+        # no CPU time is spent while the child is idle
+        cpu_time=time.process_time()
+        await asyncio.sleep(1)
+        self.assertLess(time.process_time() - cpu_time, 0.05)
+        # the signal is forwarded to the child. It is not restarted.
+        os.kill(os.getpid(), signal.SIGTERM)
+        self.assertEqual(await asyncio.wait_for(task, timeout=10), 7)
+        self.assertEqual(supervisor.health['starts'], 1)
+        self.assertEqual(supervisor.health['stopping'], 'SIGTERM')
+
+    async def test_kill_child_ignoring_signal(self) -> None:
+        stdout=io.BytesIO()
+        stubborn_child=[sys.executable, '-c', "import signal, time\n"
+                        "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+                        "print('ready', flush=True)\n"
+                        "time.sleep(60)"]
+        supervisor=Supervisor(stubborn_child, stop_timeout_in_sec=0.2, stdout=stdout, stderr=io.BytesIO())
+        task=asyncio.get_running_loop().create_task(supervisor.run())
+        deadline=time.monotonic() + 10
+        while stdout.getvalue() != b'ready\n':
+            self.assertLess(time.monotonic(), deadline)
+            await asyncio.sleep(0.05)
+        supervisor.stop()
+        self.assertEqual(await asyncio.wait_for(task, timeout=10), -signal.SIGKILL)
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")
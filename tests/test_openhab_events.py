@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+import unittest
+from typing import Any, Callable, Dict, List, Tuple
+
+from aiohttp import web
+
+from smartplug_energy_controller.config import OpenHabConnectionConfig, OpenHabSmartPlugConfig
+from smartplug_energy_controller.openhab_events import OpenHabEvent, OpenHabEventStream, parse_event
+from smartplug_energy_controller.plug_controller import OpenHabPlugController
+from smartplug_energy_controller.plug_manager import PlugManager
+from smartplug_energy_controller.utils import OpenhabConnection
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+def _event(topic : str, event_type : str, payload : Any) -> str:
+    return json.dumps({'topic': topic, 'payload': json.dumps(payload), 'type': event_type})
+
+class OpenhabConnectionMock():
+    async def post_to_item(self, oh_item_name : str, value : Any) -> bool:
+        return True
+
+class OpenhabServerMock():
+    """REST API and event stream of openHAB"""
+    def __init__(self) -> None:
+        self.item_states : Dict[str, str] = {'watt_obtained': '500', 'watt_produced': '0', 'switch': 'OFF', 'power': '0 W', 'automation': 'ON'}
+        self.thing_states : Dict[str, str] = {'zwave:device:1': 'ONLINE'}
+        self.posts : List[Tuple[str, str]] = []
+        self.topics : List[str] = []
+        self._streams : List[asyncio.Queue] = []
+
+    async def start(self) -> str:
+        app=web.Application()
+        app.router.add_get('/rest/', self._get_root)
+        app.router.add_get('/rest/items', self._get_items)
+        app.router.add_post('/rest/items/{item}', self._post_item)
+        app.router.add_get('/rest/things', self._get_things)
+        app.router.add_get('/rest/events', self._events)
+        self._runner=web.AppRunner(app, handler_cancellation=True)
+        await self._runner.setup()
+        site=web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        return f"http://127.0.0.1:{self._runner.addresses[0][1]}"
+
+    async def stop(self) -> None:
+        self.close_streams()
+        await self._runner.cleanup()
+
+    async def _get_root(self, request : web.Request) -> web.Response:
+        return web.json_response({'runtimeInfo': {'version': '4.1.0'}})
+
+    async def _get_items(self, request : web.Request) -> web.Response:
+        return web.json_response([{'name': name, 'state': state} for name, state in self.item_states.items()])
+
+    async def _post_item(self, request : web.Request) -> web.Response:
+        self.posts.append((request.match_info['item'], await request.text()))
+        return web.Response()
+
+    async def _get_things(self, request : web.Request) -> web.Response:
+        return web.json_response([{'UID': uid, 'statusInfo': {'status': status}} for uid, status in self.thing_states.items()])
+
+    async def _events(self, request : web.Request) -> web.StreamResponse:
+        self.topics=request.query['topics'].split(',')
+        queue : asyncio.Queue = asyncio.Queue()
+        response=web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        self._streams.append(queue)
+        try:
+            while (data := await queue.get()) is not None:
+                await response.write(f"event: message\ndata: {data}\n\n".encode())
+        finally:
+            self._streams.remove(queue)
+        return response
+
+    @property
+    def stream_count(self) -> int:
+        return len(self._streams)
+
+    def publish(self, data : str) -> None:
+        for queue in self._streams:
+            queue.put_nowait(data)
+
+    def close_streams(self) -> None:
+        self.publish(None) # type: ignore
+
+    def update_item(self, item : str, value : str) -> None:
+        changed=self.item_states[item] != value
+        self.item_states[item]=value
+        self.publish(_event(f"openhab/items/{item}/state", 'ItemStateEvent', {'type': 'Decimal', 'value': value}))
+        self.publish(_event(f"openhab/items/{item}/stateupdated", 'ItemStateUpdatedEvent', {'type': 'Decimal', 'value': value}))
+        if changed:
+            self.publish(_event(f"openhab/items/{item}/statechanged", 'ItemStateChangedEvent', {'type': 'Decimal', 'value': value}))
+
+async def _wait_until(condition : Callable[[], bool], timeout_in_sec : float = 5) -> None:
+    deadline=time.monotonic() + timeout_in_sec
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Condition not met in time")
+        await asyncio.sleep(0.01)
+
+class TestParseEvent(unittest.TestCase):
+    def test_parse_event(self) -> None:
+        self.assertEqual(parse_event(_event('openhab/items/power/statechanged', 'ItemStateChangedEvent', {'type': 'Quantity', 'value': '12.5 W', 'oldValue': '0 W'})),
+                         OpenHabEvent('ItemStateChangedEvent', 'power', '12.5 W'))
+        self.assertEqual(parse_event(_event('openhab/things/zwave:device:1/statuschanged', 'ThingStatusInfoChangedEvent',
+                                            [{'status': 'OFFLINE', 'statusDetail': 'NONE'}, {'status': 'ONLINE', 'statusDetail': 'NONE'}])),
+                         OpenHabEvent('ThingStatusInfoChangedEvent', 'zwave:device:1', 'OFFLINE'))
+        self.assertIsNone(parse_event(_event('openhab/inbox/added', 'InboxAddedEvent', {})))
+        self.assertIsNone(parse_event('no json'))
+        self.assertIsNone(parse_event(json.dumps({'topic': 'openhab/items/power/state'})))
+
+class TestOpenhabConnection(unittest.IsolatedAsyncioTestCase):
+    async def test_read_states(self) -> None:
+        server=OpenhabServerMock()
+        oh_connection=OpenhabConnection(OpenHabConnectionConfig(await server.start()), logger)
+        try:
+            item_states, thing_states=await oh_connection.read_states({'switch', 'power', 'unknown'}, {'zwave:device:1'}) # type: ignore
+            self.assertEqual(item_states, {'switch': 'OFF', 'power': '0 W'})
+            self.assertEqual(thing_states, {'zwave:device:1': 'ONLINE'})
+            self.assertEqual(await oh_connection.read_states(set(), set()), ({}, {}))
+        finally:
+            await server.stop()
+        self.assertIsNone(await oh_connection.read_states({'switch'}, set()))
+
+class TestOpenHabEventStream(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self._server=OpenhabServerMock()
+        oh_url=await self._server.start()
+        self._manager=PlugManager(logger, 5, 250)
+        self._plug=OpenHabPlugController(logger, OpenHabSmartPlugConfig('openhab', True, 200, 0.5, 'zwave:device:1', 'switch', 'power', 'automation'),
+                                         oh_connection=OpenhabConnectionMock())
+        self._manager._add_plug_controller('A', self._plug)
+        self._stream=OpenHabEventStream(logger, OpenHabConnectionConfig(oh_url, '', '', 'watt_obtained', 'watt_produced', True), self._manager)
+
+    async def asyncTearDown(self) -> None:
+        await self._stream.stop()
+        await self._server.stop()
+
+    async def test_event_stream(self) -> None:
+        self._server.thing_states['zwave:device:1']='OFFLINE'
+        self._stream.start()
+        await _wait_until(lambda: self._stream.metrics['plug_updates'] == 1 and len(self._server.posts) == 1)
+        # only the configured items and things are subscribed
+        self.assertEqual(sorted(self._server.topics), ['openhab/items/automation/*', 'openhab/items/power/*', 'openhab/items/switch/*',
+                                                       'openhab/items/watt_obtained/*', 'openhab/items/watt_produced/*',
+                                                       'openhab/things/zwave:device:1/statuschanged'])
+        # states are read after subscribing. The automation enabled item is initialized with the state of the plug.
+        self.assertFalse(await self._plug.is_online())
+        self.assertEqual(self._server.posts, [('automation', 'ON')])
+
+        self._server.publish(_event('openhab/things/zwave:device:1/statuschanged', 'ThingStatusInfoChangedEvent',
+                                    [{'status': 'ONLINE'}, {'status': 'OFFLINE'}]))
+        self._server.update_item('switch', 'ON')
+        self._server.update_item('power', '150.5 W')
+        await _wait_until(lambda: self._stream.metrics['plug_updates'] == 4)
+        self.assertTrue(await self._plug.is_online())
+        self.assertTrue(await self._plug.is_on())
+        self.assertEqual(self._plug.watt_consumed, 150.5)
+
+        # smart meter values are added on each update of the watt obtained item (changed or not)
+        self._server.update_item('watt_obtained', '400')
+        self._server.update_item('watt_obtained', '400')
+        await _wait_until(lambda: self._stream.metrics['smart_meter_values'] == 2)
+        self.assertEqual(len(self._manager.decisions), 2)
+        self.assertEqual(self._manager.decisions[-1].watt_obtained_from_provider, 400)
+        # and on each change of the watt produced item
+        self._server.update_item('watt_produced', '100')
+        self._server.update_item('watt_produced', '100')
+        await _wait_until(lambda: self._stream.metrics['smart_meter_values'] == 3)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self._stream.metrics['smart_meter_values'], 3)
+
+        self._server.update_item('automation', 'OFF')
+        await _wait_until(lambda: not self._plug.enabled)
+
+        # missed changes are applied after reconnecting
+        self._server.close_streams()
+        await _wait_until(lambda: not self._stream.connected)
+        self._server.item_states['switch']='OFF'
+        self._server.item_states['automation']='ON'
+        await _wait_until(lambda: self._stream.metrics['connects'] == 2 and self._plug.enabled, timeout_in_sec=10)
+        self.assertFalse(await self._plug.is_on())
+        self.assertEqual(self._server.posts, [('automation', 'ON')])
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")
@@ -1,9 +1,17 @@
 import logging
 import sys
 import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
 
-from smartplug_energy_controller.plug_controller import TapoPlugController
-from smartplug_energy_controller.config import TapoSmartPlugConfig
+import aiohttp
+from aiohttp import ClientSession
+
+from typing import Any, List, Tuple, Union
+
+from smartplug_energy_controller.plug_controller import TapoPlugController, OpenHabPlugController
+from smartplug_energy_controller.config import TapoSmartPlugConfig, OpenHabSmartPlugConfig
+from smartplug_energy_controller.utils import VirtualClock
 
 logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
 logger = logging.getLogger(__name__)
@@ -13,7 +21,93 @@ class TestTapoPlugController(unittest.IsolatedAsyncioTestCase):
         controller=TapoPlugController(logger, TapoSmartPlugConfig(type='tapo', enabled=True, id='test_controller', auth_user='test', auth_passwd='test', 
                             expected_consumption_in_watt=200, consumer_efficiency=0.5))
         self.assertFalse(await controller.is_on())
-        
+
+    async def test_circuit_breaker(self) -> None:
+        clock=VirtualClock(datetime(2024, 6, 1))
+        controller=TapoPlugController(logger, TapoSmartPlugConfig(type='tapo', enabled=True, id='test_controller', auth_user='test', auth_passwd='test', 
+                            expected_consumption_in_watt=200, consumer_efficiency=0.5), clock)
+        with patch.object(TapoPlugController, '_connect_and_update', side_effect=ConnectionError("unreachable")) as connect:
+            for _ in range(10):
+                self.assertFalse(await controller.is_online())
+            # no further connection attempts while the breaker is open
+            self.assertEqual(connect.call_count, 3)
+            state=await controller.state
+            self.assertEqual(state['circuit_breaker'], 'open')
+            self.assertEqual(state['circuit_breaker_open_until'], (clock.now() + timedelta(seconds=30)).isoformat())
+            clock.advance(timedelta(seconds=30))
+            self.assertFalse(await controller.is_online())
+            self.assertEqual(connect.call_count, 4)
+        with patch.object(TapoPlugController, '_connect_and_update') as connect:
+            clock.advance(timedelta(seconds=60))
+            self.assertTrue(await controller.is_online())
+            self.assertEqual((await controller.state)['circuit_breaker'], 'closed')
+
+    async def test_close_sessions(self) -> None:
+        controller=TapoPlugController(logger, TapoSmartPlugConfig(type='tapo', enabled=True, id='127.0.0.1:1', auth_user='test', auth_passwd='test', 
+                            expected_consumption_in_watt=200, consumer_efficiency=0.5))
+        sessions : List[aiohttp.ClientSession] = []
+        def create_session(*args, **kwargs) -> aiohttp.ClientSession:
+            sessions.append(ClientSession(*args, **kwargs))
+            return sessions[-1]
+        with patch('aiohttp.ClientSession', side_effect=create_session):
+            # plug is offline: each protocol is tried with its own session
+            for _ in range(2):
+                with self.assertRaises(Exception):
+                    await controller._connect_and_update()
+            self.assertEqual(len(sessions), 6)
+            self.assertTrue(all(session.closed for session in sessions))
+            # session of a connected plug is closed on reset and close
+            with patch('plugp100.new.device_factory.connect'):
+                await controller._connect_and_update()
+                controller.reset()
+                await controller._connect_and_update()
+            await controller.close()
+            self.assertEqual(len(sessions), 8)
+            self.assertTrue(all(session.closed for session in sessions))
+
+class OpenhabConnectionMock():
+    def __init__(self) -> None:
+        self.posts : List[Tuple[str, Any]] = []
+
+    async def post_to_item(self, oh_item_name : str, value : Any) -> bool:
+        self.posts.append((oh_item_name, value))
+        return True
+
+class TestOpenHabPlugController(unittest.IsolatedAsyncioTestCase):
+    async def test_suppress_duplicate_commands(self) -> None:
+        clock=VirtualClock(datetime(2024, 6, 1))
+        oh_connection=OpenhabConnectionMock()
+        controller=OpenHabPlugController(logger, OpenHabSmartPlugConfig('openhab', True, 200, 0.5, 'thing', 'switch', 'power', '', confirmation_window_in_sec=30), 
+                                         clock, oh_connection)
+        self.assertTrue(await controller.turn_on())
+        clock.advance(timedelta(seconds=10))
+        # not confirmed yet -> not sent again
+        self.assertTrue(await controller.turn_on())
+        self.assertEqual(oh_connection.posts, [('switch', 'ON')])
+        # no confirmation within the window -> retry
+        clock.advance(timedelta(seconds=20))
+        self.assertTrue(await controller.turn_on())
+        self.assertEqual(oh_connection.posts, [('switch', 'ON'), ('switch', 'ON')])
+        await controller.update_values(200, True, True)
+        self.assertTrue(await controller.turn_off())
+        await controller.update_values(0, True, False)
+        # confirmed -> the next command is sent at once
+        self.assertTrue(await controller.turn_on())
+        self.assertEqual(oh_connection.posts[2:], [('switch', 'OFF'), ('switch', 'ON')])
+        self.assertEqual(controller.actuation_metrics, {'sent': 4, 'suppressed': 1, 'retried': 1, 'resynced': 0})
+
+    async def test_known_state(self) -> None:
+        controller=OpenHabPlugController(logger, OpenHabSmartPlugConfig('openhab', True, 200, 0.5, 'thing', 'switch', 'power', ''), 
+                                         VirtualClock(datetime(2024, 6, 1)), OpenhabConnectionMock())
+        changes : List[Union[None, bool]] = []
+        controller.set_on_change(lambda: changes.append(controller.known_state))
+        self.assertFalse(controller.known_state)
+        await controller.update_values(200, True, True)
+        await controller.update_values(210, True, True)
+        await controller.update_values(0, False, False)
+        await controller.set_enabled(False)
+        self.assertEqual(changes, [True, None, None])
+
 if __name__ == '__main__':
     try:
         unittest.main()
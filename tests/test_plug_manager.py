@@ -1,20 +1,27 @@
+import asyncio
 import logging
+import math
+import time
 import sys
 import unittest
 from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import Any, List, Dict, Set, Tuple
 from functools import cached_property
 
-from smartplug_energy_controller.plug_controller import PlugController
-from smartplug_energy_controller.plug_manager import PlugManager
-from smartplug_energy_controller.config import SmartPlugConfig
+from aiohttp import web
+
+from smartplug_energy_controller.plug_controller import PlugController, OpenHabPlugController
+from smartplug_energy_controller.plug_manager import PlugManager, PendingLimitExceeded
+from smartplug_energy_controller.config import SmartPlugConfig, OpenHabSmartPlugConfig, GeneralConfig
+from smartplug_energy_controller.config import OpenHabConnectionConfig
+from smartplug_energy_controller.utils import OpenhabConnection, VirtualClock
 
 logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
 logger = logging.getLogger(__name__)
 
 class PlugControllerMock(PlugController):
-    def __init__(self, logger, cfg : SmartPlugConfig) -> None:
-        super().__init__(logger, cfg)
+    def __init__(self, logger, cfg : SmartPlugConfig, clock=None) -> None:
+        super().__init__(logger, cfg, clock)
         self._is_on = False
         self._online = True
 
@@ -56,6 +63,31 @@ class DateTimeIncrementer():
         self._counter += 1
         return self._time + timedelta(minutes=self._counter, seconds=self._counter)
 
+class KnownStatePlugControllerMock(PlugControllerMock):
+    """Reports its state without requests (like a plug updated by openHAB) and counts the requests for the state"""
+    def __init__(self, logger, cfg : SmartPlugConfig, clock=None) -> None:
+        super().__init__(logger, cfg, clock)
+        self._known_state = False
+        self.requests = 0
+
+    async def is_on(self) -> bool:
+        self.requests += 1
+        return await super().is_on()
+
+    def switch(self, on : bool) -> None:
+        self._is_on = on
+        self._set_known_state(on)
+
+    async def turn_on(self) -> bool:
+        rc = await super().turn_on()
+        self._set_known_state(self._is_on)
+        return rc
+
+    async def turn_off(self) -> bool:
+        rc = await super().turn_off()
+        self._set_known_state(self._is_on)
+        return rc
+
 class TestPlugManager(unittest.IsolatedAsyncioTestCase):
     eval_time_in_min=2
     default_base_load_in_watt=200
@@ -215,6 +247,447 @@ class TestPlugManager(unittest.IsolatedAsyncioTestCase):
         await self._manager.add_smart_meter_values(80, 310, now + timedelta(minutes=5))
         self.assertTrue(await self._all_plugs_off(self._plug_uuids))
 
+    async def test_decision_trace(self):
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, decision_trace_size=3)
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5)
+        manager._add_plug_controller("A", PlugControllerMock(logger, cfg))
+        cfg=SmartPlugConfig(type='testing', enabled=False, expected_consumption_in_watt=100, consumer_efficiency=0.5)
+        manager._add_plug_controller("B", PlugControllerMock(logger, cfg))
+
+        now = datetime.now()
+        await manager.add_smart_meter_values(0, 300, now)
+        self.assertEqual(len(manager.decisions), 1)
+        self.assertEqual(manager.decisions[0].branch, 'turn_on')
+        self.assertEqual([(d.uuid, d.result) for d in manager.decisions[0].plugs], [('A', 'below_threshold')])
+        await manager.add_smart_meter_values(0, 500, now + timedelta(seconds=30))
+        self.assertEqual([(d.uuid, d.result) for d in manager.decisions[1].plugs], [('A', 'turned_on')])
+        await manager.add_smart_meter_values(300, 0, now + timedelta(minutes=1))
+        await manager.add_smart_meter_values(300, 0, now + timedelta(minutes=2))
+        await manager.add_smart_meter_values(300, 0, now + timedelta(minutes=3))
+        # ring buffer keeps the latest values only
+        self.assertEqual(len(manager.decisions), 3)
+        trace=manager.decisions[-1]
+        self.assertEqual(trace.timestamp, now + timedelta(minutes=3))
+        self.assertEqual(trace.watt_obtained_from_provider, 300)
+        self.assertEqual(trace.median, 300)
+        self.assertEqual(trace.base_load, TestPlugManager.default_base_load_in_watt)
+        self.assertEqual(trace.branch, 'turn_off')
+        self.assertEqual([(d.uuid, d.result) for d in trace.plugs], [('A', 'off')])
+        self.assertIn('total', trace.timings_in_ms)
+        self.assertIn('turn_off', trace.timings_in_ms)
+        self.assertEqual([(d.uuid, d.result) for d in manager.decisions[0].plugs], [('A', 'on')])
+        self.assertEqual([(d.uuid, d.result) for d in manager.decisions[1].plugs], [('A', 'turned_off')])
+
+    async def test_virtual_clock(self):
+        clock=VirtualClock(datetime(2024, 6, 1, 12))
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, clock=clock)
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5)
+        manager._add_plug_controller("A", PlugControllerMock(logger, cfg, clock))
+        # values without timestamp are added at the time of the clock
+        for watt_produced in [300, 500, 500]:
+            clock.advance(timedelta(seconds=30))
+            await manager.add_smart_meter_values(0, watt_produced)
+        self.assertEqual([trace.timestamp for trace in manager.decisions], [datetime(2024, 6, 1, 12, 0, 30), datetime(2024, 6, 1, 12, 1), datetime(2024, 6, 1, 12, 1, 30)])
+        self.assertTrue(await manager.plug("A").is_on())
+        state=await manager.plug("A").state
+        self.assertEqual(state['proposed_state_since'], datetime(2024, 6, 1, 12, 1).isoformat())
+        # one day within milliseconds
+        for _ in range(24*60):
+            clock.advance(timedelta(minutes=1))
+            await manager.add_smart_meter_values(300, 0)
+        self.assertFalse(await manager.plug("A").is_on())
+        self.assertEqual(manager.decisions[-1].timestamp, datetime(2024, 6, 2, 12, 1, 30))
+
+    async def test_snapshot(self):
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt)
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5)
+        manager._add_plug_controller("A", PlugControllerMock(logger, cfg))
+        snapshot=manager.snapshot
+        plug_snapshot=manager.plug("A").snapshot
+        with self.assertRaises(TypeError):
+            snapshot.state['base_load']=0 # type: ignore
+        # readers do not wait for running evaluations
+        async with manager._lock:
+            self.assertEqual((await manager.state)['base_load'], TestPlugManager.default_base_load_in_watt)
+        now=datetime.now()
+        for i in range(3):
+            await manager.add_smart_meter_values(0, 500, now + timedelta(minutes=i))
+        # published snapshots are never changed
+        self.assertGreater(manager.snapshot.version, snapshot.version)
+        self.assertEqual(snapshot.state['latest_mean'], sys.float_info.max)
+        self.assertEqual(manager.snapshot.state['latest_mean'], 0)
+        self.assertNotEqual(manager.snapshot.etag(), snapshot.etag())
+        await manager.plug("A").set_enabled(False)
+        self.assertEqual(plug_snapshot.state['enabled'], 'On')
+        self.assertEqual(manager.plug("A").snapshot.state['enabled'], 'Off')
+        self.assertEqual((await manager.plug("A").state)['enabled'], 'Off')
+
+    async def test_coalescing(self):
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, coalesce=True, max_pending=5)
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5)
+        plug=PlugControllerMock(logger, cfg)
+        # plug which blocks the evaluation (e.g. timeout of a Tapo plug)
+        release=asyncio.Event()
+        async def is_online() -> bool:
+            await release.wait()
+            return True
+        plug.is_online=is_online # type: ignore
+        manager._add_plug_controller("A", plug)
+        now=datetime.now()
+        tasks=[asyncio.create_task(manager.ingest_smart_meter_values(300, None, now + timedelta(seconds=i))) for i in range(5)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(manager.ingestion_metrics['pending'], 5)
+        with self.assertRaises(PendingLimitExceeded):
+            await manager.ingest_smart_meter_values(300, None, now + timedelta(seconds=5))
+        release.set()
+        await asyncio.gather(*tasks)
+        metrics=manager.ingestion_metrics
+        self.assertEqual(metrics['pending'], 0)
+        self.assertEqual(metrics['rejected'], 1)
+        # only the newest values have been evaluated
+        self.assertEqual(metrics['evaluations'], 1)
+        self.assertEqual(metrics['skipped_evaluations'], 4)
+        self.assertEqual(manager.decisions[-1].timestamp, now + timedelta(seconds=4))
+        # but all values have been added
+        self.assertEqual(manager._watt_obtained_values.value_count(), 6)
+        await manager.ingest_smart_meter_values(300, None, now + timedelta(seconds=6))
+        self.assertEqual(manager.ingestion_metrics['evaluations'], 2)
+
+    async def test_cancel_coalescing_evaluator(self):
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, coalesce=True, max_pending=5)
+        plug=PlugControllerMock(logger, SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5))
+        async def hang() -> bool:
+            await asyncio.sleep(3600)
+            return True
+        plug.is_online=hang # type: ignore
+        manager._add_plug_controller("A", plug)
+        now=datetime.now()
+        tasks=[asyncio.create_task(manager.ingest_smart_meter_values(300, None, now + timedelta(seconds=i))) for i in range(4)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(manager.ingestion_metrics['pending'], 4)
+        # cancelled in the middle of an evaluation (e.g. on shutdown): the waiting requests do not hang
+        assert manager._evaluator is not None
+        manager._evaluator.cancel()
+        results=await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), timeout=1)
+        self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results))
+        self.assertEqual(manager.ingestion_metrics['pending'], 0)
+        self.assertIsNone(manager._evaluator)
+        # the next values start a new evaluator
+        manager.plug("A").is_online=PlugControllerMock.is_online.__get__(manager.plug("A")) # type: ignore
+        await asyncio.wait_for(manager.ingest_smart_meter_values(300, None, now + timedelta(seconds=5)), timeout=1)
+        self.assertEqual(manager.ingestion_metrics['evaluations'], 1)
+
+    async def test_allocate_surplus(self):
+        for allocate_surplus, expected_results in [(False, ['turned_on']), (True, ['turned_on', 'turned_on', 'below_threshold'])]:
+            clock=VirtualClock(datetime(2024, 6, 1, 12))
+            manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, 
+                                clock=clock, allocate_surplus=allocate_surplus)
+            for uuid in self._plug_uuids:
+                manager._add_plug_controller(uuid, PlugControllerMock(logger, self._manager.plug(uuid).cfg, clock))
+            for watt_obtained, watt_produced in [(100, 0), (100, 0), (0, 0), (0, 500)]:
+                clock.advance(timedelta(minutes=1))
+                await manager.add_smart_meter_values(watt_obtained, watt_produced)
+            # surplus of 300 Watt is sufficient for A (200 Watt) and B (100 Watt)
+            trace=manager.decisions[-1]
+            self.assertEqual(trace.break_even, TestPlugManager.default_base_load_in_watt)
+            self.assertEqual([decision.result for decision in trace.plugs], expected_results)
+
+    async def test_allocated_surplus_of_previous_evaluations(self):
+        clock=VirtualClock(datetime(2024, 6, 1, 12))
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, 
+                            clock=clock, allocate_surplus=True)
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=100, consumer_efficiency=0.05)
+        for i in range(5):
+            manager._add_plug_controller(f"plug_{i}", PlugControllerMock(logger, cfg, clock))
+        for watt_obtained, watt_produced in [(100, 0), (100, 0), (0, 0), (0, 450), (0, 450), (0, 450), (300, 450)]:
+            clock.advance(timedelta(minutes=1))
+            await manager.add_smart_meter_values(watt_obtained, watt_produced)
+        results=[[d.result for d in trace.plugs] for trace in manager.decisions][3:]
+        # surplus of 250 Watt. The plugs turned on are not reflected by the median of the next value. 
+        # Their surplus is not allocated to other plugs again until the evaluated time frame has passed.
+        self.assertEqual(results, [['turned_on', 'turned_on', 'below_threshold', 'below_threshold', 'below_threshold'], 
+                                   ['on', 'on', 'below_threshold', 'below_threshold', 'below_threshold'], 
+                                   ['on', 'on', 'turned_on', 'turned_on', 'below_threshold'], 
+                                   ['off', 'turned_off']])
+        # the allocations are reset once the overproduction has ended
+        self.assertEqual(manager._allocations, {})
+
+    async def test_priority_index(self):
+        clock=VirtualClock(datetime(2024, 6, 1, 12))
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, clock=clock)
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=100, consumer_efficiency=0.5)
+        plugs=[KnownStatePlugControllerMock(logger, cfg, clock) for _ in range(100)]
+        for i, plug in enumerate(plugs):
+            manager._add_plug_controller(f"plug_{i}", plug)
+            plug.switch(i < 50)
+        await plugs[50].set_enabled(False)
+        for watt_obtained, watt_produced in [(100, 0), (100, 0), (0, 0), (0, 500), (300, 0), (300, 0), (300, 0)]:
+            clock.advance(timedelta(minutes=1))
+            await manager.add_smart_meter_values(watt_obtained, watt_produced)
+        results=[[(d.uuid, d.result) for d in trace.plugs] for trace in manager.decisions]
+        # only the plug with the lowest (highest) prio being on (off) is checked. Disabled plugs are skipped.
+        self.assertEqual(results, [[('plug_49', 'turned_off')], [('plug_48', 'turned_off')], [('plug_48', 'below_threshold')], [('plug_48', 'turned_on')], 
+                                   [('plug_48', 'turned_off')], [('plug_47', 'turned_off')], [('plug_46', 'turned_off')]])
+        self.assertEqual(sum(plug.requests for plug in plugs), sum(plug.requests for plug in plugs[46:50]))
+        # state changes reported by the plug (e.g. via openHAB) are taken into account without requests
+        plugs[45].switch(False)
+        clock.advance(timedelta(minutes=1))
+        await manager.add_smart_meter_values(300, 0)
+        self.assertEqual([(d.uuid, d.result) for d in manager.decisions[-1].plugs], [('plug_44', 'turned_off')])
+        self.assertEqual(plugs[45].requests, 0)
+
+    async def test_adaptive_eval_time(self):
+        clock=VirtualClock(datetime(2024, 6, 1, 12))
+        manager=PlugManager(logger, 5, TestPlugManager.default_base_load_in_watt, clock=clock, 
+                            eval_time_limits=(timedelta(minutes=1), timedelta(minutes=10)), volatility_reference_in_watt=200)
+        self.assertEqual((await manager.state)['eval_time_in_sec'], 300)
+        # stable values -> shortest time frame
+        for _ in range(20):
+            clock.advance(timedelta(seconds=30))
+            await manager.add_smart_meter_values(300, 0)
+        self.assertEqual((await manager.state)['eval_time_in_sec'], 60)
+        # volatile values (e.g. clouds) -> the time frame grows up to the maximum
+        for i in range(40):
+            clock.advance(timedelta(seconds=30))
+            await manager.add_smart_meter_values(600 if i % 2 else 0, 0)
+        self.assertEqual((await manager.state)['eval_time_in_sec'], 600)
+        # memory is bounded by the maximum time frame
+        self.assertLessEqual(manager._watt_obtained_values.value_count(), 20)
+        # the forecast follows the time frame
+        self.assertEqual(manager._watt_obtained_forecaster._trend_time_constant, 600)
+        self.assertEqual(manager._watt_produced_forecaster._level_time_constant, 300)
+
+    async def test_forecast_is_guarded_by_median(self):
+        clock=VirtualClock(datetime(2024, 6, 1, 12))
+        manager=PlugManager(logger, 5, TestPlugManager.default_base_load_in_watt, clock=clock, forecast_horizon=timedelta(minutes=15))
+        for watt_obtained in [-500, -500, -500, -500, 3000]:
+            clock.advance(timedelta(minutes=1))
+            await manager.add_smart_meter_values(watt_obtained, 2000)
+        # single spike: the trend of the raw values follows it, the median does not
+        trace=manager.decisions[-1]
+        self.assertEqual(trace.median, -500)
+        max_expected=-500 + 2*math.sqrt(manager._watt_obtained_values.variance())
+        self.assertGreater(trace.forecast, max_expected)
+        self.assertAlmostEqual(manager._expected_watt_obtained, max_expected)
+
+    async def test_deferrable_plug(self):
+        clock=VirtualClock(datetime(2024, 6, 1))
+        manager=PlugManager(logger, 15, TestPlugManager.default_base_load_in_watt, clock=clock)
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=500, consumer_efficiency=0.5, runtime_in_min=120, deadline='18:00')
+        manager._add_plug_controller("D", PlugControllerMock(logger, cfg, clock))
+        switches : List[Tuple[datetime, str]] = []
+        for _ in range(2*24*12):
+            clock.advance(timedelta(minutes=5))
+            hour=clock.now().hour + clock.now().minute/60
+            # production peaks at 13:00
+            watt_produced=max(0.0, 1500 - 300*abs(hour - 13))
+            await manager.add_smart_meter_values(300 - watt_produced, watt_produced)
+            decisions=manager.decisions[-1].plugs
+            # the deferrable plug is not part of the usual on/off logic
+            self.assertEqual([decision.uuid for decision in decisions], ['D'])
+            if decisions[0].result in ('turned_on', 'turned_off'):
+                switches.append((clock.now(), decisions[0].result))
+        # first day: nothing is known about the surplus -> runs at once. Afterwards: runs while the expected surplus is highest.
+        self.assertEqual(switches, [(datetime(2024, 6, 1, 0, 5), 'turned_on'), (datetime(2024, 6, 1, 2, 5), 'turned_off'),
+                                    (datetime(2024, 6, 2, 12), 'turned_on'), (datetime(2024, 6, 2, 14), 'turned_off')])
+
+    async def test_dwell_times(self):
+        clock=VirtualClock(datetime(2024, 6, 1, 12))
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, clock=clock)
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5, 
+                            min_on_time_in_sec=600, min_off_time_in_sec=300, max_switches_per_hour=3)
+        plug=PlugControllerMock(logger, cfg, clock)
+        online_checks : List[datetime] = []
+        async def is_online() -> bool:
+            online_checks.append(clock.now())
+            return True
+        plug.is_online=is_online # type: ignore
+        manager._add_plug_controller("A", plug)
+        switches : List[datetime] = []
+        async def add_value(watt_obtained : float, watt_produced : float) -> None:
+            clock.advance(timedelta(seconds=30))
+            await manager.add_smart_meter_values(watt_obtained, watt_produced)
+            if manager.decisions[-1].plugs and manager.decisions[-1].plugs[0].result in ('turned_on', 'turned_off'):
+                switches.append(clock.now())
+        for watt_produced in [300, 500, 500]:
+            await add_value(0, watt_produced)
+        self.assertEqual(switches, [datetime(2024, 6, 1, 12, 1)])
+        # consumption: the plug stays on for 10 minutes. Locked plugs are not asked for their state.
+        online_checks.clear()
+        for _ in range(40):
+            await add_value(300, 0)
+        self.assertEqual(switches[1], datetime(2024, 6, 1, 12, 11))
+        locked=[trace.timestamp for trace in manager.decisions if trace.plugs[0].result == 'locked']
+        self.assertEqual(len(locked), 17)
+        self.assertFalse(set(locked) & set(online_checks))
+        # alternating values: dwell times and the maximum number of switches per hour are respected
+        for _ in range(240):
+            await add_value(0, 1000)
+            await add_value(300, 0)
+        self.assertGreater(len(switches), 6)
+        for turned_on, (previous, switch) in zip([True, False]*len(switches), zip(switches, switches[1:])):
+            self.assertGreaterEqual(switch - previous, timedelta(minutes=10 if turned_on else 5))
+        for previous, switch in zip(switches, switches[3:]):
+            self.assertGreaterEqual(switch - previous, timedelta(hours=1))
+
+    async def test_locked_plug_keeps_priority_order(self):
+        clock=VirtualClock(datetime(2024, 6, 1, 12))
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, clock=clock)
+        for uuid in ['A', 'B']:
+            manager._add_plug_controller(uuid, PlugControllerMock(logger, self._manager.plug(uuid).cfg, clock))
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=50, consumer_efficiency=0.5, 
+                            min_on_time_in_sec=600, max_switches_per_hour=2)
+        manager._add_plug_controller('C', PlugControllerMock(logger, cfg, clock))
+        for plug in manager.plugs():
+            plug._is_on=True # type: ignore
+        # C (lowest prio) has just been turned on. It stays on for 10 minutes.
+        manager.plug('C').record_switch(True, clock.now())
+        results=[]
+        for _ in range(12):
+            clock.advance(timedelta(minutes=1))
+            await manager.add_smart_meter_values(300, 0)
+            results.append([(d.uuid, d.result) for d in manager.decisions[-1].plugs])
+        # plugs with higher prio are not turned off while C is locked
+        self.assertEqual(results[:9], [[('C', 'locked')]]*9)
+        # a plug turned off by this service and locked by the maximum number of switches is skipped
+        self.assertEqual(results[9:], [[('C', 'turned_off')], [('C', 'locked'), ('B', 'turned_off')], [('C', 'locked'), ('B', 'off'), ('A', 'turned_off')]])
+
+    async def test_timeouts(self):
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, evaluation_deadline=timedelta(seconds=0.15))
+        cfg=SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5, io_timeout_in_sec=0.1)
+        for uuid in ["A", "B", "C"]:
+            plug=PlugControllerMock(logger, cfg)
+            plug._is_on=True
+            manager._add_plug_controller(uuid, plug)
+        # plugs which never answer
+        async def hang() -> bool:
+            await asyncio.sleep(3600)
+            return True
+        manager.plug("C").is_online=hang # type: ignore
+        manager.plug("B").is_online=hang # type: ignore
+        now=datetime.now()
+        start=time.perf_counter()
+        await manager.add_smart_meter_values(300, None, now)
+        await manager.add_smart_meter_values(300, None, now + timedelta(minutes=1))
+        # C: timeout. B: timeout limited by the deadline. A: skipped
+        self.assertLess(time.perf_counter() - start, 1)
+        trace=manager.decisions[-1]
+        self.assertEqual([(d.uuid, d.result) for d in trace.plugs], [('C', 'timeout'), ('B', 'timeout'), ('A', 'deadline_exceeded')])
+        self.assertLess(trace.plugs[1].duration_in_ms, 75)
+        self.assertTrue(trace.deadline_exceeded)
+        self.assertEqual(manager.ingestion_metrics['deadline_exceeded'], 2)
+        # without deadline each plug is limited by its own timeout
+        manager._evaluation_deadline=None
+        manager.plug("C").is_online=manager.plug("A").is_online # type: ignore
+        await manager.add_smart_meter_values(300, None, now + timedelta(minutes=2))
+        trace=manager.decisions[-1]
+        self.assertEqual([(d.uuid, d.result) for d in trace.plugs], [('C', 'turned_off')])
+        manager.plug("C").is_online=hang # type: ignore
+        await manager.add_smart_meter_values(300, None, now + timedelta(minutes=3))
+        self.assertEqual([(d.uuid, d.result) for d in manager.decisions[-1].plugs][:2], [('C', 'timeout'), ('B', 'timeout')])
+        self.assertEqual(manager.decisions[-1].plugs[-1].result, 'turned_off')
+
+    async def test_no_timeouts_by_default(self):
+        manager=PlugManager.from_config(logger, GeneralConfig(eval_time_in_min=TestPlugManager.eval_time_in_min))
+        plug=PlugControllerMock(logger, SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5))
+        plug._is_on=True
+        manager._add_plug_controller("A", plug)
+        # slow plug (e.g. a Tapo handshake)
+        async def slow() -> bool:
+            await asyncio.sleep(0.2)
+            return True
+        plug.is_online=slow # type: ignore
+        await manager.add_smart_meter_values(300, None)
+        self.assertEqual([(d.uuid, d.result) for d in manager.decisions[-1].plugs], [('A', 'turned_off')])
+        self.assertFalse(manager.decisions[-1].deadline_exceeded)
+
+    async def test_timeout_of_openhab_request(self):
+        # openHAB which never answers a POST
+        async def post_item(request : web.Request) -> web.Response:
+            await asyncio.sleep(3600)
+            return web.Response()
+        app=web.Application()
+        app.router.add_post('/rest/items/{item}', post_item)
+        runner=web.AppRunner(app, handler_cancellation=True)
+        await runner.setup()
+        site=web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        try:
+            oh_connection=OpenhabConnection(OpenHabConnectionConfig(f"http://127.0.0.1:{runner.addresses[0][1]}"), logger)
+            clock=VirtualClock(datetime(2024, 6, 1, 12))
+            manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt, clock=clock)
+            plug_cfg=OpenHabSmartPlugConfig('openhab', True, 200, 0.5, 'thing', 'switch', 'power', '', io_timeout_in_sec=0.1)
+            plug=OpenHabPlugController(logger, plug_cfg, clock, oh_connection=oh_connection)
+            await plug.update_values(0, True, False)
+            manager._add_plug_controller("A", plug)
+            for watt_obtained, watt_produced in [(100, 0), (100, 0), (0, 0), (0, 500), (0, 500)]:
+                clock.advance(timedelta(minutes=1))
+                await manager.add_smart_meter_values(watt_obtained, watt_produced)
+            # the cancellation of the watchdog is neither swallowed nor leaked. Each timeout is reported as such.
+            self.assertEqual([trace.plugs[0].result for trace in manager.decisions[-2:]], ['timeout', 'timeout'])
+            self.assertEqual(asyncio.current_task().cancelling(), 0) # type: ignore
+        finally:
+            await runner.cleanup()
+
+    async def test_cancel_evaluation(self):
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt)
+        plug=PlugControllerMock(logger, SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5))
+        async def hang() -> bool:
+            await asyncio.sleep(3600)
+            return True
+        plug.is_online=hang # type: ignore
+        manager._add_plug_controller("A", plug)
+        # cancellations from outside are not reported as timeout
+        task=asyncio.create_task(manager.add_smart_meter_values(300, None, datetime.now()))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+    async def test_resync_openhab_plugs(self):
+        class OpenhabConnectionMock():
+            def __init__(self) -> None:
+                self.item_states={'switch_A': 'ON', 'power_A': '150 W', 'switch_B': 'OFF', 'power_B': 'NULL'}
+                self.thing_states={'thing_A': 'ONLINE', 'thing_B': 'OFFLINE'}
+                self.reads : List[Tuple[Set[str], Set[str]]] = []
+
+            async def post_to_item(self, oh_item_name : str, value : Any) -> bool:
+                return True
+
+            async def read_states(self, item_names : Set[str], thing_uids : Set[str]):
+                self.reads.append((item_names, thing_uids))
+                return {name: self.item_states[name] for name in item_names}, {uid: self.thing_states[uid] for uid in thing_uids}
+
+        oh_connection=OpenhabConnectionMock()
+        manager=PlugManager(logger, TestPlugManager.eval_time_in_min, TestPlugManager.default_base_load_in_watt)
+        plugs=[OpenHabPlugController(logger, OpenHabSmartPlugConfig('openhab', True, 100, 0.5, f"thing_{name}", f"switch_{name}", f"power_{name}", ''), 
+                                     oh_connection=oh_connection) for name in ['A', 'B']]
+        manager._add_plug_controller("A", plugs[0])
+        manager._add_plug_controller("B", plugs[1])
+        manager._add_plug_controller("C", PlugControllerMock(logger, SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5)))
+        await plugs[1].update_values(100, False, False)
+        await manager.resync_openhab_plugs()
+        # one read for all plugs of the connection
+        self.assertEqual(oh_connection.reads, [({'switch_A', 'power_A', 'switch_B', 'power_B'}, {'thing_A', 'thing_B'})])
+        # update of plug A has been missed. plug B is in sync.
+        self.assertTrue(await plugs[0].is_on())
+        self.assertEqual(plugs[0].watt_consumed, 150)
+        self.assertEqual(plugs[0].known_state, True)
+        self.assertEqual(plugs[0].actuation_metrics['resynced'], 1)
+        self.assertFalse(await plugs[1].is_online())
+        self.assertEqual(plugs[1].watt_consumed, 100)
+        self.assertEqual(plugs[1].actuation_metrics['resynced'], 0)
+        # unknown items are skipped
+        oh_connection.item_states.pop('switch_B')
+        oh_connection.item_states['switch_A']='OFF'
+        async def read_states(item_names : Set[str], thing_uids : Set[str]):
+            return {name: oh_connection.item_states[name] for name in item_names if name in oh_connection.item_states}, dict(oh_connection.thing_states)
+        oh_connection.read_states=read_states # type: ignore
+        await manager.resync_openhab_plugs()
+        self.assertFalse(await plugs[0].is_on())
+        self.assertEqual(plugs[0].actuation_metrics['resynced'], 2)
+        self.assertEqual(plugs[1].actuation_metrics['resynced'], 0)
+
 if __name__ == '__main__':
     try:
         unittest.main()
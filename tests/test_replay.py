@@ -0,0 +1,80 @@
+import logging
+import sys
+import unittest
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from smartplug_energy_controller.replay import Replay, read_csv
+from smartplug_energy_controller.config import GeneralConfig, SmartPlugConfig
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+class TestReplay(unittest.IsolatedAsyncioTestCase):
+    def _create_replay(self, **kwargs) -> Replay:
+        plug_cfgs={'A': SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5),
+                   'B': SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=100, consumer_efficiency=0.5)}
+        return Replay(logger, plug_cfgs, GeneralConfig(eval_time_in_min=2, default_base_load_in_watt=200, **kwargs))
+
+    async def test_run(self) -> None:
+        start=datetime(2024, 6, 1, 12)
+        # 10 minutes of 500 Watt feed-in followed by 10 minutes of 300 Watt consumption
+        readings=[(start + timedelta(seconds=i), -500.0 if i < 600 else 300.0, 800.0 if i < 600 else 0.0) for i in range(1200)]
+        result=await self._create_replay().run(readings)
+        self.assertEqual(result.readings, 1200)
+        self.assertAlmostEqual(result.simulated_time_in_h, 1199/3600)
+        self.assertEqual([(entry.plug_uuid, entry.state) for entry in result.schedule], [('A', 'On'), ('B', 'On'), ('B', 'Off'), ('A', 'Off')])
+        self.assertEqual(result.switch_count, 4)
+        self.assertEqual(result.plugs['A'].switch_count, 2)
+        # plugs are running on produced energy only while feeding in
+        self.assertGreater(result.plugs['A'].on_time_in_h, 0)
+        self.assertGreater(result.self_consumption_in_kwh, 0)
+        self.assertLessEqual(result.self_consumption_ratio, 1)
+        self.assertAlmostEqual(result.plug_consumption_in_kwh, result.plugs['A'].consumption_in_kwh + result.plugs['B'].consumption_in_kwh)
+        self.assertGreaterEqual(result.grid_draw_in_kwh, result.grid_draw_without_plugs_in_kwh)
+
+    async def test_forecast(self) -> None:
+        start=datetime(2024, 6, 1, 12)
+        # production ramps up to 1000 Watt within 10 minutes and down again (consumption of 300 Watt)
+        produced=[1000*min(i, 1200-i, 600)/600 if i < 1200 else 0 for i in range(0, 1500, 5)]
+        readings=[(start + timedelta(seconds=i*5), 300 - value, value) for i, value in enumerate(produced)]
+        result=await self._create_replay().run(readings)
+        forecast_result=await self._create_replay(forecast_horizon_in_sec=60).run(readings)
+        self.assertEqual(result.forecast_count, 0)
+        self.assertGreater(forecast_result.forecast_count, 0)
+        self.assertGreater(forecast_result.forecast_mae_in_watt, 0)
+        # plugs are turned on ahead of the evaluation window
+        self.assertLess(forecast_result.schedule[0].timestamp, result.schedule[0].timestamp)
+        self.assertGreater(forecast_result.self_consumption_in_kwh, result.self_consumption_in_kwh)
+
+    async def test_general_config(self) -> None:
+        start=datetime(2024, 6, 1, 12)
+        readings=[(start + timedelta(seconds=i), -500.0, 800.0) for i in range(600)]
+        result=await self._create_replay().run(readings)
+        allocated_result=await self._create_replay(allocate_surplus=True).run(readings)
+        # allocate_surplus of the config is used (like in the service): the surplus not sufficient for A is allocated to B
+        self.assertEqual([entry.plug_uuid for entry in result.schedule], ['A', 'B'])
+        self.assertEqual([entry.plug_uuid for entry in allocated_result.schedule], ['B', 'A'])
+        self.assertLess(allocated_result.schedule[0].timestamp, result.schedule[0].timestamp)
+
+    async def test_run_without_readings(self) -> None:
+        result=await self._create_replay().run([])
+        self.assertEqual(result.readings, 0)
+        self.assertEqual(result.schedule, [])
+
+    def test_read_csv(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file=Path(tmp_dir)/'readings.csv'
+            file.write_text("timestamp,obtained,produced\n2024-06-01T12:00:00,100,50\n1717243201,-20.5,\n")
+            readings=list(read_csv(file))
+        self.assertEqual(readings[0], (datetime(2024, 6, 1, 12), 100, 50))
+        self.assertEqual(readings[1], (datetime.fromtimestamp(1717243201), -20.5, None))
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")
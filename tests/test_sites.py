@@ -0,0 +1,48 @@
+import logging
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from smartplug_energy_controller.config import ConfigParser
+from smartplug_energy_controller.sites import Sites
+from smartplug_energy_controller.utils import ClientSessionPool, VirtualClock
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+config_file = Path(__file__).parent.absolute()/'data'/'config.example.yml'
+
+class TestSites(unittest.IsolatedAsyncioTestCase):
+    async def test_sites(self) -> None:
+        clock = VirtualClock(datetime(2024, 6, 1, 12))
+        sites = Sites(logger, clock, ClientSessionPool())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ['home', 'office']:
+                shutil.copy(config_file, Path(tmp_dir)/f"{name}.yml")
+            sites.load(Path(tmp_dir))
+        self.assertEqual(sites.names, ['home', 'office'])
+        self.assertIn('home', sites)
+        self.assertNotIn('unknown', sites)
+        with self.assertRaises(ValueError):
+            sites.add('home', ConfigParser(config_file, None))
+        # each site has its own manager and openHAB connection
+        self.assertIsNot(sites['home'].manager, sites['office'].manager)
+        self.assertIsNot(sites['home'].oh_connection, sites['office'].oh_connection)
+        clock.advance(timedelta(seconds=30))
+        await sites['home'].manager.add_smart_meter_values(300)
+        self.assertEqual(len(sites['home'].manager.decisions), 1)
+        self.assertEqual(len(sites['office'].manager.decisions), 0)
+        # shared objects (clock, connection pool) are not part of the memory of a site
+        self.assertGreater(sites.memory_in_bytes('home'), sites.memory_in_bytes('office'))
+        self.assertGreater(sites.memory_in_bytes('office'), 0)
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")
@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+from pathlib import Path
+
+from ruamel.yaml import YAML
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+test_path = Path(__file__).parent.absolute()
+config_file=Path(f"{test_path}/data/config.example.yml")
+# NOTE: generous limits (slow CI runners). On a desktop the import takes about 0.3 seconds.
+_max_import_time_in_sec=3
+_max_time_to_accept_requests_in_sec=15
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class TestStartup(unittest.TestCase):
+    def test_import(self) -> None:
+        # NOTE: the config does not exist. Importing the app must neither parse it nor create anything else.
+        env=dict(os.environ, CONFIG_PATH='/does/not/exist.yml', SMARTPLUG_ENERGY_CONTROLLER_PORT='8000', PYTHONPATH=f"{test_path}/..")
+        code=("import sys, time, json\n"
+              "start=time.perf_counter()\n"
+              "import smartplug_energy_controller.app\n"
+              "print(json.dumps({'import_time_in_sec': time.perf_counter() - start, 'modules': sorted(sys.modules)}))")
+        result=json.loads(subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True).stdout)
+        self.assertLess(result['import_time_in_sec'], _max_import_time_in_sec)
+        # imported lazily
+        for module in ['plugp100', 'aiohttp', 'uvicorn', 'smartplug_energy_controller.openhab_events']:
+            self.assertNotIn(module, result['modules'])
+
+    def test_time_to_accept_requests(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            yaml=YAML(typ='safe', pure=True)
+            data=yaml.load(config_file)
+            data['log_file']=f"{tmp_dir}/test.log"
+            service_config=Path(tmp_dir)/'config.yml'
+            yaml.dump(data, service_config)
+            port=_free_port()
+            env=dict(os.environ, CONFIG_PATH=str(service_config), SMARTPLUG_ENERGY_CONTROLLER_PORT=str(port), PYTHONPATH=f"{test_path}/..")
+            start=time.monotonic()
+            process=subprocess.Popen([sys.executable, '-c', 'from smartplug_energy_controller.app import serve; serve()'], env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while True:
+                    self.assertIsNone(process.poll(), "The service exited during startup")
+                    self.assertLess(time.monotonic() - start, _max_time_to_accept_requests_in_sec)
+                    try:
+                        with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                            self.assertEqual(response.status, 200)
+                            break
+                    except OSError:
+                        time.sleep(0.05)
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")
@@ -0,0 +1,63 @@
+import logging
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+from smartplug_energy_controller import sweep as sweep_module
+from smartplug_energy_controller.sweep import SharedReadings, create_grid, sweep
+from smartplug_energy_controller.config import GeneralConfig, SmartPlugConfig
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+class TestSweep(unittest.TestCase):
+    def setUp(self) -> None:
+        self._plug_cfgs={'A': SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=200, consumer_efficiency=0.5),
+                         'B': SmartPlugConfig(type='testing', enabled=True, expected_consumption_in_watt=100, consumer_efficiency=0.5)}
+
+    def test_create_grid(self) -> None:
+        grid=create_grid(self._plug_cfgs, [2, 5], [0.075], {'A': [0.3, 0.5, 0.7]}, {'A': [200, 400], 'B': [50, 100]})
+        self.assertEqual(len(grid), 2*3*2*2)
+        self.assertEqual(len(set(grid)), len(grid))
+        # values of the config are used for plugs without grid
+        self.assertTrue(all(dict(parameters.consumer_efficiency)['B'] == 0.5 for parameters in grid))
+
+    def test_shared_readings(self) -> None:
+        start=datetime(2024, 6, 1, 12)
+        # streamed (generator) into blocks of 4 readings. The last block is filled partially.
+        readings=((start + timedelta(seconds=i), float(i), float(2*i) if i % 2 == 0 else None) for i in range(10))
+        shared_readings=SharedReadings(readings, chunk_size=4)
+        try:
+            self.assertEqual((shared_readings.count, shared_readings.start_time, len(shared_readings.names)), (10, start, 3))
+            sweep_module._init_worker(shared_readings.names, shared_readings.chunk_size, shared_readings.count, shared_readings.start_time, {}, GeneralConfig())
+            self.assertEqual(list(sweep_module._iter_worker_readings()),
+                             [(start + timedelta(seconds=i), float(i), float(2*i) if i % 2 == 0 else None) for i in range(10)])
+        finally:
+            for block in sweep_module._worker_blocks:
+                block.close()
+            sweep_module._worker_blocks=[]
+            shared_readings.close()
+        with self.assertRaises(ValueError):
+            SharedReadings(iter([]))
+
+    def test_sweep(self) -> None:
+        start=datetime(2024, 6, 1, 12)
+        # 10 minutes of 500 Watt feed-in followed by 10 minutes of 300 Watt consumption
+        readings=[(start + timedelta(seconds=i), -500.0 if i < 600 else 300.0, 800.0 if i < 600 else None) for i in range(1200)]
+        grid=create_grid(self._plug_cfgs, [2, 5], [0.075], {'A': [0.2, 0.8]}, {})
+        results=sweep(readings, self._plug_cfgs, GeneralConfig(default_base_load_in_watt=200), grid, max_workers=2)
+        self.assertEqual(len(results), len(grid))
+        self.assertEqual(set(result.parameters for result in results), set(grid))
+        for better, worse in zip(results, results[1:]):
+            self.assertGreaterEqual(better.self_consumption_in_kwh, worse.self_consumption_in_kwh)
+            if better.self_consumption_in_kwh == worse.self_consumption_in_kwh:
+                self.assertLessEqual(better.switch_count, worse.switch_count)
+        self.assertGreater(results[0].self_consumption_in_kwh, 0)
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")
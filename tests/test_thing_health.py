@@ -0,0 +1,104 @@
+import logging
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+from oh_to_smartplug_energy_controller.thing_health import ThingHealth
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+class TestThingHealth(unittest.TestCase):
+    def test_status(self) -> None:
+        now=datetime(2024, 6, 1, 12)
+        health=ThingHealth(now, min_stale_time=timedelta(minutes=5))
+        # idle plug: no updates of its items for hours. The thing is ONLINE.
+        for minute in range(1, 12*60):
+            self.assertFalse(health.check(now + timedelta(minutes=minute)))
+        self.assertIsNone(health.silence_time())
+        now+=timedelta(hours=12)
+        health.status_changed(now, False)
+        # polling the unchanged status does not move the time it went offline
+        health.status_changed(now + timedelta(minutes=3), False)
+        self.assertEqual(health.offline_since, now)
+        self.assertFalse(health.check(now + timedelta(minutes=5)))
+        self.assertTrue(health.check(now + timedelta(minutes=6)))
+        # back online (e.g. a short outage of the WiFi)
+        health.status_changed(now + timedelta(minutes=6), True)
+        self.assertFalse(health.check(now + timedelta(minutes=7)))
+
+    def test_cadence(self) -> None:
+        now=datetime(2024, 6, 1, 12)
+        health=ThingHealth(now, max_silence=timedelta(minutes=1), stale_factor=3)
+        self.assertEqual(health.silence_time(), timedelta(minutes=1))
+        for _ in range(20):
+            now+=timedelta(seconds=30)
+            health.updated(now)
+            self.assertFalse(health.check(now))
+        self.assertEqual(health.cadence, timedelta(seconds=30))
+        self.assertEqual(health.silence_time(), timedelta(seconds=90))
+        # slower updates increase the expected cadence
+        for _ in range(20):
+            now+=timedelta(minutes=1)
+            health.updated(now)
+        self.assertAlmostEqual(health.cadence.total_seconds(), 60, delta=1) # type: ignore
+        self.assertFalse(health.check(now + timedelta(minutes=2)))
+        self.assertTrue(health.check(now + timedelta(minutes=4)))
+
+    def test_restart_backoff(self) -> None:
+        now=datetime(2024, 6, 1, 12)
+        health=ThingHealth(now, online=False, min_stale_time=timedelta(minutes=5), initial_backoff=timedelta(minutes=5), max_backoff=timedelta(minutes=20))
+        restarts=[]
+        for minute in range(1, 120):
+            if health.check(now + timedelta(minutes=minute)):
+                restarts.append(minute)
+                health.restarted(now + timedelta(minutes=minute), success=False)
+        # stale after 5 minutes. Restarted after a backoff of 5, 10, 20, 20, ... minutes
+        self.assertEqual(restarts[:5], [6, 11, 21, 41, 61])
+        self.assertEqual(health.counters['failed_restarts'], len(restarts))
+        # the thing is ONLINE again. This resets the backoff.
+        now+=timedelta(minutes=120)
+        health.status_changed(now, True)
+        health.status_changed(now + timedelta(minutes=1), False)
+        self.assertFalse(health.check(now + timedelta(minutes=6)))
+        self.assertTrue(health.check(now + timedelta(minutes=7)))
+        health.restarted(now + timedelta(minutes=7), success=True)
+        self.assertFalse(health.check(now + timedelta(minutes=11)))
+        self.assertTrue(health.check(now + timedelta(minutes=12)))
+        self.assertEqual(health.counters['restarts'], 1)
+
+    def test_restart_backoff_of_silent_thing(self) -> None:
+        now=datetime(2024, 6, 1, 12)
+        health=ThingHealth(now, max_silence=timedelta(minutes=5), initial_backoff=timedelta(minutes=5))
+        self.assertTrue(health.check(now + timedelta(minutes=6)))
+        health.restarted(now + timedelta(minutes=6), success=True)
+        # ONLINE after the restart, but still no updates: the backoff is kept
+        health.status_changed(now + timedelta(minutes=6), True)
+        self.assertFalse(health.check(now + timedelta(minutes=10)))
+        self.assertTrue(health.check(now + timedelta(minutes=11)))
+        health.restarted(now + timedelta(minutes=11), success=True)
+        self.assertFalse(health.check(now + timedelta(minutes=20)))
+        # updates after the restart reset the backoff. The interval since the last update does not change the cadence.
+        now+=timedelta(minutes=30)
+        health.updated(now)
+        self.assertIsNone(health.cadence)
+        self.assertFalse(health.check(now + timedelta(minutes=5)))
+        self.assertTrue(health.check(now + timedelta(minutes=6)))
+
+    def test_restarts_avoided(self) -> None:
+        now=datetime(2024, 6, 1, 12)
+        health=ThingHealth(now, legacy_restart_interval=timedelta(minutes=21))
+        for minute in range(1, 24*60 + 1):
+            health.updated(now + timedelta(minutes=minute))
+            self.assertFalse(health.check(now + timedelta(minutes=minute)))
+        # one restart per 21 minutes used to be done
+        self.assertEqual(health.counters['restarts_avoided'], 24*60//21)
+        self.assertEqual(health.counters['restarts'], 0)
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")
@@ -124,6 +124,204 @@ class TestRollingValues(unittest.TestCase):
         rolling_values.add(ValueEntry(1000, now + timedelta(minutes=16)))
         self.assertEqual(rolling_values.median(), 0)
 
+    def test_variance(self) -> None:
+        rolling_values = RollingValues(timedelta(minutes=5))
+        now = datetime(2024, 6, 1, 12)
+        for i in range(2000):
+            value = 1000 + (i*37 % 101)*(1 if i % 2 else -1)
+            rolling_values.add(ValueEntry(value, now + i*timedelta(seconds=1)))
+        # the first value of the window is not weighted
+        expected = [rolling_values[i].value for i in range(1, rolling_values.value_count())]
+        mean = sum(expected)/len(expected)
+        self.assertAlmostEqual(rolling_values.variance(), sum((v - mean)**2 for v in expected)/len(expected), places=6)
+        # a shorter window drops the oldest values at once
+        rolling_values.set_time_delta(timedelta(minutes=1))
+        self.assertEqual(rolling_values.time_delta(), timedelta(minutes=1))
+        self.assertEqual(rolling_values.value_count(), 60)
+        expected = [rolling_values[i].value for i in range(1, rolling_values.value_count())]
+        mean = sum(expected)/len(expected)
+        self.assertAlmostEqual(rolling_values.variance(), sum((v - mean)**2 for v in expected)/len(expected), places=6)
+
+
+class TestClock(unittest.IsolatedAsyncioTestCase):
+    def test_monotonic_clock(self) -> None:
+        clock = MonotonicClock()
+        timestamps = [clock.now() for _ in range(100)]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    async def test_virtual_clock(self) -> None:
+        start = datetime(2024, 6, 1, 12)
+        clock = VirtualClock(start)
+        self.assertEqual(clock.now(), start)
+        woken_up : List[datetime] = []
+        async def sleeper(seconds : float) -> None:
+            await clock.sleep(seconds)
+            woken_up.append(clock.now())
+        tasks = [asyncio.create_task(sleeper(60)), asyncio.create_task(sleeper(3600))]
+        await asyncio.sleep(0)
+        clock.advance(timedelta(seconds=59))
+        await asyncio.sleep(0)
+        self.assertEqual(woken_up, [])
+        clock.advance(timedelta(seconds=1))
+        await asyncio.sleep(0)
+        self.assertEqual(woken_up, [start + timedelta(minutes=1)])
+        clock.set(start + timedelta(days=1))
+        await asyncio.gather(*tasks)
+        self.assertEqual(len(woken_up), 2)
+        with self.assertRaises(ValueError):
+            clock.set(start)
+
+    async def test_scheduler(self) -> None:
+        clock = VirtualClock(datetime(2024, 6, 1))
+        scheduler = Scheduler(logger, clock)
+        run_times : List[datetime] = []
+        async def job() -> None:
+            run_times.append(clock.now())
+        scheduler.add_job(job, timedelta(hours=1))
+        # one day in steps of one minute
+        for _ in range(24*60):
+            clock.advance(timedelta(minutes=1))
+            await scheduler.run_due_jobs()
+        self.assertEqual(run_times, [datetime(2024, 6, 1) + timedelta(hours=i+1) for i in range(24)])
+        # running in the background
+        scheduler.start()
+        await asyncio.sleep(0)
+        clock.advance(timedelta(hours=1))
+        for _ in range(3):
+            await asyncio.sleep(0)
+        scheduler.shutdown()
+        self.assertEqual(len(run_times), 25)
+
+class TestTimeoutWatchdog(unittest.IsolatedAsyncioTestCase):
+    async def test_timeouts(self) -> None:
+        watchdog = TimeoutWatchdog()
+        watchdog.bind()
+        # the timer is scheduled for the first (short) timeout and fires too early for the second call
+        watchdog.arm(0.02)
+        watchdog.disarm()
+        watchdog.arm(0.2)
+        await asyncio.sleep(0.05)
+        watchdog.disarm()
+        watchdog.arm(0.02)
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.sleep(1)
+        self.assertTrue(watchdog.timed_out())
+        watchdog.disarm()
+        # the task is usable afterwards
+        await asyncio.sleep(0.03)
+        watchdog.close()
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_states(self) -> None:
+        clock = VirtualClock(datetime(2024, 6, 1))
+        changes : List[str] = []
+        breaker = CircuitBreaker(clock, failure_threshold=3, backoff=timedelta(seconds=30), max_backoff=timedelta(seconds=100), 
+                                 on_change=lambda: changes.append(breaker.state))
+        for _ in range(2):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        # backoff grows exponentially (up to max_backoff) while probes fail
+        for backoff in [30, 60, 100, 100]:
+            self.assertEqual(breaker.open_until, clock.now() + timedelta(seconds=backoff))
+            clock.advance(timedelta(seconds=backoff-1))
+            self.assertFalse(breaker.allow())
+            clock.advance(timedelta(seconds=1))
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, 'half_open')
+            # only one probe at a time
+            self.assertFalse(breaker.allow())
+            breaker.record_failure()
+        clock.advance(timedelta(seconds=100))
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.failures, 0)
+        self.assertIsNone(breaker.open_until)
+        self.assertEqual(changes[:3], ['open', 'half_open', 'open'])
+        self.assertEqual(changes[-1], 'closed')
+
+class TestTrendForecaster(unittest.TestCase):
+    def test_forecast(self) -> None:
+        forecaster = TrendForecaster(timedelta(seconds=30), timedelta(seconds=60))
+        self.assertIsNone(forecaster.forecast(timedelta(seconds=60)))
+        start = datetime(2024, 6, 1, 12)
+        # linear ramp of 2 Watt per second with irregular intervals
+        seconds = 0
+        for i in range(200):
+            seconds += 1 + i % 3
+            forecaster.add(2.0*seconds, start + timedelta(seconds=seconds))
+        self.assertAlmostEqual(forecaster.trend_per_sec, 2, places=2)
+        self.assertAlmostEqual(forecaster.forecast(timedelta(seconds=60)), 2.0*(seconds + 60), delta=1) # type: ignore
+        # values with the same timestamp are ignored
+        forecaster.add(0, start + timedelta(seconds=seconds))
+        self.assertAlmostEqual(forecaster.level, 2.0*seconds, delta=1) # type: ignore
+
+class TestPriorityIndex(unittest.TestCase):
+    def test_update(self) -> None:
+        index = PriorityIndex()
+        self.assertIsNone(index.next_off())
+        self.assertIsNone(index.next_on())
+        for priority, is_on in enumerate([True, False, None, False, True]):
+            index.update(priority, True, is_on)
+        # unknown state (2) is a candidate for both
+        self.assertEqual([index.next_off(), index.next_off(1), index.next_off(2), index.next_off(3)], [1, 2, 3, None])
+        self.assertEqual([index.next_on(), index.next_on(4), index.next_on(2), index.next_on(0)], [4, 2, 0, None])
+        index.update(1, True, True)
+        index.update(2, False, None)
+        self.assertEqual(index.next_off(), 3)
+        self.assertEqual(index.next_on(4), 1)
+
+class TestDroppingQueueHandler(unittest.TestCase):
+    def test_drop_when_full(self) -> None:
+        test_logger=logging.getLogger('test_dropping_queue_handler')
+        test_logger.propagate=False
+        handler=DroppingQueueHandler(queue_size=2)
+        test_logger.addHandler(handler)
+        try:
+            for i in range(5):
+                test_logger.error("value %s", i)
+            self.assertEqual(handler.dropped, 3)
+            records=[handler.queue.get_nowait(), handler.queue.get_nowait()]
+            # the message is formatted by the caller. Later changes of the arguments do not matter.
+            self.assertEqual([(record.msg, record.args) for record in records], [("value 0", None), ("value 1", None)])
+            # the dropped records are reported once the queue has room again
+            test_logger.error("value %s", 5)
+            records=[handler.queue.get_nowait(), handler.queue.get_nowait()]
+            self.assertEqual([record.getMessage() for record in records], ["Dropped 3 log records. The log handler is too slow.", "value 5"])
+            self.assertEqual(records[0].levelno, logging.WARNING)
+        finally:
+            test_logger.removeHandler(handler)
+
+    def test_exception_is_formatted_by_caller(self) -> None:
+        test_logger=logging.getLogger('test_dropping_queue_handler_exception')
+        test_logger.propagate=False
+        handler=DroppingQueueHandler(queue_size=2)
+        test_logger.addHandler(handler)
+        values=[1]
+        try:
+            try:
+                raise ValueError("invalid value")
+            except ValueError:
+                test_logger.exception("values %s", values)
+            values.append(2)
+            record=handler.queue.get_nowait()
+            self.assertEqual(record.getMessage(), "values [1]")
+            self.assertIn("ValueError: invalid value", record.exc_text)
+            entry=json.loads(JsonFormatter().format(record))
+            self.assertIn("ValueError: invalid value", entry['exception'])
+        finally:
+            test_logger.removeHandler(handler)
+
+    def test_json_formatter(self) -> None:
+        record=logging.makeLogRecord({'name': 'test', 'levelno': logging.INFO, 'levelname': 'INFO', 'msg': "value %s", 'args': (1.5,)})
+        entry=json.loads(JsonFormatter().format(record))
+        self.assertEqual((entry['level'], entry['logger'], entry['message']), ('INFO', 'test', "value 1.5"))
+        self.assertIn('time', entry)
+
 if __name__ == '__main__':
     try:
         unittest.main()
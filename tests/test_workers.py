@@ -0,0 +1,124 @@
+import logging
+import os
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from functools import cached_property
+from pathlib import Path
+from typing import Dict
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+
+from smartplug_energy_controller.app import serve
+from smartplug_energy_controller.config import SmartPlugConfig
+from smartplug_energy_controller.plug_controller import PlugController
+from smartplug_energy_controller.plug_manager import PlugManager
+from smartplug_energy_controller.utils import MonotonicClock, Scheduler
+from smartplug_energy_controller.workers import Owner, SnapshotReader, SnapshotWriter, create_worker_app
+
+logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
+logger = logging.getLogger(__name__)
+
+class PlugControllerMock(PlugController):
+    def __init__(self, logger, cfg : SmartPlugConfig) -> None:
+        super().__init__(logger, cfg)
+        self._is_on = False
+
+    @cached_property
+    def info(self) -> Dict[str, str]:
+        return {'type': 'testing'}
+
+    def reset(self) -> None:
+        pass
+
+    async def is_online(self) -> bool:
+        return True
+
+    async def is_on(self) -> bool:
+        return self._is_on
+
+class TestSnapshot(unittest.TestCase):
+    def test_write_read(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = SnapshotWriter(Path(tmp_dir)/'snapshot', capacity=1024)
+            reader = SnapshotReader(Path(tmp_dir)/'snapshot')
+            writer.write({'a': 1})
+            first = reader.read()
+            self.assertEqual(first, {'a': 1})
+            # unchanged snapshots are not parsed again
+            self.assertIs(reader.read(), first)
+            writer.write({'a': 2, 'timestamp': datetime(2024, 6, 1)})
+            self.assertEqual(reader.read(), {'a': 2, 'timestamp': '2024-06-01 00:00:00'})
+            # the file grows in case a snapshot exceeds the capacity
+            writer.write({'a': 'x'*5000})
+            self.assertEqual(writer.capacity, 8*1024)
+            self.assertEqual(reader.read(), {'a': 'x'*5000})
+            writer.close()
+
+    def test_read_timeout(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = SnapshotWriter(Path(tmp_dir)/'snapshot', capacity=1024)
+            reader = SnapshotReader(Path(tmp_dir)/'snapshot', timeout_in_sec=0.1)
+            # nothing has been published yet. The reader backs off instead of spinning.
+            cpu_time = time.process_time()
+            with self.assertRaises(RuntimeError):
+                reader.read()
+            self.assertLess(time.process_time() - cpu_time, 0.05)
+            writer.close()
+
+class TestWorkers(unittest.TestCase):
+    def test_forwarding(self) -> None:
+        manager = PlugManager(logger, eval_time_in_min=5, default_base_load_in_watt=250)
+        manager._add_plug_controller('A', PlugControllerMock(logger, SmartPlugConfig(type='testing', expected_consumption_in_watt=100, consumer_efficiency=0.5)))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            owner = Owner(logger, manager, Scheduler(logger, MonotonicClock()), Path(tmp_dir)/'owner.sock', Path(tmp_dir)/'snapshot', 
+                          published_decisions=2)
+            owner.start()
+            try:
+                # NOTE: use one event loop for all requests (like a uvicorn worker)
+                with TestClient(create_worker_app(Path(tmp_dir)/'owner.sock', Path(tmp_dir)/'snapshot')) as client:
+                    response = client.get("/smart-meter")
+                    assert response.status_code == 200
+                    self.assertEqual(response.json()['base_load'], 250)
+                    etag = response.headers['ETag']
+                    assert client.get("/smart-meter", headers={'If-None-Match': etag}).status_code == 304
+                    now = datetime.now()
+                    for i in range(3):
+                        response = client.put("/smart-meter", json={'watt_obtained_from_provider': 300, 'timestamp': (now + timedelta(minutes=i)).isoformat()})
+                        assert response.status_code == 200
+                    # the snapshot is published before the forwarded request returns
+                    self.assertEqual(client.get("/smart-meter").json()['latest_mean'], 300)
+                    assert client.get("/smart-meter", headers={'If-None-Match': etag}).status_code == 200
+                    # only the latest decisions are published
+                    self.assertEqual(len(manager.decisions), 3)
+                    self.assertEqual(client.get("/debug/decisions").json()[-1]['timestamp'], manager.decisions[-1].timestamp.isoformat(sep=' '))
+                    self.assertEqual(len(client.get("/debug/decisions").json()), 2)
+                    self.assertEqual(client.get("/plug-info/A").json(), {'type': 'testing'})
+                    assert client.get("/plug-state/unknown").status_code == 404
+                    assert client.put("/plug-state/unknown/disable").status_code == 404
+                    assert client.put("/plug-state/A/disable").status_code == 200
+                    self.assertEqual(client.get("/plug-state/A").json()['enabled'], 'Off')
+                    response = client.put("/plug-state/A", json={'watt_consumed_at_plug': 100, 'online': True, 'is_on': False})
+                    assert response.status_code == 501
+            finally:
+                owner.stop()
+            # tasks of the owner are done and its loop is closed
+            self.assertEqual(owner._tasks, set())
+            self.assertTrue(owner._loop.is_closed()) # type: ignore
+
+    def test_sites_with_workers(self) -> None:
+        with patch.dict(os.environ, {'CONFIG_PATH': '/does/not/exist.yml', 'SMARTPLUG_ENERGY_CONTROLLER_PORT': '8000', 
+                                     'SMARTPLUG_ENERGY_CONTROLLER_WORKERS': '2', 'SITES_CONFIG_DIR': '/does/not/exist'}):
+            with self.assertRaises(ValueError):
+                serve()
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except Exception as e:
+        logger.exception("Caught Exception: " + str(e))
+    except:
+        logger.exception("Caught unknow exception")